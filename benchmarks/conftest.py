@@ -0,0 +1,64 @@
+import random
+from ipaddress import IPv4Network, IPv6Network
+
+import pytest
+
+
+# Session backends to run the session-dependent benchmarks against.
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+
+# A mix of browser and crawler User-Agents, in rough proportion to real traffic.
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/126.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/126.0.0.0 Safari/537.36 Edg/126.0.0.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/17.5 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:127.0) Gecko/20100101 Firefox/127.0',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:127.0) Gecko/20100101 Firefox/127.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) AppleWebKit/605.1.15 '
+    '(KHTML, like Gecko) Version/17.5 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/126.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (Linux; Android 6.0.1; Nexus 5X Build/MMB29P) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/126.0.6478.126 Mobile Safari/537.36 '
+    '(compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+    'Mozilla/5.0 (compatible; AhrefsBot/7.0; +http://ahrefs.com/robot/)',
+    'Mozilla/5.0 (compatible; SemrushBot/7~bl; +http://www.semrush.com/bot.html)',
+    'Mozilla/5.0 AppleWebKit/537.36 (KHTML, like Gecko; compatible; GPTBot/1.2; '
+    '+https://openai.com/gptbot)',
+    'Mozilla/5.0 (compatible; Siteimprove.com)',
+    'python-requests/2.32.3',
+    'curl/8.7.1',
+]
+
+EXCLUDED_USER_AGENTS = r'Googlebot|bingbot|Siteimprove\.com'
+
+
+@pytest.fixture(params=list(SESSION_ENGINES))
+def session_engine(request, settings):
+    """Run a benchmark once with each session backend.
+
+    Benchmarks using this need the django_db mark, for the db backend.
+    """
+    settings.SESSION_ENGINE = SESSION_ENGINES[request.param]
+    return settings.SESSION_ENGINE
+
+
+def random_networks(count, seed=0):
+    """Create a mix of random IPv4 /24 and IPv6 /48 networks."""
+    rng = random.Random(seed)
+    networks = []
+    for i in range(count):
+        if i % 4:
+            networks.append(IPv4Network((rng.getrandbits(24) << 8, 24)))
+        else:
+            networks.append(IPv6Network((rng.getrandbits(48) << 80, 48)))
+    return networks
@@ -0,0 +1,31 @@
+from ipaddress import ip_network
+
+import pytest
+
+from dam.ipindex import IPIndex, dump_index, load_index
+from dam.matchers import make_ip_list
+from benchmarks.conftest import random_networks
+
+
+@pytest.fixture(scope='module')
+def networks():
+    return [str(network) for network in random_networks(50000)]
+
+
+def test_load_settings(benchmark, networks):
+    """Build the index the way ALTCHA_EXCLUDE_IPS is, from ip_network objects."""
+    index = benchmark(lambda: IPIndex(make_ip_list(networks)))
+    assert index
+
+
+def test_load_text_file(benchmark, networks, tmp_path):
+    path = tmp_path / 'ips.txt'
+    path.write_text('\n'.join(networks))
+    assert benchmark(load_index, str(path))
+
+
+def test_load_compiled_file(benchmark, networks, tmp_path):
+    path = tmp_path / 'ips.bin'
+    with open(path, 'wb') as file:
+        dump_index(IPIndex(map(ip_network, networks)), file)
+    assert benchmark(load_index, str(path))
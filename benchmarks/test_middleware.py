@@ -0,0 +1,92 @@
+import random
+from importlib import import_module
+from ipaddress import ip_address
+from itertools import cycle
+from time import time
+from unittest.mock import Mock
+
+import pytest
+from django.conf import settings
+
+from dam.middleware import AltchaMiddleware
+from benchmarks.conftest import EXCLUDED_USER_AGENTS, USER_AGENTS, random_networks
+
+
+def make_session(engine, data):
+    """Save a session with the given data, returning its key."""
+    session = import_module(engine).SessionStore()
+    session.update(data)
+    session.save()
+    return session.session_key
+
+
+class TestProcessRequest:
+    @pytest.mark.django_db
+    def test_verified(self, benchmark, session_engine, rf):
+        AM = AltchaMiddleware(Mock())
+        SessionStore = import_module(session_engine).SessionStore
+        session_key = make_session(session_engine, {settings.ALTCHA_SESSION_KEY: time() + 3600,
+                                                    'ip': '127.0.0.1'})
+        request = rf.get('/protected/', REMOTE_ADDR='127.0.0.1')
+
+        def process_request():
+            # Each request loads its session from the backend.
+            request.session = SessionStore(session_key)
+            return AM.process_request(request)
+
+        assert benchmark(process_request) is None
+
+    @pytest.mark.django_db
+    def test_redirected(self, benchmark, session_engine, rf):
+        AM = AltchaMiddleware(Mock())
+        SessionStore = import_module(session_engine).SessionStore
+        request = rf.get('/protected/?search=stuff', HTTP_REFERER='https://example.com/')
+
+        def process_request():
+            request.session = SessionStore()
+            return AM.process_request(request)
+
+        assert benchmark(process_request).status_code == 302
+
+    @pytest.mark.parametrize('exclusion', ['path', 'ip', 'header'])
+    def test_excluded(self, benchmark, exclusion, rf, settings):
+        settings.ALTCHA_EXCLUDE_PATHS = {'/robots.txt', '/static/*'}
+        settings.ALTCHA_EXCLUDE_IPS = [str(network) for network in random_networks(1000)]
+        settings.ALTCHA_EXCLUDE_HEADERS = {'User-Agent': EXCLUDED_USER_AGENTS}
+        AM = AltchaMiddleware(Mock())
+        if exclusion == 'path':
+            request = rf.get('/static/dam/dam.css')
+        elif exclusion == 'ip':
+            request = rf.get('/protected/', REMOTE_ADDR=settings.ALTCHA_EXCLUDE_IPS[1][:-3])
+        else:
+            request = rf.get('/protected/', HTTP_USER_AGENT=USER_AGENTS[7])
+        request.session = {}
+        assert benchmark(AM.process_request, request) is None
+
+
+@pytest.mark.parametrize('size', [10, 100, 1000, 10000, 50000])
+def test_exclude_ip(benchmark, size, rf, settings):
+    settings.ALTCHA_EXCLUDE_IPS = [str(network) for network in random_networks(size)]
+    AM = AltchaMiddleware(Mock())
+    rng = random.Random(1)
+    requests = cycle([rf.get('/protected/', REMOTE_ADDR=str(ip_address(rng.getrandbits(32))))
+                      for _ in range(1000)])
+    benchmark(lambda: AM.exclude_ip(next(requests)))
+
+
+def test_exclude_headers(benchmark, rf, settings):
+    settings.ALTCHA_EXCLUDE_HEADERS = {'User-Agent': EXCLUDED_USER_AGENTS}
+    AM = AltchaMiddleware(Mock())
+    requests = cycle([rf.get('/protected/', HTTP_USER_AGENT=user_agent)
+                      for user_agent in USER_AGENTS])
+    benchmark(lambda: AM.exclude_headers(next(requests)))
+
+
+@pytest.mark.parametrize('metrics', [False, True], ids=['without_metrics', 'with_metrics'])
+def test_metrics_overhead(benchmark, metrics, rf, settings):
+    settings.ALTCHA_METRICS = metrics
+    settings.ALTCHA_EXCLUDE_PATHS = {'/static/*'}
+    AM = AltchaMiddleware(Mock())
+    request = rf.get('/static/dam/dam.css')
+    request.session = {}
+    assert benchmark(AM.process_request, request) is None
@@ -0,0 +1,56 @@
+import asyncio
+import json
+from base64 import b64encode
+from importlib import import_module
+
+import pytest
+from altcha import solve_challenge
+
+from dam.challenges import new_challenge
+from dam.views import dam_challenge, submit_challenge
+
+
+@pytest.fixture
+def run():
+    """Run coroutines on one event loop, rather than starting one per call."""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.mark.parametrize('prerender', [False, True], ids=['template', 'prerendered'])
+def test_dam_challenge(benchmark, prerender, rf, run, settings):
+    settings.ALTCHA_PRERENDER = prerender
+    request = rf.get('/dam/', {'next': '/protected/?search=stuff'})
+    response = benchmark(lambda: run(dam_challenge(request)))
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_submit_challenge(benchmark, session_engine, rf, run):
+    SessionStore = import_module(session_engine).SessionStore
+
+    def setup():
+        # Every round needs an unused solution, as replays are rejected.
+        challenge = new_challenge(max_number=1000)
+        solution = solve_challenge(challenge.challenge, challenge.salt, challenge.algorithm,
+                                   challenge.max_number, 0)
+        payload = b64encode(json.dumps({
+            'algorithm': challenge.algorithm,
+            'challenge': challenge.challenge,
+            'number': solution.number,
+            'salt': challenge.salt,
+            'signature': challenge.signature,
+        }).encode()).decode()
+        request = rf.post('/dam/submit/', {'altcha': payload})
+        request.session = SessionStore()
+        return (request,), {}
+
+    def submit(request):
+        response = run(submit_challenge(request))
+        # Persist the verification, as SessionMiddleware would.
+        request.session.save()
+        return response
+
+    response = benchmark.pedantic(submit, setup=setup, rounds=200, warmup_rounds=5)
+    assert response.status_code == 200
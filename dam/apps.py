@@ -1,7 +1,14 @@
 from django.apps import AppConfig
 
+from dam.config import get_config
+
 
 class DamConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dam'
     verbose_name = 'Django Altcha Middleware'
+
+    def ready(self):
+        # Validate the settings and compile the exclusions at startup, rather
+        # than on the first request.
+        get_config()
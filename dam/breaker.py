@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.core.cache import caches
+
+from dam.config import get_config
+from dam.metrics import count_breaker_transition
+from dam.steps import Deferred
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CacheUnavailable(Exception):
+    """The cache failed, took too long, or isn't being called while its breaker is open."""
+
+
+class CircuitBreaker:
+    """Stop calling a failing service until it has had time to recover.
+
+    The breaker starts closed, letting calls through. After failure_threshold
+    failures in a row, it opens, and calls are refused for reset_seconds.
+    Then it is half open: a single trial call is let through, which closes
+    the breaker if it succeeds, or opens it again if it fails. Each change of
+    state is counted in the dam_cache_breaker_transitions_total metric.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Determine if a call may be made now."""
+        if self.state == CLOSED:
+            return True
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                # Let this call through as the trial; others are refused until it's done.
+                self.transition(HALF_OPEN)
+                return True
+            return False
+
+    def record_success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.transition(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED
+                                           and self.failures >= self.failure_threshold):
+                self.transition(OPEN)
+
+    def transition(self, state):
+        """Change state. Must be called holding the lock."""
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            logger.warning('Circuit breaker for %s opened after %d failures.',
+                           self.name, self.failures)
+        elif state == CLOSED:
+            logger.info('Circuit breaker for %s closed.', self.name)
+        count_breaker_transition(state)
+
+
+class GuardedCache:
+    """Call a Django cache with a deadline, behind a circuit breaker.
+
+    call() and acall() run a cache method, raising CacheUnavailable if the
+    breaker is open, the backend raises, or it doesn't answer within
+    deadline seconds, so callers can fall back rather than stall. Errors and
+    missed deadlines count as failures towards opening the breaker, but a
+    ValueError (e.g. from incr() of a missing key) is the cache's answer, so
+    is raised as it is. Sync calls run on a small pool of threads so they can
+    be waited on with a timeout; calls that miss their deadline are abandoned,
+    not interrupted, but once the breaker opens, no more are made. Without a
+    deadline, sync calls run in the caller's thread.
+
+    Operations written as generators of steps (see dam.steps) yield defer()
+    calls, which are made with call() or acall() depending on how they are run.
+
+    Django's cache connections are per thread, so the cache is looked up by
+    its alias in whichever thread makes the call, including the pool's.
+    """
+
+    def __init__(self, cache_alias, breaker, deadline=None, max_workers=8):
+        self.cache_alias = cache_alias
+        self.breaker = breaker
+        self.deadline = deadline
+        self.executor = (ThreadPoolExecutor(max_workers, thread_name_prefix='dam-cache')
+                         if deadline else None)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def run(self, method, args, kwargs):
+        return getattr(self.cache, method)(*args, **kwargs)
+
+    @contextmanager
+    def guard(self):
+        """Refuse a call while the breaker is open, and record the outcome of one made."""
+        if not self.breaker.allow():
+            raise CacheUnavailable(f'{self.breaker.name} circuit breaker is open.')
+        try:
+            yield
+        except (FutureTimeoutError, asyncio.TimeoutError):
+            self.breaker.record_failure()
+            raise CacheUnavailable(f'{self.breaker.name} took over {self.deadline}s.')
+        except ValueError:
+            self.breaker.record_success()
+            raise
+        except Exception as err:
+            self.breaker.record_failure()
+            raise CacheUnavailable(f'{self.breaker.name} failed: {err!r}') from err
+        self.breaker.record_success()
+
+    def call(self, method, *args, **kwargs):
+        with self.guard():
+            if self.executor is None:
+                return self.run(method, args, kwargs)
+            return self.executor.submit(self.run, method, args, kwargs).result(self.deadline)
+
+    async def acall(self, method, *args, **kwargs):
+        """Async version of call(), which calls the cache's async method (e.g. aadd)."""
+        with self.guard():
+            return await asyncio.wait_for(getattr(self.cache, f'a{method}')(*args, **kwargs),
+                                          self.deadline)
+
+    def defer(self, method, *args, **kwargs):
+        """Return a call of a cache method, to be yielded by a generator of steps."""
+        return Deferred(self.call, self.acall, method, *args, **kwargs)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+def guarded_cache(cache_alias):
+    """Return this process's GuardedCache for a cache alias, configured by ALTCHA_CACHE_*.
+
+    Every user of an alias shares it, and so its circuit breaker.
+    """
+    config = get_config()
+    options = config.cache_guard
+    return config.component(f'guarded_cache:{cache_alias}', lambda: GuardedCache(
+        cache_alias,
+        CircuitBreaker(
+            f'cache {cache_alias!r}',
+            failure_threshold=options['failure_threshold'],
+            reset_seconds=options['reset_seconds'],
+        ),
+        deadline=options['deadline'],
+    ))
@@ -0,0 +1,95 @@
+import hashlib
+import math
+import multiprocessing
+import time
+
+
+class ClientProfile:
+    """A kind of client solving challenges: how fast each worker hashes, and how many it runs.
+
+    The widget splits the search across its web workers, so a profile solves
+    as fast as one worker hashing rate * workers times a second.
+    """
+
+    def __init__(self, name, rate, workers=1):
+        self.name = name
+        self.rate = rate
+        self.workers = workers
+
+    def __repr__(self):
+        return f'ClientProfile({self.name!r}, {self.rate!r}, workers={self.workers!r})'
+
+    @classmethod
+    def parse(cls, value):
+        """Parse a profile from 'name:rate' or 'name:rate:workers'."""
+        try:
+            name, rate, *workers = value.split(':')
+            profile = cls(name, float(rate), int(workers[0]) if workers else 1)
+        except ValueError:
+            raise ValueError(f"Invalid client profile {value!r}: expected 'name:rate[:workers]'.")
+        if not name or len(workers) > 1 or profile.rate <= 0 or profile.workers < 1:
+            raise ValueError(f"Invalid client profile {value!r}: expected 'name:rate[:workers]'.")
+        return profile
+
+    @property
+    def total_rate(self):
+        return self.rate * self.workers
+
+
+# Rough SHA-256 rates of the widget's web workers, which hash with the
+# browser's WebCrypto API. They vary a lot between devices and browsers, so
+# measure your own clients' where you can.
+CLIENT_PROFILES = [
+    ClientProfile('desktop', 500_000, workers=4),
+    ClientProfile('mobile', 150_000, workers=2),
+    ClientProfile('low-end mobile', 50_000, workers=1),
+]
+
+
+def hash_rate(seconds=1.0, batch=10_000):
+    """Measure how many challenge hashes a second this process can try.
+
+    Solving tries sha256(salt + str(number)) for each number in turn. As the
+    salt is the same for every number, it is hashed once, and each attempt
+    copies that state and hashes just the number, which is how a native
+    solver would batch its work. Numbers are tried in batches between checks
+    of the clock.
+    """
+    base = hashlib.sha256(b'calibration-salt?expires=0&')
+    target = hashlib.sha256(b'never matches').digest()
+    copy = base.copy
+    tried = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for number in range(tried, tried + batch):
+            digest = copy()
+            digest.update(str(number).encode())
+            if digest.digest() == target:
+                break
+        tried += batch
+        now = time.perf_counter()
+        if now >= deadline:
+            return tried / (now - started)
+
+
+def multi_core_hash_rate(processes, seconds=1.0):
+    """Measure how many challenge hashes a second this host can try using several processes."""
+    with multiprocessing.Pool(processes) as pool:
+        return sum(pool.map(hash_rate, [seconds] * processes))
+
+
+def solve_seconds(max_number, rate, percentile=None):
+    """Model how long solving a challenge takes at rate hashes a second.
+
+    The secret number is picked uniformly from 0 to max_number, so on average
+    half the numbers are tried, and at the p-th percentile, p% of them. Without
+    a percentile, the expected (mean) time is returned.
+    """
+    share = 0.5 if percentile is None else percentile / 100
+    return max_number * share / rate
+
+
+def recommend_max_number(target_seconds, rate, percentile=95):
+    """Return the largest max_number solved within target_seconds at the percentile."""
+    return max(1, math.floor(target_seconds * rate * 100 / percentile))
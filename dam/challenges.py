@@ -0,0 +1,234 @@
+import datetime
+import threading
+import time
+
+from altcha import create_challenge
+
+from dam.breaker import CacheUnavailable, guarded_cache
+from dam.clientip import get_client_ip
+from dam.config import get_config
+from dam.difficulty import get_difficulty_controller
+from dam.metrics import count_challenge, count_pool, get_metrics
+from dam.ratelimit import get_rate_limiter
+from dam.signals import challenge_issued
+from dam.steps import arun_steps, run_steps
+
+
+POOL_HEAD_KEY = 'dam:pool:head'
+
+
+def new_challenge(extra_seconds=0, max_number=None):
+    """Create an Altcha challenge using the configured settings.
+
+    extra_seconds is added to the challenge's lifetime, to cover time spent
+    waiting in the challenge pool. max_number overrides ALTCHA_MAX_NUMBER.
+    """
+    config = get_config()
+    started = time.perf_counter()
+    challenge = create_challenge(
+        expires=datetime.datetime.now() + datetime.timedelta(
+            minutes=config.challenge_expire_minutes, seconds=extra_seconds),
+        max_number=max_number or config.max_number,
+        hmac_key=config.hmac_key,
+        # Use the params to add arbitrary values to the salt, potentially increasing security
+        params=config.salt_params,
+    )
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.observe('dam_create_challenge_seconds', time.perf_counter() - started)
+    return challenge
+
+
+def issue_challenge(request):
+    """Issue a challenge to the request's client, or return None if it is rate limited.
+
+    The difficulty comes from the adaptive difficulty controller, if enabled,
+    and the challenge from the pool, if enabled and it has one.
+    """
+    return run_steps(issue_steps(request))
+
+
+async def aissue_challenge(request):
+    """Async version of issue_challenge()."""
+    return await arun_steps(issue_steps(request))
+
+
+def issue_steps(request):
+    client_ip = get_client_ip(request)
+    limiter = get_rate_limiter('challenge')
+    if limiter is not None and not (yield from limiter.allow_steps(client_ip)):
+        return None
+    config = get_config()
+    max_number = config.max_number
+    controller = get_difficulty_controller()
+    if controller is not None:
+        max_number = yield from controller.issue_steps(client_ip)
+    challenge = None
+    pool = get_challenge_pool()
+    # Pooled challenges are only usable at the default difficulty.
+    if pool is not None and max_number == config.max_number:
+        if config.pool_refill_thread:
+            pool.start()
+        challenge = yield from pool.take_steps()
+    if challenge is None:
+        challenge = new_challenge(max_number=max_number)
+    return record_issued(request, challenge)
+
+
+def record_issued(request, challenge):
+    count_challenge('issued')
+    challenge_issued.send(sender=issue_challenge, request=request, challenge=challenge)
+    return challenge
+
+
+def challenge_data(challenge):
+    """Return a challenge in the JSON format the Altcha widget accepts."""
+    return {
+        'algorithm': challenge.algorithm,
+        'challenge': challenge.challenge,
+        'maxnumber': challenge.max_number,
+        'salt': challenge.salt,
+        'signature': challenge.signature,
+    }
+
+
+def challenge_lifetime():
+    """Return the longest time, in seconds, that an issued challenge stays valid."""
+    config = get_config()
+    lifetime = config.challenge_expire_minutes * 60
+    if config.pool is not None:
+        # Pooled challenges are valid for longer, to cover their time in the pool.
+        lifetime += config.pool['ttl']
+    return lifetime
+
+
+def slot_key(index):
+    return f'dam:pool:{index}'
+
+
+def head_seed():
+    """Return the value to start a missing head counter at.
+
+    The clock in nanoseconds is ahead of any slot claimed before the counter
+    was evicted or reset, as each claim only adds one, so no challenge still
+    in the pool is handed out again.
+    """
+    return time.time_ns()
+
+
+class ChallengePool:
+    """Pool of pre-generated challenges stored in a Django cache.
+
+    Challenges sit in numbered slots. Consumers claim the next slot by
+    atomically incrementing a shared head counter, so with a shared cache
+    (e.g. Redis or Memcached) every worker process draws from the same pool
+    and no challenge is handed out twice. A slot is deleted once taken, and
+    refills fill the slots ahead of the head in one batch. Slots expire after
+    ALTCHA_POOL_TTL seconds, and each challenge's lifetime is extended by that
+    much, so a challenge taken from the pool always has its full
+    ALTCHA_CHALLENGE_EXPIRE_MINUTES left to solve.
+
+    The cache is guarded by a deadline and circuit breaker. While it is
+    unavailable, the pool counts as empty and isn't refilled.
+    """
+
+    def __init__(self, size, ttl=60, refill_interval=10, cache_alias='default'):
+        self.size = size
+        self.ttl = ttl
+        self.refill_interval = refill_interval
+        self.cache_alias = cache_alias
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return guarded_cache(self.cache_alias)
+
+    def claim_slot_steps(self):
+        try:
+            return (yield self.cache.defer('incr', POOL_HEAD_KEY))
+        except ValueError:
+            # Head counter doesn't exist yet, or was evicted.
+            yield self.cache.defer('add', POOL_HEAD_KEY, head_seed(), timeout=None)
+            return (yield self.cache.defer('incr', POOL_HEAD_KEY))
+
+    def take(self):
+        """Take a challenge from the pool, returning None if it is empty or unavailable."""
+        return run_steps(self.take_steps())
+
+    async def atake(self):
+        """Async version of take()."""
+        return await arun_steps(self.take_steps())
+
+    def take_steps(self):
+        try:
+            slot = yield from self.claim_slot_steps()
+            key = slot_key(slot)
+            challenge = yield self.cache.defer('get', key)
+            if challenge is not None:
+                yield self.cache.defer('delete', key)
+        except CacheUnavailable:
+            return None
+        return self.record(challenge)
+
+    def record(self, challenge):
+        if challenge is None:
+            count_pool('miss')
+            # Refill early rather than waiting for the next interval.
+            self.wakeup.set()
+        else:
+            count_pool('hit')
+        return challenge
+
+    def refill(self):
+        """Fill any empty slots ahead of the head, returning how many were filled."""
+        cache = self.cache
+        try:
+            head = cache.call('get', POOL_HEAD_KEY)
+            if head is None:
+                cache.call('add', POOL_HEAD_KEY, head_seed(), timeout=None)
+                head = cache.call('get', POOL_HEAD_KEY, 0)
+            keys = [slot_key(index) for index in range(head + 1, head + self.size + 1)]
+            filled = cache.call('get_many', keys)
+            challenges = {key: new_challenge(extra_seconds=self.ttl)
+                          for key in keys if key not in filled}
+            if challenges:
+                cache.call('set_many', challenges, timeout=self.ttl)
+                count_pool('refilled', len(challenges))
+        except CacheUnavailable:
+            # The breaker logs the outage, so skip this refill quietly.
+            return 0
+        return len(challenges)
+
+    def start(self):
+        """Start refilling the pool in a background thread, if not already running.
+
+        This is called on first use rather than at startup, so that each
+        worker process forked from a preloaded parent starts its own thread.
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='dam-challenge-pool',
+                                               daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """Stop refilling the pool in the background."""
+        self.stopped.set()
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.refill()
+            self.wakeup.wait(self.refill_interval)
+            self.wakeup.clear()
+
+
+def get_challenge_pool():
+    """Return this process's challenge pool, or None if ALTCHA_POOL_SIZE is 0."""
+    config = get_config()
+    if config.pool is None:
+        return None
+    return config.component('challenge_pool', lambda: ChallengePool(**config.pool))
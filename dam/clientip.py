@@ -0,0 +1,77 @@
+import ipaddress
+
+from dam.config import get_config
+from dam.ipindex import IPIndex
+
+
+def parse_address(value):
+    """Parse an IP address, returning None if it isn't valid."""
+    try:
+        return ipaddress.ip_address(value)
+    except ValueError:
+        return None
+
+
+class ClientIPResolver:
+    """Find a request's client IP address among the proxies it passed through.
+
+    X-Forwarded-For is read from the right, starting from the proxy that
+    connected to Django (REMOTE_ADDR), as each proxy appends the address it
+    received the request from, and only the entries added by trusted proxies
+    can be believed. With trusted_proxies, hops from addresses in those
+    networks are skipped, and the first hop from anywhere else is the client.
+    With proxy_count, the client is that many hops back (so with 0, it is
+    REMOTE_ADDR). With neither, the first (leftmost) X-Forwarded-For address
+    is used, as sent by the client, which any client can spoof.
+    """
+
+    def __init__(self, trusted_proxies=(), proxy_count=None):
+        self.trusted_proxies = IPIndex(trusted_proxies)
+        self.proxy_count = proxy_count
+
+    def resolve(self, meta):
+        """Return the client's IP address as a string and as an ipaddress object.
+
+        The object is None if the address isn't valid.
+        """
+        forwarded_for = meta.get('HTTP_X_FORWARDED_FOR')
+        if not self.trusted_proxies and self.proxy_count is None:
+            client_ip = (forwarded_for or meta.get('REMOTE_ADDR')).split(',')[0]
+            return client_ip, parse_address(client_ip)
+        hops = [hop.strip() for hop in forwarded_for.split(',')] if forwarded_for else []
+        hops.append(meta.get('REMOTE_ADDR'))
+        if not self.trusted_proxies:
+            client_ip = hops[max(0, len(hops) - 1 - self.proxy_count)]
+            return client_ip, parse_address(client_ip)
+        for client_ip in reversed(hops):
+            address = parse_address(client_ip)
+            if address is None or address not in self.trusted_proxies:
+                return client_ip, address
+        # Every hop is a trusted proxy, so the leftmost is the best guess.
+        return client_ip, address
+
+
+def get_resolver():
+    """Return the resolver configured by ALTCHA_TRUSTED_PROXIES and ALTCHA_PROXY_COUNT."""
+    config = get_config()
+    return config.component('client_ip_resolver', lambda: ClientIPResolver(
+        config.trusted_proxies, proxy_count=config.proxy_count))
+
+
+def resolve_client(request):
+    """Return the request's (client IP, address object), resolving it only once per request."""
+    try:
+        return request._dam_client
+    except AttributeError:
+        client = request._dam_client = get_resolver().resolve(request.META)
+        return client
+
+
+def get_client_ip(request):
+    """Return the request's client IP address as a string."""
+    return resolve_client(request)[0]
+
+
+def get_client_address(request):
+    """Return the request's client IP address as an ipaddress object, or None if invalid."""
+    return resolve_client(request)[1]
@@ -0,0 +1,460 @@
+import ipaddress
+import re
+import threading
+from functools import partial
+from types import MappingProxyType
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+from dam.exclusions import WatchedFile
+from dam.ipindex import IPIndex, load_index
+from dam.matchers import (HeaderMatcher, PathMatcher, load_header_matcher, load_path_matcher,
+                          make_excluded_headers, make_ip_list)
+
+
+# Settings besides ALTCHA_* that the configuration depends on.
+DEPENDENT_SETTINGS = frozenset({'STATIC_URL', 'STORAGES', 'STATICFILES_STORAGE', 'ROOT_URLCONF',
+                                'CACHES', 'TEMPLATES'})
+# Bundled stylesheet inlined into the challenge page with ALTCHA_INLINE_CSS.
+CSS_PATH = 'dam/dam.css'
+
+
+class Config:
+    """The ALTCHA_* settings, validated and with their exclusions compiled.
+
+    Built once when the app is ready, and rebuilt only when a setting changes,
+    so requests read plain attributes rather than going through
+    django.conf.settings. The middleware (and so the dam decorator) and the
+    views all share it. It can't be changed once built.
+
+    The per-process objects built from it, such as the rate limiters and the
+    challenge pool, are kept on it as components, so they are rebuilt with it
+    when a setting changes.
+    """
+
+    __slots__ = (
+        'hmac_key', 'max_number', 'challenge_expire_minutes', 'salt_params',
+        'auth_expire_minutes', 'session_key', 'use_signed_cookie', 'cookie_name',
+        'fail_message', 'json_challenges', 'inline_challenges', 'inline_status', 'prerender',
+        'pool_refill_thread', 'excluded_paths', 'path_matcher', 'excluded_ips',
+        'ip_index', 'excluded_headers', 'header_cache_size', 'header_matcher',
+        'crawlers', 'ip_file', 'path_file', 'header_file', 'trusted_proxies',
+        'proxy_count', 'token_keys', 'token_key_id', 'ipv4_bind_prefix', 'ipv6_bind_prefix',
+        'rate_limits', 'pool', 'difficulty', 'metrics', 'replay_store_class', 'replay',
+        'cache_guard', 'revocation', 'events', '_urls', '_page_context', '_components',
+        '_components_lock',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values.get(name))
+        object.__setattr__(self, '_components', {})
+        # Re-entrant, as building one component may use another.
+        object.__setattr__(self, '_components_lock', threading.RLock())
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config is immutable; change the settings instead.')
+
+    def __delattr__(self, name):
+        raise AttributeError('Config is immutable; change the settings instead.')
+
+    @classmethod
+    def from_settings(cls):
+        """Build the configuration from settings, raising ImproperlyConfigured if invalid."""
+        for name in ('ALTCHA_HMAC_KEY', 'ALTCHA_MAX_NUMBER'):
+            if not hasattr(settings, name):
+                raise ImproperlyConfigured(f'dam requires {name}.')
+        hmac_key = settings.ALTCHA_HMAC_KEY
+        max_number = settings.ALTCHA_MAX_NUMBER
+        if not isinstance(max_number, int) or max_number < 1:
+            raise ImproperlyConfigured('ALTCHA_MAX_NUMBER must be a positive integer.')
+        inline_status = getattr(settings, 'ALTCHA_INLINE_CHALLENGE_STATUS', 403)
+        if not isinstance(inline_status, int):
+            raise ImproperlyConfigured('ALTCHA_INLINE_CHALLENGE_STATUS must be an integer.')
+        excluded_paths = getattr(settings, 'ALTCHA_EXCLUDE_PATHS', set())
+        try:
+            excluded_ips = tuple(make_ip_list(getattr(settings, 'ALTCHA_EXCLUDE_IPS', [])))
+        except ValueError as err:
+            # Skipping it would challenge clients that are meant to be let through.
+            raise ImproperlyConfigured(f'Invalid ALTCHA_EXCLUDE_IPS: {err}')
+        try:
+            excluded_headers = MappingProxyType(
+                make_excluded_headers(getattr(settings, 'ALTCHA_EXCLUDE_HEADERS', {})))
+        except re.error as err:
+            raise ImproperlyConfigured(f'Invalid ALTCHA_EXCLUDE_HEADERS pattern: {err}')
+        header_cache_size = integer('ALTCHA_HEADER_CACHE_SIZE', 1024)
+        try:
+            trusted_proxies = tuple(ipaddress.ip_network(network)
+                                    for network in getattr(settings, 'ALTCHA_TRUSTED_PROXIES', []))
+        except ValueError as err:
+            # Trusting the wrong hops would let clients spoof their address.
+            raise ImproperlyConfigured(f'Invalid ALTCHA_TRUSTED_PROXIES: {err}')
+        proxy_count = integer('ALTCHA_PROXY_COUNT', None, allow_none=True)
+        token_keys = MappingProxyType(dict(getattr(settings, 'ALTCHA_TOKEN_KEYS', None)
+                                           or {'0': hmac_key}))
+        if any(not isinstance(key_id, str) or ':' in key_id for key_id in token_keys):
+            raise ImproperlyConfigured('ALTCHA_TOKEN_KEYS ids must be strings without colons.')
+        token_key_id = getattr(settings, 'ALTCHA_TOKEN_KEY_ID', None) or next(iter(token_keys))
+        if token_key_id not in token_keys:
+            raise ImproperlyConfigured(f'ALTCHA_TOKEN_KEY_ID {token_key_id!r} is not in '
+                                       'ALTCHA_TOKEN_KEYS.')
+        # Exclusions may also be loaded from files, which are reloaded when they change.
+        check_interval = number('ALTCHA_EXCLUDE_FILES_CHECK_SECONDS', 5)
+        auth_expire_minutes = number('ALTCHA_AUTH_EXPIRE_MINUTES', 480)
+        return cls(
+            hmac_key=hmac_key,
+            max_number=max_number,
+            challenge_expire_minutes=number('ALTCHA_CHALLENGE_EXPIRE_MINUTES', 2),
+            salt_params=MappingProxyType(dict(getattr(settings, 'ALTCHA_SALT_PARAMS', {}))),
+            auth_expire_minutes=auth_expire_minutes,
+            session_key=getattr(settings, 'ALTCHA_SESSION_KEY', 'altcha_verified'),
+            use_signed_cookie=getattr(settings, 'ALTCHA_USE_SIGNED_COOKIE', False),
+            cookie_name=getattr(settings, 'ALTCHA_COOKIE_NAME', 'altcha_verified'),
+            fail_message=getattr(settings, 'ALTCHA_FAIL_MESSAGE',
+                                 'Challenge failed or no longer valid.'),
+            json_challenges=getattr(settings, 'ALTCHA_JSON_CHALLENGES', False),
+            inline_challenges=getattr(settings, 'ALTCHA_INLINE_CHALLENGES', False),
+            inline_status=inline_status,
+            prerender=getattr(settings, 'ALTCHA_PRERENDER', False),
+            pool_refill_thread=getattr(settings, 'ALTCHA_POOL_REFILL_THREAD', True),
+            excluded_paths=excluded_paths,
+            path_matcher=PathMatcher(excluded_paths),
+            excluded_ips=excluded_ips,
+            ip_index=IPIndex(excluded_ips),
+            excluded_headers=excluded_headers,
+            header_cache_size=header_cache_size,
+            header_matcher=HeaderMatcher(excluded_headers, header_cache_size),
+            crawlers=crawler_options(trusted_proxies, proxy_count),
+            ip_file=watch_file(getattr(settings, 'ALTCHA_EXCLUDE_IPS_FILE', None),
+                               load_index,
+                               check_interval),
+            path_file=watch_file(getattr(settings, 'ALTCHA_EXCLUDE_PATHS_FILE', None),
+                                 load_path_matcher,
+                                 check_interval),
+            header_file=watch_file(getattr(settings, 'ALTCHA_EXCLUDE_HEADERS_FILE', None),
+                                   partial(load_header_matcher, cache_size=header_cache_size),
+                                   check_interval),
+            trusted_proxies=trusted_proxies,
+            proxy_count=proxy_count,
+            token_keys=token_keys,
+            token_key_id=token_key_id,
+            ipv4_bind_prefix=integer('ALTCHA_IPV4_BIND_PREFIX', 32, maximum=32),
+            ipv6_bind_prefix=integer('ALTCHA_IPV6_BIND_PREFIX', 128, maximum=128),
+            rate_limits=rate_limit_options(),
+            pool=pool_options(),
+            difficulty=difficulty_options(max_number),
+            metrics=metrics_options(),
+            replay_store_class=imported('ALTCHA_REPLAY_STORE', 'dam.replay.ReplayStore'),
+            replay=MappingProxyType({
+                'cache_alias': cache_alias('ALTCHA_REPLAY_CACHE'),
+                'local_size': integer('ALTCHA_REPLAY_LOCAL_SIZE', 10000),
+            }),
+            cache_guard=MappingProxyType({
+                'deadline': number('ALTCHA_CACHE_DEADLINE_SECONDS', 0.5, allow_none=True),
+                'failure_threshold': integer('ALTCHA_CACHE_BREAKER_THRESHOLD', 5, minimum=1),
+                'reset_seconds': number('ALTCHA_CACHE_BREAKER_RESET_SECONDS', 30),
+            }),
+            revocation=revocation_options(auth_expire_minutes),
+            events=event_options(),
+        )
+
+    def component(self, name, build):
+        """Return this process's component called name, building it with build() on first use."""
+        component = self._components.get(name)
+        if component is None:
+            with self._components_lock:
+                component = self._components.get(name)
+                if component is None:
+                    component = self._components[name] = build()
+        return component
+
+    def close(self):
+        """Stop the components' background threads, once this configuration is replaced."""
+        for component in list(self._components.values()):
+            # Components with resources to release (e.g. the event log's file) close them too.
+            stop = getattr(component, 'close', None) or getattr(component, 'stop', None)
+            if stop is not None:
+                stop()
+
+    @property
+    def urls(self):
+        """Return the challenge URL and the app's own paths, resolving them on first use.
+
+        They aren't resolved when the app is ready, as the URLconf may not be
+        importable yet.
+        """
+        urls = self._urls
+        if urls is None:
+            challenge_url = reverse('dam:challenge')
+            urls = (challenge_url, frozenset({challenge_url, reverse('dam:submit_challenge'),
+                                              reverse('dam:check')}))
+            object.__setattr__(self, '_urls', urls)
+        return urls
+
+    @property
+    def page_context(self):
+        """Return the challenge page's context from settings, building it on first use.
+
+        It isn't built when the app is ready, as resolving the static files'
+        URLs with the manifest storage needs the manifest, which doesn't
+        exist until collectstatic has run.
+        """
+        context = self._page_context
+        if context is None:
+            context = MappingProxyType(page_context())
+            object.__setattr__(self, '_page_context', context)
+        return context
+
+    @property
+    def challenge_url(self):
+        return self.urls[0]
+
+    @property
+    def dam_paths(self):
+        """Return the app's own paths, which are never challenged."""
+        return self.urls[1]
+
+
+def page_context():
+    """Return the parts of the challenge page context that come from settings.
+
+    The bundled assets' URLs are resolved through the static files storage,
+    so with the manifest storage they are the hashed files' URLs.
+    """
+    return {
+        'site_icon_url': getattr(settings, 'ALTCHA_SITE_ICON_URL', ''),
+        'js_src_url': getattr(settings, 'ALTCHA_JS_URL', None) or static('altcha/altcha.min.js'),
+        'css_src_url': getattr(settings, 'ALTCHA_CSS_URL', None) or static(CSS_PATH),
+        'inline_css': read_css() if getattr(settings, 'ALTCHA_INLINE_CSS', False) else '',
+        'preload_js': getattr(settings, 'ALTCHA_PRELOAD_JS', False),
+        'altcha_message': getattr(settings,
+                                  'ALTCHA_MESSAGE',
+                                  'Gauging your humanity...This may take some seconds.'),
+        'help_text': getattr(settings,
+                             'ALTCHA_HELP_MESSAGE',
+                             ''),
+    }
+
+
+def read_css():
+    """Return the contents of the bundled stylesheet, as found by the static files finders."""
+    path = finders.find(CSS_PATH)
+    if path is None:
+        raise ImproperlyConfigured(f'ALTCHA_INLINE_CSS is on, but {CSS_PATH} was not found.')
+    with open(path, encoding='utf-8') as css_file:
+        return css_file.read()
+
+
+def integer(name, default, minimum=0, maximum=None, allow_none=False):
+    """Return an integer setting, raising ImproperlyConfigured if it is out of bounds."""
+    value = getattr(settings, name, default)
+    if value is None and allow_none:
+        return None
+    if (not isinstance(value, int) or isinstance(value, bool) or value < minimum
+            or (maximum is not None and value > maximum)):
+        bounds = (f'from {minimum} to {maximum}' if maximum is not None
+                  else f'of at least {minimum}')
+        raise ImproperlyConfigured(f'{name} must be an integer {bounds}.')
+    return value
+
+
+def number(name, default, allow_none=False):
+    """Return a setting that must be a number of at least 0, such as a number of seconds."""
+    value = getattr(settings, name, default)
+    if value is None and allow_none:
+        return None
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+        raise ImproperlyConfigured(f'{name} must be a number of at least 0.')
+    return value
+
+
+def cache_alias(name):
+    """Return a setting naming a cache, which must be one of CACHES."""
+    alias = getattr(settings, name, 'default')
+    if alias not in settings.CACHES:
+        raise ImproperlyConfigured(f'{name} {alias!r} is not a cache in CACHES.')
+    return alias
+
+
+def imported(name, default):
+    """Import the object named by a dotted path setting."""
+    try:
+        return import_string(getattr(settings, name, default))
+    except ImportError as err:
+        raise ImproperlyConfigured(f'Invalid {name}: {err}')
+
+
+def rate_limit_options():
+    """Return the RateLimiter arguments for each scope with a rate limit."""
+    limits = {}
+    for scope in ('challenge', 'submit'):
+        name = f'ALTCHA_RATE_LIMIT_{scope.upper()}'
+        limit = getattr(settings, name, None)
+        if not limit:
+            continue
+        try:
+            rate, window = limit
+        except (TypeError, ValueError):
+            rate = window = None
+        if not all(isinstance(value, int) and value > 0 for value in (rate, window)):
+            raise ImproperlyConfigured(f'{name} must be a (requests, seconds) pair of '
+                                       'positive integers.')
+        limits[scope] = MappingProxyType({
+            'rate': rate,
+            'window': window,
+            'ipv4_prefix': integer('ALTCHA_RATE_LIMIT_IPV4_PREFIX', 32, maximum=32),
+            'ipv6_prefix': integer('ALTCHA_RATE_LIMIT_IPV6_PREFIX', 64, maximum=128),
+            'sync_interval': number('ALTCHA_RATE_LIMIT_SYNC_SECONDS', 1),
+            'sync_batch': integer('ALTCHA_RATE_LIMIT_SYNC_BATCH', 1000, minimum=1),
+            'max_networks': integer('ALTCHA_RATE_LIMIT_MAX_NETWORKS', 100000, minimum=1),
+            'cache_alias': cache_alias('ALTCHA_RATE_LIMIT_CACHE'),
+        })
+    return MappingProxyType(limits)
+
+
+def pool_options():
+    """Return the ChallengePool arguments, or None if ALTCHA_POOL_SIZE is 0."""
+    size = integer('ALTCHA_POOL_SIZE', 0)
+    if not size:
+        return None
+    return MappingProxyType({
+        'size': size,
+        'ttl': number('ALTCHA_POOL_TTL', 60),
+        'refill_interval': number('ALTCHA_POOL_REFILL_SECONDS', 10),
+        'cache_alias': cache_alias('ALTCHA_POOL_CACHE'),
+    })
+
+
+def difficulty_options(max_number):
+    """Return the DifficultyController arguments, or None if adaptive difficulty is off."""
+    if not getattr(settings, 'ALTCHA_ADAPTIVE_DIFFICULTY', False):
+        return None
+    floor = integer('ALTCHA_DIFFICULTY_FLOOR', None, minimum=1, allow_none=True) or max_number
+    ceiling = (integer('ALTCHA_DIFFICULTY_CEILING', None, minimum=floor, allow_none=True)
+               or floor * 10)
+    smoothing = number('ALTCHA_DIFFICULTY_SMOOTHING', 0.3)
+    if not 0 < smoothing <= 1:
+        raise ImproperlyConfigured('ALTCHA_DIFFICULTY_SMOOTHING must be more than 0 and at '
+                                   'most 1.')
+    options = {
+        'floor': floor,
+        'ceiling': ceiling,
+        'smoothing': smoothing,
+        'window': integer('ALTCHA_DIFFICULTY_WINDOW', 60, minimum=1),
+        'ipv4_prefix': integer('ALTCHA_DIFFICULTY_IPV4_PREFIX', 24, maximum=32),
+        'ipv6_prefix': integer('ALTCHA_DIFFICULTY_IPV6_PREFIX', 64, maximum=128),
+        'use_load': getattr(settings, 'ALTCHA_DIFFICULTY_USE_LOAD', True),
+        'refresh_interval': number('ALTCHA_DIFFICULTY_REFRESH_SECONDS', 5),
+        'cache_alias': cache_alias('ALTCHA_DIFFICULTY_CACHE'),
+    }
+    for option, name, default in (('issue_rate', 'ALTCHA_DIFFICULTY_ISSUE_RATE', 600),
+                                  ('fail_rate', 'ALTCHA_DIFFICULTY_FAIL_RATE', 60),
+                                  ('subnet_rate', 'ALTCHA_DIFFICULTY_SUBNET_RATE', 20)):
+        # The observed rates are divided by these.
+        options[option] = number(name, default)
+        if not options[option]:
+            raise ImproperlyConfigured(f'{name} must be more than 0.')
+    return MappingProxyType(options)
+
+
+def metrics_options():
+    """Return the metrics' buckets and exporter, or None if ALTCHA_METRICS is off."""
+    if not getattr(settings, 'ALTCHA_METRICS', False):
+        return None
+    buckets = getattr(settings, 'ALTCHA_METRICS_BUCKETS', None)
+    if buckets is not None and (not buckets or not all(
+            isinstance(bound, (int, float)) and bound > 0 for bound in buckets)):
+        raise ImproperlyConfigured('ALTCHA_METRICS_BUCKETS must be positive numbers of seconds.')
+    exporter = getattr(settings, 'ALTCHA_METRICS_EXPORTER', None)
+    return MappingProxyType({
+        'buckets': tuple(buckets) if buckets is not None else None,
+        'exporter': imported('ALTCHA_METRICS_EXPORTER', None) if exporter else None,
+        'export_interval': number('ALTCHA_METRICS_EXPORT_SECONDS', 60),
+    })
+
+
+def revocation_options(auth_expire_minutes):
+    """Return the Generations arguments, or None if ALTCHA_REVOCATION is off."""
+    if not getattr(settings, 'ALTCHA_REVOCATION', False):
+        return None
+    return MappingProxyType({
+        'ipv4_prefix': integer('ALTCHA_REVOCATION_IPV4_PREFIX', 24, maximum=32),
+        'ipv6_prefix': integer('ALTCHA_REVOCATION_IPV6_PREFIX', 64, maximum=128),
+        'check_interval': number('ALTCHA_REVOCATION_CHECK_SECONDS', 5),
+        # Verifications last at most this long, so older subnet revocations are moot.
+        'subnet_ttl': int(auth_expire_minutes * 60) + 1,
+        'cache_alias': cache_alias('ALTCHA_REVOCATION_CACHE'),
+    })
+
+
+def event_options():
+    """Return the event log's sink and queue settings, or None if ALTCHA_EVENTS is off."""
+    if not getattr(settings, 'ALTCHA_EVENTS', False):
+        return None
+    return MappingProxyType({
+        'sink_class': imported('ALTCHA_EVENT_SINK', 'dam.events.JSONLinesSink'),
+        'sink_options': MappingProxyType(dict(getattr(settings, 'ALTCHA_EVENT_SINK_OPTIONS', {}))),
+        'queue_size': integer('ALTCHA_EVENT_QUEUE_SIZE', 10000, minimum=1),
+        'batch_size': integer('ALTCHA_EVENT_BATCH_SIZE', 500, minimum=1),
+        'flush_seconds': number('ALTCHA_EVENT_FLUSH_SECONDS', 1.0),
+    })
+
+
+def crawler_options(trusted_proxies, proxy_count):
+    """Return the CrawlerVerifier arguments, or None if ALTCHA_VERIFIED_CRAWLERS is empty."""
+    crawlers = getattr(settings, 'ALTCHA_VERIFIED_CRAWLERS', {})
+    if not crawlers:
+        return None
+    if not trusted_proxies and proxy_count is None:
+        # Otherwise anyone could claim a crawler's IP address in X-Forwarded-For.
+        raise ImproperlyConfigured('ALTCHA_VERIFIED_CRAWLERS requires ALTCHA_TRUSTED_PROXIES '
+                                   'or ALTCHA_PROXY_COUNT, as the leftmost X-Forwarded-For '
+                                   'address can be spoofed.')
+    for pattern in crawlers:
+        try:
+            re.compile(pattern, re.I)
+        except re.error as err:
+            raise ImproperlyConfigured(f'Invalid ALTCHA_VERIFIED_CRAWLERS pattern: {err}')
+    return MappingProxyType({
+        'crawlers': MappingProxyType({pattern: tuple(domains)
+                                      for pattern, domains in crawlers.items()}),
+        'resolver_class': imported('ALTCHA_CRAWLER_RESOLVER', 'dam.crawlers.SocketResolver'),
+        'ttl': number('ALTCHA_CRAWLER_CACHE_TTL', 3600),
+        'cache_size': integer('ALTCHA_CRAWLER_CACHE_SIZE', 10000, minimum=1),
+        'max_pending': integer('ALTCHA_CRAWLER_MAX_PENDING', 1000, minimum=1),
+    })
+
+
+def watch_file(path, load, check_interval):
+    """Create a WatchedFile for path, or return None if no path is configured."""
+    return WatchedFile(path, load, check_interval) if path else None
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def get_config():
+    """Return the configuration, building it if settings changed since it was last built."""
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                _config = Config.from_settings()
+    return _config
+
+
+@receiver(setting_changed)
+def reset_config(**kwargs):
+    global _config
+    if kwargs['setting'].startswith('ALTCHA_') or kwargs['setting'] in DEPENDENT_SETTINGS:
+        config, _config = _config, None
+        if config is not None:
+            config.close()
@@ -0,0 +1,155 @@
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from dam.clientip import parse_address
+from dam.config import get_config
+
+
+class SocketResolver:
+    """Resolve hostnames using the system resolver."""
+
+    def reverse(self, ip):
+        """Return the hostname for an IP address, or None if there isn't one."""
+        try:
+            return socket.gethostbyaddr(ip)[0]
+        except OSError:
+            return None
+
+    def forward(self, hostname):
+        """Return the set of IP addresses a hostname resolves to."""
+        try:
+            return {info[4][0] for info in socket.getaddrinfo(hostname, None)}
+        except OSError:
+            return set()
+
+
+def verify_crawler(ip, domains, resolver):
+    """Check that ip's hostname is in one of domains and resolves back to ip.
+
+    This is the reverse then forward DNS check that search engines recommend
+    for verifying their crawlers.
+    """
+    address = parse_address(ip)
+    if address is None:
+        return False
+    hostname = resolver.reverse(ip)
+    if not hostname or not hostname.rstrip('.').endswith(domains):
+        return False
+    # Compare addresses rather than strings, which may be written differently (e.g. IPv6).
+    return any(parse_address(forward) == address for forward in resolver.forward(hostname))
+
+
+class CrawlerVerifier:
+    """Exempt requests from crawlers whose claimed identity checks out in DNS.
+
+    crawlers maps User-Agent patterns to the domains those crawlers' hosts are
+    in, e.g. {r'Googlebot': ('.googlebot.com', '.google.com')}. The first time
+    an IP address claims to be a crawler, its DNS lookups are started in a
+    background thread and the request is treated as unverified. The result,
+    positive or negative, is then remembered for ttl seconds, so each crawler
+    IP only needs one lookup per ttl.
+
+    Anyone can claim to be a crawler, so the work they can cause is bounded.
+    At most max_pending lookups wait to run; while that many are, further
+    claims are treated as unverified without a lookup (and retried on their
+    next request). Verified and unverified results are kept in separate LRU
+    caches of cache_size entries each, so a flood of fake crawlers can't
+    evict the real ones.
+    """
+
+    def __init__(self, crawlers, resolver, ttl=3600, cache_size=10000, workers=2,
+                 max_pending=1000):
+        self.crawlers = tuple((re.compile(pattern, re.I), tuple(domains))
+                              for pattern, domains in crawlers.items())
+        self.resolver = resolver
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.workers = workers
+        self.max_pending = max_pending
+        # Map (ip, domains) to the (monotonic) time their result expires.
+        self.verified = OrderedDict()
+        self.unverified = OrderedDict()
+        # Maps (ip, domains) to the future of their lookup.
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def claimed_domains(self, meta):
+        """Return the domains of the crawler the request claims to be, if any."""
+        user_agent = meta.get('HTTP_USER_AGENT')
+        if user_agent:
+            for pattern, domains in self.crawlers:
+                if pattern.search(user_agent):
+                    return domains
+        return None
+
+    def cached(self, results, key):
+        """Determine if key has an unexpired entry in results. Must be called holding the lock."""
+        expires = results.get(key)
+        if expires is None:
+            return False
+        if expires <= time.monotonic():
+            del results[key]
+            return False
+        results.move_to_end(key)
+        return True
+
+    def verify(self, meta, client_ip):
+        """Determine if the request comes from a verified crawler."""
+        domains = self.claimed_domains(meta)
+        if domains is None:
+            return False
+        key = (client_ip, domains)
+        with self.lock:
+            if self.cached(self.verified, key):
+                return True
+            if (self.cached(self.unverified, key) or key in self.pending
+                    or len(self.pending) >= self.max_pending):
+                return False
+            # Look the crawler up off the request path.
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                   thread_name_prefix='dam-crawlers')
+            self.pending[key] = self.executor.submit(self.lookup, client_ip, domains)
+        return False
+
+    def lookup(self, client_ip, domains):
+        """Verify a crawler and remember the result."""
+        try:
+            verified = verify_crawler(client_ip, domains, self.resolver)
+        except Exception:
+            verified = False
+        key = (client_ip, domains)
+        results, other = ((self.verified, self.unverified) if verified
+                          else (self.unverified, self.verified))
+        with self.lock:
+            other.pop(key, None)
+            results[key] = time.monotonic() + self.ttl
+            results.move_to_end(key)
+            while len(results) > self.cache_size:
+                results.popitem(last=False)
+            self.pending.pop(key, None)
+        return verified
+
+    def close(self):
+        """Stop the lookup threads, dropping any lookups still waiting to run."""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_crawler_verifier():
+    """Return this process's crawler verifier, or None if ALTCHA_VERIFIED_CRAWLERS is empty."""
+    config = get_config()
+    if config.crawlers is None:
+        return None
+    return config.component('crawler_verifier', lambda: make_crawler_verifier(**config.crawlers))
+
+
+def make_crawler_verifier(resolver_class, **options):
+    return CrawlerVerifier(resolver=resolver_class(), **options)
@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+
+from dam.breaker import CacheUnavailable, guarded_cache
+from dam.config import get_config
+from dam.ipindex import network_of
+from dam.steps import arun_steps, run_steps
+
+
+class DifficultyController:
+    """Scale challenge difficulty (max_number) with observed load.
+
+    Issued challenges and failed submissions are counted per time window in a
+    shared cache, so every worker sees the site-wide rates. Each rate is
+    divided by the rate considered normal for it, as is the server's load
+    average per CPU, and the largest of these ratios scales the floor
+    difficulty. The result is smoothed, so difficulty ramps up and down over a
+    few refreshes, and is clamped between the floor and the ceiling. Clients
+    in a subnet requesting more challenges than subnet_rate per window get a
+    further, proportional increase.
+
+    Global counts are batched locally and flushed to the cache at most every
+    refresh_interval seconds. Only the per-subnet count costs a cache call per
+    challenge. The cache is guarded by a deadline and circuit breaker; while it
+    is unavailable, the difficulty level holds and subnets get no increase.
+    """
+
+    def __init__(self, floor, ceiling, smoothing=0.3, window=60, issue_rate=600, fail_rate=60,
+                 subnet_rate=20, ipv4_prefix=24, ipv6_prefix=64, use_load=True,
+                 refresh_interval=5, cache_alias='default'):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.smoothing = smoothing
+        self.window = window
+        self.issue_rate = issue_rate
+        self.fail_rate = fail_rate
+        self.subnet_rate = subnet_rate
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.use_load = use_load and hasattr(os, 'getloadavg')
+        self.refresh_interval = refresh_interval
+        self.cache_alias = cache_alias
+        self.level = float(floor)
+        self.pending = {'issued': 0, 'failed': 0}
+        self.refreshed = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return guarded_cache(self.cache_alias)
+
+    def window_key(self, name):
+        return f'dam:difficulty:{name}:{int(time.time() // self.window)}'
+
+    def subnet_key(self, client_ip):
+        return self.window_key(network_of(client_ip, self.ipv4_prefix, self.ipv6_prefix))
+
+    def count_steps(self, key, amount):
+        """Add amount to a shared window counter, returning its new value.
+
+        Raises CacheUnavailable if the cache is.
+        """
+        cache = self.cache
+        try:
+            # The counter usually exists, so this is one round trip.
+            return (yield cache.defer('incr', key, amount))
+        except ValueError:
+            # This window's counter hasn't been started yet.
+            if (yield cache.defer('add', key, amount, timeout=self.window * 2)):
+                return amount
+            # Another process started it first.
+            return (yield cache.defer('incr', key, amount))
+
+    def take_pending(self):
+        """Return and reset the locally batched counts if a refresh is due, else None."""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.refreshed < self.refresh_interval:
+                return None
+            self.refreshed = now
+            pending = self.pending
+            self.pending = {'issued': 0, 'failed': 0}
+            return pending
+
+    def refresh(self):
+        run_steps(self.refresh_steps())
+
+    def refresh_steps(self):
+        pending = self.take_pending()
+        if pending is not None:
+            try:
+                counts = {}
+                for name, amount in pending.items():
+                    counts[name] = yield from self.count_steps(self.window_key(name), amount)
+                self.update(counts)
+            except CacheUnavailable:
+                # Keep the current level.
+                pass
+
+    def pressure(self, counts):
+        """Return how far above normal the busiest signal is (1.0 being normal)."""
+        ratios = [counts['issued'] / self.issue_rate, counts['failed'] / self.fail_rate]
+        if self.use_load:
+            ratios.append(os.getloadavg()[0] / (os.cpu_count() or 1))
+        return max(ratios)
+
+    def update(self, counts):
+        """Move the smoothed difficulty level toward the level the counts call for."""
+        target = min(self.ceiling, self.floor * max(1.0, self.pressure(counts)))
+        self.level += self.smoothing * (target - self.level)
+
+    def max_number(self, subnet_count):
+        """Return the difficulty for a client whose subnet has subnet_count challenges."""
+        level = self.level * max(1.0, subnet_count / self.subnet_rate)
+        return int(min(self.ceiling, max(self.floor, level)))
+
+    def record(self, name):
+        with self.lock:
+            self.pending[name] += 1
+
+    def issue(self, client_ip):
+        """Record a challenge issued to client_ip, returning the max_number to use."""
+        return run_steps(self.issue_steps(client_ip))
+
+    async def aissue(self, client_ip):
+        """Async version of issue()."""
+        return await arun_steps(self.issue_steps(client_ip))
+
+    def issue_steps(self, client_ip):
+        self.record('issued')
+        yield from self.refresh_steps()
+        try:
+            subnet_count = yield from self.count_steps(self.subnet_key(client_ip), 1)
+        except CacheUnavailable:
+            subnet_count = 0
+        return self.max_number(subnet_count)
+
+    def record_failure(self):
+        """Record a failed challenge submission."""
+        self.record('failed')
+
+
+def get_difficulty_controller():
+    """Return this process's difficulty controller, or None if adaptive difficulty is off."""
+    config = get_config()
+    if config.difficulty is None:
+        return None
+    return config.component('difficulty_controller',
+                            lambda: DifficultyController(**config.difficulty))
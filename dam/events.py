@@ -0,0 +1,164 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from dam.clientip import get_client_ip
+from dam.config import get_config
+from dam.metrics import get_metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class JSONLinesSink:
+    """Write events to a file as JSON Lines, rotating it when it grows too big.
+
+    When writing would take the file past max_bytes, it is renamed with a .1
+    suffix (and older files' suffixes are incremented, up to backup_count),
+    and a new file is started, as logging's RotatingFileHandler does. {pid} in
+    the path is replaced with the process ID, as processes mustn't share a
+    file they each rotate.
+    """
+
+    def __init__(self, path='dam-events.{pid}.jsonl', max_bytes=100 * 1024 * 1024,
+                 backup_count=5):
+        self.path = path.format(pid=os.getpid())
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.file = None
+
+    def write(self, events):
+        data = ''.join(json.dumps(event, separators=(',', ':')) + '\n'
+                       for event in events).encode()
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        size = self.file.tell()
+        if self.max_bytes and size and size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backup_count:
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'wb')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class EventLog:
+    """Pass events to a sink in batches, from a background thread.
+
+    Requests only put events on a bounded queue, so they never wait on the
+    sink. If the queue is full, because the sink can't keep up, events are
+    dropped and counted, in dropped and the dam_events_dropped_total metric.
+    The thread writes whatever is queued, up to batch_size events at a time,
+    waiting at most flush_seconds for the first.
+    """
+
+    def __init__(self, sink, queue_size=10000, batch_size=500, flush_seconds=1.0):
+        self.sink = sink
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def emit(self, event):
+        """Queue an event for the sink, or drop it if the queue is full."""
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+            metrics = get_metrics()
+            if metrics is not None:
+                metrics.count('dam_events_dropped_total', event['event'])
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='dam-events', daemon=True)
+                self.thread.start()
+                # Write out what's queued when the process exits.
+                atexit.register(self.close)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                batch = [self.queue.get(timeout=self.flush_seconds)]
+            except queue.Empty:
+                continue
+            self.write(self.drain(batch))
+
+    def drain(self, batch):
+        """Add queued events to batch, up to batch_size of them."""
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        try:
+            self.sink.write(batch)
+        except Exception:
+            # A failing sink mustn't stop later batches being written.
+            logger.exception('Could not write %d events.', len(batch))
+
+    def close(self):
+        """Stop the background thread, write out the queued events and close the sink."""
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        while not self.queue.empty():
+            self.write(self.drain([]))
+        if hasattr(self.sink, 'close'):
+            self.sink.close()
+
+
+def get_event_log():
+    """Return this process's event log, or None if ALTCHA_EVENTS is off."""
+    config = get_config()
+    if config.events is None:
+        return None
+    return config.component('event_log', lambda: make_event_log(**config.events))
+
+
+def make_event_log(sink_class, sink_options, **options):
+    return EventLog(sink_class(**sink_options), **options)
+
+
+def log_event(event, request, **fields):
+    """Log an event about the request's client, if events are on.
+
+    Every event has its time, type (event), and the client's IP address and
+    User-Agent, and the path requested, as well as any other fields given.
+    """
+    event_log = get_event_log()
+    if event_log is not None:
+        event_log.emit({
+            'time': time.time(),
+            'event': event,
+            'ip': get_client_ip(request),
+            'user_agent': request.headers.get('User-Agent', ''),
+            'path': request.path,
+            **fields,
+        })
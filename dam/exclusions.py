@@ -0,0 +1,72 @@
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def file_signature(path):
+    """Return what identifies a version of a file: its inode, size and mtime."""
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def read_lines(path):
+    """Read a file's lines, skipping blank lines and comments starting with '#'."""
+    with open(path, encoding='utf-8') as file:
+        return [line for line in (line.split('#', 1)[0].strip() for line in file) if line]
+
+
+class WatchedFile:
+    """The parsed contents of a file, reloaded when the file changes.
+
+    load is called with the file's path to parse it. At most every
+    check_interval seconds, a request starts a background thread that checks
+    whether the file's inode, size or mtime changed, and if so reloads it and
+    swaps the new value in with a single assignment. Requests never wait for
+    it, even under ASGI, where they'd otherwise hold up the event loop, but
+    carry on with the previous value until the new one is swapped in. If a
+    reload fails, e.g. because the file is invalid, the previous value is
+    kept. Replacing the file with a rename, rather than writing to it in
+    place, ensures it is never read half written.
+    """
+
+    def __init__(self, path, load, check_interval=5):
+        self.path = path
+        self.load = load
+        self.check_interval = check_interval
+        # Fail at startup if the file can't be loaded.
+        self.signature = file_signature(path)
+        self.value = load(path)
+        self.checked = time.monotonic()
+        # Held while a check runs, so only one runs at a time.
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def get(self):
+        """Return the file's parsed contents, starting a check first if one is due."""
+        if (time.monotonic() - self.checked >= self.check_interval
+                and self.lock.acquire(blocking=False)):
+            self.checked = time.monotonic()
+            try:
+                self.thread = threading.Thread(target=self.reload, name='dam-watched-file',
+                                               daemon=True)
+                self.thread.start()
+            except Exception:
+                self.lock.release()
+                raise
+        return self.value
+
+    def reload(self):
+        """Reload the file if it changed since it was last loaded, then release the lock."""
+        try:
+            signature = file_signature(self.path)
+            if signature != self.signature:
+                self.value = self.load(self.path)
+                self.signature = signature
+        except Exception:
+            logger.exception('Could not reload %s; keeping its previous contents.', self.path)
+        finally:
+            self.lock.release()
@@ -0,0 +1,219 @@
+import ipaddress
+import mmap
+import socket
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+
+
+class IPIndex:
+    """Index of IP networks for fast membership tests of client addresses.
+
+    Networks are merged into non-overlapping integer ranges, kept separately
+    for IPv4 and IPv6, so a lookup is a single binary search no matter how
+    many networks were supplied.
+    """
+
+    __slots__ = ('families',)
+
+    def __init__(self, networks=()):
+        ranges = {4: [], 6: []}
+        for network in networks:
+            ranges[network.version].append(
+                (int(network.network_address), int(network.broadcast_address)))
+        self.families = merge_families(ranges)
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Create an index from {4: [(start, end), ...], 6: [...]} integer ranges."""
+        return cls.from_families(merge_families(ranges))
+
+    @classmethod
+    def from_families(cls, families):
+        """Create an index from already merged {version: (starts, ends)} sequences."""
+        index = cls.__new__(cls)
+        index.families = families
+        return index
+
+    def __contains__(self, address):
+        """Check if an ipaddress.ip_address object falls in an indexed network."""
+        starts, ends = self.families[address.version]
+        address = int(address)
+        i = bisect_right(starts, address) - 1
+        return i >= 0 and address <= ends[i]
+
+    def __len__(self):
+        """Return the number of merged ranges in the index."""
+        return sum(len(starts) for starts, _ in self.families.values())
+
+    def __bool__(self):
+        return any(len(starts) for starts, _ in self.families.values())
+
+
+def merge_families(ranges):
+    """Merge each IP version's ranges into (starts, ends) sequences."""
+    families = {}
+    for version in (4, 6):
+        starts, ends = merge_ranges(ranges.get(version, ()))
+        if version == 4:
+            # IPv4 ranges fit in machine integers, so store them compactly.
+            starts, ends = array('L', starts), array('L', ends)
+        families[version] = (starts, ends)
+    return families
+
+
+def merge_ranges(ranges):
+    """Merge overlapping and adjacent (start, end) integer ranges.
+
+    Returns a pair of sorted lists holding the starts and ends of the merged
+    ranges.
+    """
+    starts = []
+    ends = []
+    for start, end in sorted(ranges):
+        if ends and start <= ends[-1] + 1:
+            # Range overlaps or abuts the previous one, so extend it.
+            if end > ends[-1]:
+                ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def network_of(client_ip, ipv4_prefix, ipv6_prefix):
+    """Return the network, as a string, of the given prefix length containing client_ip.
+
+    Invalid addresses are returned unchanged.
+    """
+    try:
+        address = ipaddress.ip_address(client_ip)
+    except ValueError:
+        return client_ip
+    prefix = ipv4_prefix if address.version == 4 else ipv6_prefix
+    return str(ipaddress.ip_network((address, prefix), strict=False))
+
+
+def parse_range(cidr):
+    """Parse an IP address or CIDR string into its IP version and integer range.
+
+    This is much faster than creating an ipaddress.ip_network, and just as
+    strict: addresses with host bits set, like '10.0.0.1/8', are invalid.
+    Raises ValueError for invalid networks.
+    """
+    address, slash, prefix = cidr.partition('/')
+    if ':' in address:
+        version, family, bits = 6, socket.AF_INET6, 128
+    else:
+        version, family, bits = 4, socket.AF_INET, 32
+    try:
+        start = int.from_bytes(socket.inet_pton(family, address), 'big')
+    except OSError:
+        raise ValueError(f'{cidr!r} is not a valid IP network') from None
+    if slash:
+        if not prefix.isdigit() or int(prefix) > bits:
+            raise ValueError(f'{cidr!r} has an invalid prefix length')
+        host_bits = bits - int(prefix)
+    else:
+        host_bits = 0
+    host_mask = (1 << host_bits) - 1
+    if start & host_mask:
+        raise ValueError(f'{cidr!r} has host bits set')
+    return version, start, start | host_mask
+
+
+def parse_ranges(lines):
+    """Parse lines of IP addresses or CIDRs into {4: [(start, end), ...], 6: [...]}.
+
+    Blank lines and comments starting with '#' are skipped. Raises ValueError,
+    naming the line, for invalid networks.
+    """
+    ranges = {4: [], 6: []}
+    for number, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if line:
+            try:
+                version, start, end = parse_range(line)
+            except ValueError as err:
+                raise ValueError(f'Line {number}: {err}') from None
+            ranges[version].append((start, end))
+    return ranges
+
+
+class PackedInts:
+    """Read-only sequence of big-endian unsigned integers packed in a buffer."""
+
+    __slots__ = ('buffer', 'size')
+
+    def __init__(self, buffer, size):
+        self.buffer = buffer
+        self.size = size
+
+    def __len__(self):
+        return len(self.buffer) // self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        start = i * self.size
+        if not 0 <= start < len(self.buffer):
+            raise IndexError('index out of range')
+        return int.from_bytes(self.buffer[start:start + self.size], 'big')
+
+
+# Compiled IP lists start with this, followed by the byte order of the IPv4
+# ranges, padding, and the number of IPv4 and IPv6 ranges.
+INDEX_MAGIC = b'DAMIPX\x00\x01'
+INDEX_HEADER = struct.Struct('<8sc7xQQ')
+
+
+def dump_index(index, file):
+    """Write an index in the compiled format load_index() maps into memory.
+
+    The header is followed by the merged IPv4 range starts and ends as native
+    32-bit integers, then the IPv6 range starts and ends as big-endian 128-bit
+    integers.
+    """
+    starts4, ends4 = index.families[4]
+    starts6, ends6 = index.families[6]
+    byteorder = b'<' if sys.byteorder == 'little' else b'>'
+    file.write(INDEX_HEADER.pack(INDEX_MAGIC, byteorder, len(starts4), len(starts6)))
+    for values in (starts4, ends4):
+        file.write(array('I', values).tobytes())
+    for values in (starts6, ends6):
+        file.write(b''.join(value.to_bytes(16, 'big') for value in values))
+
+
+def load_index(path):
+    """Load an IP list into an IPIndex.
+
+    Compiled lists (see dump_index()) are memory-mapped and searched in
+    place, so all processes share the same pages and loading is nearly
+    instant. Anything else is read as a text list of IP addresses and CIDRs,
+    one per line.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            file.seek(0)
+            return IPIndex.from_ranges(parse_ranges(file.read().decode().splitlines()))
+        buffer = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    _, byteorder, count4, count6 = INDEX_HEADER.unpack(buffer[:INDEX_HEADER.size])
+    offset = INDEX_HEADER.size
+    size4 = count4 * 4
+    size6 = count6 * 16
+    if len(buffer) != offset + 2 * size4 + 2 * size6:
+        raise ValueError(f'{path} is truncated or corrupt')
+    starts4 = buffer[offset:offset + size4]
+    ends4 = buffer[offset + size4:offset + 2 * size4]
+    if byteorder == (b'<' if sys.byteorder == 'little' else b'>'):
+        starts4, ends4 = starts4.cast('I'), ends4.cast('I')
+    else:
+        # Compiled on a machine of the other byte order, so it has to be copied.
+        starts4, ends4 = array('I', starts4), array('I', ends4)
+        starts4.byteswap()
+        ends4.byteswap()
+    offset += 2 * size4
+    starts6 = PackedInts(buffer[offset:offset + size6], 16)
+    ends6 = PackedInts(buffer[offset + size6:], 16)
+    return IPIndex.from_families({4: (starts4, ends4), 6: (starts6, ends6)})
@@ -0,0 +1,243 @@
+import base64
+import datetime
+import http.cookiejar
+import json
+import math
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+
+from altcha import create_challenge, solve_challenge
+from django.conf import settings
+from django.test import Client
+from django.urls import reverse
+
+
+# Matches the challenge fields in the challenge page's widget configuration.
+CHALLENGE_FIELD = re.compile(r'\b(algorithm|challenge|salt|signature|maxnumber): "([^"]*)"')
+
+
+def parse_challenge(content):
+    """Extract the challenge from a challenge page, returning None if there isn't one."""
+    fields = dict(CHALLENGE_FIELD.findall(content))
+    if len(fields) < 5:
+        return None
+    fields['maxnumber'] = int(fields['maxnumber'])
+    return fields
+
+
+def expired_challenge():
+    """Create a challenge, signed with ALTCHA_HMAC_KEY, that has already expired."""
+    challenge = create_challenge(
+        expires=datetime.datetime.now() - datetime.timedelta(minutes=1),
+        max_number=settings.ALTCHA_MAX_NUMBER,
+        hmac_key=settings.ALTCHA_HMAC_KEY,
+    )
+    return {
+        'algorithm': challenge.algorithm,
+        'challenge': challenge.challenge,
+        'salt': challenge.salt,
+        'signature': challenge.signature,
+        'maxnumber': challenge.max_number,
+    }
+
+
+def solve(challenge):
+    """Solve a challenge, returning the base64 encoded payload to submit, or None.
+
+    This runs in the solver processes, so it must stay importable at module level.
+    """
+    solution = solve_challenge(challenge['challenge'], challenge['salt'],
+                               challenge['algorithm'], challenge['maxnumber'])
+    if solution is None:
+        return None
+    return base64.b64encode(json.dumps({
+        'algorithm': challenge['algorithm'],
+        'challenge': challenge['challenge'],
+        'number': solution.number,
+        'salt': challenge['salt'],
+        'signature': challenge['signature'],
+    }).encode()).decode()
+
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(0, rank - 1)]
+
+
+class TestClientTransport:
+    """Send requests to this project in process, through the Django test client."""
+
+    def __init__(self, host):
+        self.client = Client(HTTP_HOST=host)
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.content.decode()
+
+    def post(self, path, data):
+        response = self.client.post(path, data)
+        return response.status_code, response.content.decode()
+
+
+class HTTPTransport:
+    """Send requests to a running server, keeping cookies like a browser would."""
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+
+    def request(self, request):
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as err:
+            return err.code, err.read().decode()
+
+    def get(self, path):
+        return self.request(urllib.request.Request(self.base_url + path))
+
+    def post(self, path, data):
+        headers = {}
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                headers['X-CSRFToken'] = cookie.value
+        return self.request(urllib.request.Request(
+            self.base_url + path, data=urllib.parse.urlencode(data).encode(), headers=headers))
+
+
+class Timings:
+    """Latencies and response statuses of one kind of request.
+
+    Only the thread running the load test records them, so they need no lock.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.elapsed = 0.0
+
+    def record(self, latency, status):
+        self.latencies.append(latency)
+        self.statuses[status] += 1
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            'requests': count,
+            'throughput': count / self.elapsed if self.elapsed else 0.0,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else 0.0,
+            'statuses': dict(sorted(self.statuses.items())),
+        }
+
+
+class LoadTest:
+    """Issue challenges, solve them in a process pool, and submit the solutions.
+
+    Each challenge is requested and submitted by a new client, with its own
+    cookies, so no submission is waved through as already verified. A share
+    of the submissions are attacks: replays of solutions that were already
+    accepted, and solutions to challenges that expired. Attacks should be
+    rejected and everything else accepted; anything else is counted as
+    unexpected.
+
+    Requests are made from the executor's threads, which only return their
+    results; the thread calling run() records them all.
+    """
+
+    def __init__(self, make_transport, executor, pool, replay_ratio=0.0, expired_ratio=0.0):
+        self.make_transport = make_transport
+        self.executor = executor
+        self.pool = pool
+        self.replay_ratio = replay_ratio
+        self.expired_ratio = expired_ratio
+        self.issue = Timings()
+        self.submit = Timings()
+        self.solve_seconds = 0.0
+        self.solved = 0
+        self.outcomes = Counter()
+
+    def get_challenge(self):
+        """Request a challenge, returning (latency, status, transport, challenge or None)."""
+        transport = self.make_transport()
+        started = time.perf_counter()
+        status, content = transport.get(reverse('dam:challenge'))
+        latency = time.perf_counter() - started
+        return latency, status, transport, parse_challenge(content) if status == 200 else None
+
+    def submit_solution(self, transport, payload):
+        """Submit a solution, returning (latency, status)."""
+        started = time.perf_counter()
+        status, _ = transport.post(reverse('dam:submit_challenge'), {'altcha': payload})
+        return time.perf_counter() - started, status
+
+    def submit_all(self, submissions):
+        """Submit (transport, payload, kind) tuples, returning which were accepted."""
+        results = self.executor.map(lambda args: self.submit_solution(*args[:2]), submissions)
+        accepted = []
+        for (_, _, kind), (latency, status) in zip(submissions, results):
+            self.submit.record(latency, status)
+            ok = status == 200
+            if kind == 'valid':
+                self.outcomes['accepted' if ok else 'unexpectedly rejected'] += 1
+            else:
+                self.outcomes[f'{kind} {"unexpectedly accepted" if ok else "rejected"}'] += 1
+            accepted.append(ok)
+        return accepted
+
+    def run(self, count):
+        # Issue the challenges.
+        started = time.perf_counter()
+        results = list(self.executor.map(lambda _: self.get_challenge(), range(count)))
+        self.issue.elapsed = time.perf_counter() - started
+        issued = []
+        for latency, status, transport, challenge in results:
+            self.issue.record(latency, status)
+            if challenge:
+                issued.append((transport, challenge))
+        expired_count = round(len(issued) * self.expired_ratio)
+        challenges = [challenge for _, challenge in issued]
+        challenges += [expired_challenge() for _ in range(expired_count)]
+
+        # Solve them, as clients would.
+        started = time.perf_counter()
+        payloads = self.pool.map(solve, challenges)
+        self.solve_seconds = time.perf_counter() - started
+        self.solved = sum(payload is not None for payload in payloads)
+
+        # Submit the solutions, followed by the attacks.
+        submissions = [(transport, payload, 'valid')
+                       for (transport, _), payload in zip(issued, payloads) if payload]
+        submissions += [(self.make_transport(), payload, 'expired')
+                        for payload in payloads[len(issued):] if payload]
+        started = time.perf_counter()
+        results = self.submit_all(submissions)
+        accepted = [payload for (_, payload, kind), ok in zip(submissions, results)
+                    if ok and kind == 'valid']
+        replays = [(self.make_transport(), payload, 'replayed')
+                   for payload in accepted[:round(len(accepted) * self.replay_ratio)]]
+        self.submit_all(replays)
+        self.submit.elapsed = time.perf_counter() - started
+
+    def report(self):
+        return {
+            'issue': self.issue.summary(),
+            'solve': {
+                'challenges': self.solved,
+                'throughput': self.solved / self.solve_seconds if self.solve_seconds else 0.0,
+            },
+            'submit': self.submit.summary(),
+            'outcomes': dict(sorted(self.outcomes.items())),
+        }
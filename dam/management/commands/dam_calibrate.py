@@ -0,0 +1,100 @@
+import argparse
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dam.calibration import (
+    CLIENT_PROFILES, ClientProfile, hash_rate, multi_core_hash_rate, recommend_max_number,
+    solve_seconds,
+)
+
+
+def client_profile(value):
+    try:
+        return ClientProfile.parse(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+def format_seconds(seconds):
+    return f'{seconds * 1000:.0f}ms' if seconds < 1 else f'{seconds:.1f}s'
+
+
+class Command(BaseCommand):
+    help = ('Measure how fast this host solves challenges, model how long clients take to '
+            'solve them, and recommend an ALTCHA_MAX_NUMBER for a target solve time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-seconds', type=float, default=1.0,
+                            help='Longest acceptable solve time for clients (default: 1).')
+        parser.add_argument('--percentile', type=float, default=95,
+                            help='Share of clients that must solve within the target time, '
+                                 'as a percentile (default: 95).')
+        parser.add_argument('--profile', type=client_profile, action='append', dest='profiles',
+                            help="Client profile to model, as 'name:rate[:workers]', where rate "
+                                 'is hashes a second per worker. May be repeated. Replaces the '
+                                 'built-in desktop, mobile and low-end mobile profiles.')
+        parser.add_argument('--recommend-for',
+                            help='Name of the profile to recommend a max number for (default: '
+                                 'the slowest).')
+        parser.add_argument('--max-number', type=int, default=None,
+                            help='Max number to model (default: ALTCHA_MAX_NUMBER).')
+        parser.add_argument('--seconds', type=float, default=1.0,
+                            help='How long to measure each hash rate for (default: 1).')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Number of processes for the multi-core measurement '
+                                 '(default: one per CPU).')
+
+    def handle(self, *args, **options):
+        profiles = options['profiles'] or CLIENT_PROFILES
+        if not 0 < options['percentile'] < 100:
+            raise CommandError('--percentile must be between 0 and 100.')
+        if options['target_seconds'] <= 0 or options['seconds'] <= 0:
+            raise CommandError('--target-seconds and --seconds must be positive.')
+        if options['processes'] < 1:
+            raise CommandError('--processes must be positive.')
+        if options['recommend_for']:
+            matches = [profile for profile in profiles if profile.name == options['recommend_for']]
+            if not matches:
+                raise CommandError(f"No client profile named {options['recommend_for']!r}.")
+            target = matches[0]
+        else:
+            target = min(profiles, key=lambda profile: profile.total_rate)
+        max_number = options['max_number'] or settings.ALTCHA_MAX_NUMBER
+        percentile = options['percentile']
+        label = f'p{percentile:g}'
+
+        single_rate = hash_rate(options['seconds'])
+        multi_rate = multi_core_hash_rate(options['processes'], options['seconds'])
+        self.stdout.write(f'This host: {single_rate:,.0f} hashes/s on one core, '
+                          f'{multi_rate:,.0f} hashes/s on {options["processes"]} processes.')
+
+        self.stdout.write(f'\nSolve times at max number {max_number:,}:')
+        self.stdout.write(
+            f'  {"this host, one core":<24} expected '
+            f'{format_seconds(solve_seconds(max_number, single_rate))}, {label} '
+            f'{format_seconds(solve_seconds(max_number, single_rate, percentile))}'
+        )
+        for profile in profiles:
+            self.stdout.write(
+                f'  {profile.name:<24} expected '
+                f'{format_seconds(solve_seconds(max_number, profile.total_rate))}, {label} '
+                f'{format_seconds(solve_seconds(max_number, profile.total_rate, percentile))}'
+                f' ({profile.rate:,.0f} hashes/s x {profile.workers} '
+                f'{"worker" if profile.workers == 1 else "workers"})'
+            )
+        self.stdout.write(f'  This host solves {multi_rate / (max_number / 2):,.1f} '
+                          'challenges/s on average.')
+
+        recommended = recommend_max_number(options['target_seconds'], target.total_rate,
+                                           percentile)
+        self.stdout.write(
+            f'\nRecommended: ALTCHA_MAX_NUMBER = {recommended}, which {label} of '
+            f'{target.name} clients solve within {format_seconds(options["target_seconds"])}.'
+        )
+        self.stdout.write(
+            f'  Each challenge then costs this host '
+            f'{format_seconds(solve_seconds(recommended, single_rate))} of CPU time on average, '
+            f'and it solves {multi_rate / (recommended / 2):,.1f} challenges/s.'
+        )
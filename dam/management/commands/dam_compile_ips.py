@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dam.ipindex import IPIndex, dump_index, parse_ranges
+
+
+class Command(BaseCommand):
+    help = ('Compile text lists of IP addresses and CIDRs into a file for '
+            'ALTCHA_EXCLUDE_IPS_FILE that loads instantly and is shared between processes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+', help='Text files with one IP or CIDR per line.')
+        parser.add_argument('--output', '-o', required=True, help='File to write.')
+
+    def handle(self, *args, **options):
+        ranges = {4: [], 6: []}
+        for source in options['sources']:
+            try:
+                with open(source, encoding='utf-8') as file:
+                    source_ranges = parse_ranges(file)
+            except (OSError, ValueError) as err:
+                raise CommandError(f'{source}: {err}')
+            for version, family_ranges in source_ranges.items():
+                ranges[version].extend(family_ranges)
+        index = IPIndex.from_ranges(ranges)
+        output = options['output']
+        # Write to a temporary file and rename it over the output, so processes
+        # watching the output never read it half written.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                dump_index(index, file)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, output)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        count = sum(len(family_ranges) for family_ranges in ranges.values())
+        self.stdout.write(f'Compiled {count} networks into {len(index)} ranges in {output}.')
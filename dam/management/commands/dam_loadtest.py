@@ -0,0 +1,87 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dam.loadtest import HTTPTransport, LoadTest, TestClientTransport
+
+
+def default_host():
+    """Return a host name this project accepts, for in-process requests."""
+    for host in settings.ALLOWED_HOSTS:
+        if host != '*':
+            return host.lstrip('.')
+    return 'localhost'
+
+
+class Command(BaseCommand):
+    help = ('Measure how many challenges this project can issue and verify, by requesting '
+            'challenges, solving them in a process pool and submitting the solutions.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--challenges', type=int, default=100,
+                            help='Number of challenges to request (default: 100).')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Number of requests to make at once (default: 1). In process, '
+                                 'SQLite with database sessions only supports 1.')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Number of solver processes (default: one per CPU).')
+        parser.add_argument('--replay-ratio', type=float, default=0.0,
+                            help='Share of accepted solutions to submit again, as replays.')
+        parser.add_argument('--expired-ratio', type=float, default=0.0,
+                            help='Number of solutions to expired challenges to submit, as a '
+                                 'share of the challenges issued.')
+        parser.add_argument('--url',
+                            help='Base URL of a running server to test, e.g. '
+                                 'http://localhost:8000. By default, requests are made in '
+                                 'process through the Django test client.')
+        parser.add_argument('--host', default=None,
+                            help='Host header for in-process requests (default: the first '
+                                 'ALLOWED_HOSTS entry).')
+
+    def handle(self, *args, **options):
+        if options['challenges'] < 1 or options['concurrency'] < 1 or options['processes'] < 1:
+            raise CommandError('--challenges, --concurrency and --processes must be positive.')
+        if options['url']:
+            def make_transport():
+                return HTTPTransport(options['url'])
+        else:
+            host = options['host'] or default_host()
+
+            def make_transport():
+                return TestClientTransport(host)
+        # Rejected attacks are expected, so don't log each of them.
+        request_logger = logging.getLogger('django.request')
+        level = request_logger.level
+        request_logger.setLevel(logging.ERROR)
+        try:
+            with ThreadPoolExecutor(options['concurrency']) as executor, \
+                    multiprocessing.Pool(options['processes']) as pool:
+                load_test = LoadTest(make_transport, executor, pool,
+                                     replay_ratio=options['replay_ratio'],
+                                     expired_ratio=options['expired_ratio'])
+                load_test.run(options['challenges'])
+        finally:
+            request_logger.setLevel(level)
+        report = load_test.report()
+        for name in ('issue', 'submit'):
+            summary = report[name]
+            self.stdout.write(
+                f'{name.capitalize()}: {summary["requests"]} requests, '
+                f'{summary["throughput"]:.1f}/s, latency p50 {summary["p50"] * 1000:.1f}ms, '
+                f'p90 {summary["p90"] * 1000:.1f}ms, p99 {summary["p99"] * 1000:.1f}ms, '
+                f'max {summary["max"] * 1000:.1f}ms'
+            )
+            statuses = ', '.join(f'{status}: {count}'
+                                 for status, count in summary['statuses'].items())
+            self.stdout.write(f'  Statuses: {statuses}')
+            if name == 'issue':
+                solve = report['solve']
+                self.stdout.write(f'Solve: {solve["challenges"]} challenges, '
+                                  f'{solve["throughput"]:.1f}/s')
+        for outcome, count in report['outcomes'].items():
+            style = self.style.ERROR if 'unexpectedly' in outcome else self.style.SUCCESS
+            self.stdout.write(style(f'{outcome.capitalize()}: {count}'))
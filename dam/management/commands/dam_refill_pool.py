@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dam.challenges import get_challenge_pool
+
+
+class Command(BaseCommand):
+    help = 'Fill the pool of pre-generated Altcha challenges.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep refilling the pool every ALTCHA_POOL_REFILL_SECONDS.',
+        )
+
+    def handle(self, *args, **options):
+        pool = get_challenge_pool()
+        if pool is None:
+            raise CommandError('The challenge pool is disabled; set ALTCHA_POOL_SIZE to use it.')
+        while True:
+            filled = pool.refill()
+            self.stdout.write(f'Added {filled} challenges to the pool.')
+            if not options['loop']:
+                break
+            time.sleep(pool.refill_interval)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dam.revocation import get_generations
+
+
+class Command(BaseCommand):
+    help = ('Revoke verifications, so clients must solve a challenge again, by bumping the '
+            'global generation or those of the subnets containing the given IP addresses.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('addresses', nargs='*',
+                            help='IP addresses whose subnets to revoke verifications in.')
+        parser.add_argument('--all', action='store_true', help='Revoke every verification.')
+
+    def handle(self, *args, **options):
+        generations = get_generations()
+        if generations is None:
+            raise CommandError('Revocation is not enabled. Set ALTCHA_REVOCATION = True.')
+        if not options['all'] and not options['addresses']:
+            raise CommandError('Give IP addresses whose subnets to revoke, or --all.')
+        if options['all']:
+            generations.revoke_all()
+            self.stdout.write('Revoked every verification.')
+        for address in options['addresses']:
+            subnet = generations.revoke_subnet(address)
+            self.stdout.write(f'Revoked verifications in {subnet}.')
@@ -0,0 +1,114 @@
+import fnmatch
+import ipaddress
+import json
+import re
+from functools import lru_cache
+
+from dam.exclusions import read_lines
+
+
+class PathMatcher:
+    """Match request paths against exact paths and glob patterns.
+
+    Exact paths are checked with a set lookup, and any paths containing glob
+    wildcards (e.g. '/static/*') are combined into a single regular expression.
+    """
+
+    def __init__(self, paths):
+        exact = set()
+        patterns = []
+        for path in paths:
+            if any(char in path for char in '*?['):
+                patterns.append(fnmatch.translate(path))
+            else:
+                exact.add(path)
+        self.exact = frozenset(exact)
+        self.pattern = re.compile('|'.join(patterns)) if patterns else None
+
+    def match(self, path):
+        if path in self.exact:
+            return True
+        return self.pattern is not None and self.pattern.match(path) is not None
+
+
+class HeaderMatcher:
+    """Match request headers against excluded header patterns.
+
+    Header values are read directly from request.META, and each header's
+    verdicts are memoized per value in a bounded LRU cache, as clients that
+    send excluded headers (e.g. crawlers' User-Agents) tend to send the same
+    few values over and over.
+    """
+
+    def __init__(self, header_patterns, cache_size=1024):
+        self.headers = tuple((meta_key(header), pattern)
+                             for header, pattern in header_patterns.items())
+        self.check = lru_cache(maxsize=cache_size)(self._check)
+
+    @staticmethod
+    def _check(pattern, value):
+        return bool(value.strip() and pattern.search(value))
+
+    def match(self, meta):
+        for key, pattern in self.headers:
+            value = meta.get(key)
+            if value and self.check(pattern, value):
+                # Client sent header that allows bypassing verification.
+                return True
+        return False
+
+    def stats(self):
+        info = self.check.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'hit_rate': info.hits / lookups if lookups else 0.0,
+            'size': info.currsize,
+        }
+
+
+def meta_key(header):
+    """Return the request.META key holding an HTTP header's value."""
+    key = header.upper().replace('-', '_')
+    if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        return key
+    return f'HTTP_{key}'
+
+
+def make_ip_list(ip_addresses):
+    """Convert supplied [CIDR] IP addresses to ip address objects.
+
+    Takes an iterable of individual or CIDR IP addresses, and converts
+    them to a list of ipaddress.ip_network objects. Raises ValueError if any
+    of them is invalid.
+    """
+    return list({ipaddress.ip_network(address) for address in ip_addresses})
+
+
+def make_excluded_headers(header_exclusions):
+    """Convert headers' string values into case-insensitive regular expression patterns.
+
+    Values given for the same header with different capitalization are
+    combined into a single pattern.
+    """
+    combined = {}
+    for header, value in header_exclusions.items():
+        for existing in combined:
+            if existing.lower() == header.lower():
+                combined[existing] = f'(?:{combined[existing]})|(?:{value})'
+                break
+        else:
+            combined[header] = value
+    return {k: re.compile(v, re.I) for k, v in combined.items()}
+
+
+def load_path_matcher(path):
+    """Load a file of paths and glob patterns to exclude, one per line."""
+    return PathMatcher(read_lines(path))
+
+
+def load_header_matcher(path, cache_size=1024):
+    """Load a JSON file of headers to exclude, in the format of ALTCHA_EXCLUDE_HEADERS."""
+    with open(path, encoding='utf-8') as file:
+        return HeaderMatcher(make_excluded_headers(json.load(file)), cache_size)
@@ -0,0 +1,212 @@
+import logging
+import threading
+from bisect import bisect_left
+
+from dam.config import get_config
+
+
+logger = logging.getLogger(__name__)
+
+# Counters, mapped to their label name and help text.
+COUNTERS = {
+    'dam_requests_total': ('verdict', 'Requests checked by the middleware, by verdict.'),
+    'dam_challenges_total': ('outcome', 'Challenges issued and submitted, by outcome.'),
+    'dam_cache_breaker_transitions_total': ('state',
+                                            'Cache circuit breaker changes, by new state.'),
+    'dam_pool_total': ('outcome', 'Challenges taken from (hit) or missing from (miss) the pool, '
+                                  'and added to it (refilled).'),
+    'dam_events_dropped_total': ('event', 'Events dropped as the event queue was full, by type.'),
+}
+# Histograms, mapped to their help text.
+HISTOGRAMS = {
+    'dam_process_request_seconds': 'Time taken by the middleware to check a request.',
+    'dam_create_challenge_seconds': 'Time taken to create a challenge.',
+    'dam_verify_solution_seconds': 'Time taken to verify a submitted solution.',
+}
+# Upper bounds, in seconds, of the histograms' buckets.
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Shard:
+    """One thread's counters and histograms."""
+
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        # Maps (name, label value) to a count.
+        self.counters = {}
+        # Maps names to lists of bucket counts, followed by the sum of the observations.
+        self.histograms = {}
+
+
+class Metrics:
+    """Per-process counters and latency histograms.
+
+    Each thread records into its own shard, which only that thread ever
+    writes to, so recording takes no locks and no counts are lost to races
+    between threads. Snapshots add up the shards of every thread that has
+    recorded anything.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.local = threading.local()
+        self.shards = []
+        self.exporter = None
+        self.export_interval = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.start_lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            # Appending to a list is atomic, so this needs no lock either.
+            self.shards.append(shard)
+            return shard
+
+    def count(self, name, label, amount=1):
+        """Add amount to the counter for name and label."""
+        counters = self.shard().counters
+        key = (name, label)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, seconds):
+        """Record a duration in the histogram for name."""
+        histograms = self.shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            # One count per bucket, one for +Inf, then the sum.
+            histogram = histograms[name] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def snapshot(self):
+        """Return the totals of all threads' counters and histograms.
+
+        Counters are returned as {name: {label: count}}, and histograms as
+        {name: {'buckets': [(upper bound, cumulative count), ...], 'sum': seconds,
+        'count': observations}}, with the last bucket's bound being infinity.
+        """
+        counters = {}
+        histograms = {}
+        for shard in list(self.shards):
+            # Copying a dict is atomic, so the owning thread can keep recording.
+            for (name, label), count in shard.counters.copy().items():
+                labels = counters.setdefault(name, {})
+                labels[label] = labels.get(label, 0) + count
+            for name, histogram in shard.histograms.copy().items():
+                histogram = list(histogram)
+                totals = histograms.get(name)
+                if totals is None:
+                    histograms[name] = histogram
+                else:
+                    histograms[name] = [a + b for a, b in zip(totals, histogram)]
+        bounds = self.buckets + (float('inf'),)
+        for name, histogram in histograms.items():
+            cumulative = []
+            total = 0
+            for bound, count in zip(bounds, histogram):
+                total += count
+                cumulative.append((bound, total))
+            histograms[name] = {'buckets': cumulative, 'sum': histogram[-1], 'count': total}
+        return {'counters': counters, 'histograms': histograms}
+
+    def start(self, exporter, interval):
+        """Pass a snapshot to exporter every interval seconds, from a background thread."""
+        if self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.exporter = exporter
+                    self.export_interval = interval
+                    self.thread = threading.Thread(target=self.run, name='dam-metrics',
+                                                   daemon=True)
+                    self.thread.start()
+
+    def stop(self):
+        """Stop exporting."""
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.export_interval):
+            try:
+                self.exporter(self.snapshot())
+            except Exception:
+                # A failing exporter shouldn't stop later exports.
+                logger.exception('Could not export metrics.')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prometheus_text(snapshot):
+    """Format a metrics snapshot in the Prometheus text exposition format."""
+    lines = []
+    for name, (label_name, help_text) in COUNTERS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for label, count in sorted(snapshot['counters'].get(name, {}).items()):
+            lines.append(f'{name}{{{label_name}="{label}"}} {count}')
+    for name, help_text in HISTOGRAMS.items():
+        histogram = snapshot['histograms'].get(name)
+        if histogram is None:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for bound, count in histogram['buckets']:
+            lines.append(f'{name}_bucket{{le="{format_value(bound)}"}} {count}')
+        lines.append(f'{name}_sum {format_value(histogram["sum"])}')
+        lines.append(f'{name}_count {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_metrics():
+    """Return this process's metrics, or None if ALTCHA_METRICS is off.
+
+    If ALTCHA_METRICS_EXPORTER names a callable, it is passed a snapshot of
+    the metrics every ALTCHA_METRICS_EXPORT_SECONDS.
+    """
+    config = get_config()
+    if config.metrics is None:
+        return None
+    return config.component('metrics', lambda: make_metrics(**config.metrics))
+
+
+def make_metrics(buckets, exporter, export_interval):
+    metrics = Metrics(buckets or DEFAULT_BUCKETS)
+    if exporter is not None:
+        metrics.start(exporter, export_interval)
+    return metrics
+
+
+def count_challenge(outcome):
+    """Count a challenge outcome, if metrics are on.
+
+    outcome is 'issued', 'solved', 'failed' or 'replayed'.
+    """
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.count('dam_challenges_total', outcome)
+
+
+def count_breaker_transition(state):
+    """Count a cache circuit breaker changing state, if metrics are on."""
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.count('dam_cache_breaker_transitions_total', state)
+
+
+def count_pool(outcome, amount=1):
+    """Count challenges taken from or added to the challenge pool, if metrics are on.
+
+    outcome is 'hit', 'miss' or 'refilled'.
+    """
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.count('dam_pool_total', outcome, amount)
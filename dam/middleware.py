@@ -1,13 +1,42 @@
-import ipaddress
-import re
 import time
+from functools import partial
 from urllib.parse import quote_plus
 
-from django.conf import settings
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse
+from django.middleware.csrf import get_token
 from django.shortcuts import redirect
-from django.urls import reverse
+from django.utils.cache import add_never_cache_headers
 from django.utils.deprecation import MiddlewareMixin
 
+from dam.challenges import challenge_data, issue_steps
+from dam.clientip import get_client_address, get_client_ip, parse_address
+from dam.config import get_config
+from dam.crawlers import get_crawler_verifier
+from dam.events import log_event
+from dam.metrics import get_metrics
+from dam.ratelimit import get_rate_limiter
+from dam.rendering import render_challenge_page
+from dam.revocation import get_generations
+from dam.steps import Deferred, arun_steps, run_steps
+from dam.tokens import client_binding, ip_binding, load_token
+
+
+# Verdicts returned by AltchaMiddleware.classify().
+EXCLUDED_PATH = 'excluded_path'
+EXCLUDED_IP = 'excluded_ip'
+EXCLUDED_HEADER = 'excluded_header'
+VERIFIED_CRAWLER = 'verified_crawler'
+VERIFIED = 'verified'
+IP_CHANGED = 'ip_changed'
+REVOKED = 'revoked'
+CHALLENGE = 'challenge'
+# Verdicts that let the request through without a challenge.
+ALLOWED_VERDICTS = frozenset({EXCLUDED_PATH, EXCLUDED_IP, EXCLUDED_HEADER, VERIFIED_CRAWLER,
+                              VERIFIED})
+# Session key of a verification's revocation generation stamp.
+GENERATION_SESSION_KEY = 'altcha_generation'
+
 
 class AltchaMiddleware(MiddlewareMixin):
     """Prompt user to complete Altcha proof-of-work if needed."""
@@ -15,105 +44,239 @@ class AltchaMiddleware(MiddlewareMixin):
     def __init__(self, get_response):
         super().__init__(get_response)
         self.get_response = get_response
-        self.altcha_session_key = getattr(settings,
-                                          'ALTCHA_SESSION_KEY',
-                                          'altcha_verified')
-        self.excluded_paths = getattr(settings,
-                                      'ALTCHA_EXCLUDE_PATHS',
-                                      set())
-        ip_exclusions = getattr(settings,
-                                'ALTCHA_EXCLUDE_IPS',
-                                [])
-        self.excluded_ips = make_ip_list(ip_exclusions)
-        self.excluded_ips.sort()
-        header_exclusions = getattr(settings,
-                                    'ALTCHA_EXCLUDE_HEADERS',
-                                    {})
-        self.excluded_headers = make_excluded_headers(header_exclusions)
 
     def exclude_ip(self, request):
-        """Determine if client IP can skip Altcha verification.
-
-        X-Forwarded-For header may include chain of IPs, if so, use first
-        address.
-        """
-        if not self.excluded_ips:
+        """Determine if client IP can skip Altcha verification."""
+        # The exclusions are compiled once per configuration, in get_config().
+        config = get_config()
+        file_index = config.ip_file.get() if config.ip_file is not None else None
+        if not config.ip_index and not file_index:
             # There are no excluded IP addresses.
             return False
-        client_ip = get_client_ip(request)
-        try:
-            client_ip = ipaddress.ip_address(client_ip)
-        except ValueError:
-            # Client IP address not valid.
+        client_address = get_client_address(request)
+        if client_address is None:
+            # Invalid client IP addresses are never excluded.
             return False
-        for network in self.excluded_ips:
-            if client_ip < network[0]:
-                # Networks are sorted, so if client_ip is less than the
-                # current networks first address, client_ip is not in the list.
-                break
-            if client_ip in network:
-                return True
-        return False
+        return client_address in config.ip_index or (file_index is not None
+                                                     and client_address in file_index)
 
     def exclude_headers(self, request):
         """Determine if request headers warrant skipping verification."""
-        for header, pattern in self.excluded_headers.items():
-            value = request.headers.get(header, '')
-            if value.strip() and pattern.search(value):
-                # Client sent header that allows bypassing verification.
-                return True
-        return False
+        config = get_config()
+        return config.header_matcher.match(request.META) or (
+            config.header_file is not None and config.header_file.get().match(request.META))
 
-    def process_request(self, request):
-        dam_paths = {reverse('dam:challenge'), reverse('dam:submit_challenge')}
-        if time.time() <= request.session.get(self.altcha_session_key, 0):
-            # User already passed Altcha verification, and their approval hasn't expired yet.
-            client_ip = get_client_ip(request)
-            if request.session.get('ip') == client_ip:
-                # Client is still using the same IP address, so good.
-                return None
-            else:
-                # Session user has changed IP address, expire their Altcha verification.
-                request.session[self.altcha_session_key] = 0
-                request.session['ip'] = client_ip
-        if request.path in dam_paths | set(self.excluded_paths):
+    def exclude_path(self, path):
+        """Determine if a path is exempt from verification."""
+        config = get_config()
+        return (path in config.dam_paths or config.path_matcher.match(path)
+                or (config.path_file is not None and config.path_file.get().match(path)))
+
+    def classify(self, request):
+        """Decide whether the request must be challenged.
+
+        Checks are ordered cheapest first: paths, IPs and headers are matched
+        in memory, and the client's verification (which may need a session
+        backend read) is only checked if none of them exempt the request.
+        """
+        return run_steps(self.classify_steps(request))
+
+    async def aclassify(self, request):
+        """Async version of classify() that doesn't block on the session."""
+        return await arun_steps(self.classify_steps(request))
+
+    def classify_steps(self, request):
+        verdict = self.check_exclusions(request)
+        if verdict is None:
+            verdict = yield from self.check_verification_steps(request)
+        return verdict
+
+    def check_exclusions(self, request):
+        """Check if the request is exempt from verification, returning its verdict if so."""
+        if self.exclude_path(request.path):
             # Path is exempt from Altcha verification.
-            return None
-        elif self.exclude_ip(request):
+            return EXCLUDED_PATH
+        return self.check_client_exclusions(request)
+
+    def check_client_exclusions(self, request):
+        """Check if the client is exempt from verification, whatever path it requests."""
+        if self.exclude_ip(request):
             # IP address is exempt from Altcha verification.
-            return None
-        elif self.exclude_headers(request):
+            return EXCLUDED_IP
+        if self.exclude_headers(request):
             # Request includes HTTP header with value exempt from verification.
+            return EXCLUDED_HEADER
+        crawler_verifier = get_crawler_verifier()
+        if (crawler_verifier is not None
+                and crawler_verifier.verify(request.META, get_client_ip(request))):
+            # Request comes from a crawler whose identity was verified by DNS.
+            return VERIFIED_CRAWLER
+        return None
+
+    def check_token(self, request):
+        """Check the client's signed cookie, returning its verdict and generation stamp."""
+        token = request.COOKIES.get(get_config().cookie_name)
+        verification = load_token(token) if token else None
+        if verification is None or time.time() > verification[0]:
+            return CHALLENGE, None
+        if verification[1] == client_binding(request):
+            return VERIFIED, verification[2]
+        return IP_CHANGED, None
+
+    def check_verification(self, request):
+        """Check if the client holds an unexpired, unrevoked verification for its IP."""
+        return run_steps(self.check_verification_steps(request))
+
+    async def acheck_verification(self, request):
+        """Async version of check_verification() that doesn't block on the session."""
+        return await arun_steps(self.check_verification_steps(request))
+
+    def check_verification_steps(self, request):
+        config = get_config()
+        generations = get_generations()
+        if config.use_signed_cookie:
+            # Verification is kept in a signed cookie, so no session is needed.
+            verdict, stamp = self.check_token(request)
+            if verdict == VERIFIED and generations is not None:
+                if not (yield from generations.is_current_steps(stamp, get_client_ip(request))):
+                    return REVOKED
+            return verdict
+        session = request.session
+        if time.time() <= (yield session_get(session, config.session_key, 0)):
+            # User already passed Altcha verification, and their approval hasn't expired yet.
+            client_ip = get_client_ip(request)
+            session_ip = yield session_get(session, 'ip')
+            if same_binding(session_ip, client_ip, request):
+                # Client is still using the same IP address (or network), so good,
+                # unless its verification has since been revoked.
+                if generations is None:
+                    return VERIFIED
+                stamp = yield session_get(session, GENERATION_SESSION_KEY)
+                if (yield from generations.is_current_steps(stamp, client_ip)):
+                    return VERIFIED
+                yield session_set(session, config.session_key, 0)
+                return REVOKED
+            # Session user has changed IP address, expire their Altcha verification.
+            yield session_set(session, config.session_key, 0)
+            yield session_set(session, 'ip', client_ip)
+            return IP_CHANGED
+        return CHALLENGE
+
+    def process_request(self, request):
+        return run_steps(self.process_steps(request))
+
+    async def __acall__(self, request):
+        """Handle requests natively under ASGI, without a thread per request."""
+        response = await arun_steps(self.process_steps(request))
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+    def process_steps(self, request):
+        started = time.perf_counter()
+        verdict = yield from self.classify_steps(request)
+        if verdict in ALLOWED_VERDICTS:
+            record_verdict(verdict, started)
             return None
+        response = yield from self.challenge_response_steps(request)
+        record_verdict(verdict, started)
+        log_challenged(request, verdict, response)
+        return response
+
+    def challenge_response_steps(self, request):
+        config = get_config()
+        if config.json_challenges and wants_json(request):
+            # Give API clients the challenge itself, rather than a page to find it on.
+            challenge = yield from issue_steps(request)
+            return json_challenge_response(request, challenge)
+        if config.inline_challenges:
+            challenge = yield from issue_steps(request)
+            return self.inline_challenge_response(request, challenge)
         referrer = request.headers.get('Referer')
         # Redirect to Altcha verification page
-        dam_url = f'{reverse("dam:challenge")}?next={quote_plus(request.get_full_path())}'
+        dam_url = f'{config.challenge_url}?next={quote_plus(request.get_full_path())}'
         if referrer:
             dam_url += f'&prev={quote_plus(referrer)}'
         return redirect(dam_url)
 
+    def inline_challenge_response(self, request, challenge):
+        """Serve the challenge page at the requested URL, which it reloads once solved."""
+        if challenge is None:
+            response = HttpResponse('Too many requests.', status=429, content_type='text/plain')
+            response['Retry-After'] = get_rate_limiter('challenge').window
+        else:
+            response = render_challenge_page(request, challenge, request.get_full_path(),
+                                             status=get_config().inline_status)
+        # The page is only for this client, and only until it is verified.
+        add_never_cache_headers(response)
+        return response
+
+
+def wants_json(request):
+    """Determine if the request comes from a script or API client rather than a page load."""
+    return ('application/json' in request.headers.get('Accept', '')
+            or 'X-Requested-With' in request.headers)
+
 
-def make_ip_list(ip_addresses):
-    """Convert supplied [CIDR] IP addresses to ip address objects.
+def json_challenge_response(request, challenge):
+    """Respond with a challenge as JSON, or a 429 if the client is rate limited."""
+    if challenge is None:
+        response = JsonResponse({'error': 'Too many requests.'}, status=429)
+        response['Retry-After'] = get_rate_limiter('challenge').window
+        return response
+    # Make sure the client has a CSRF token to submit its solution with.
+    get_token(request)
+    response = JsonResponse(challenge_data(challenge), status=401)
+    response['WWW-Authenticate'] = 'Altcha'
+    return response
 
-    Takes an iterable of individual or CIDR IP addresses, and converts
-    them to a list of ipaddress.ip_network objects.
+
+def record_verdict(verdict, started):
+    """Count a request's verdict and time its check, which began at started."""
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.observe('dam_process_request_seconds', time.perf_counter() - started)
+        metrics.count('dam_requests_total', verdict)
+
+
+def log_challenged(request, verdict, response):
+    """Log that the request was challenged, and how (by the response's status)."""
+    log_event('challenged', request, verdict=verdict, status=response.status_code,
+              next=request.get_full_path(), prev=request.headers.get('Referer'))
+
+
+def same_binding(session_ip, client_ip, request):
+    """Determine if a session verified from session_ip is still valid for the request's client.
+
+    client_ip is the request's client IP.
     """
-    networks = set()
-    for address in ip_addresses:
-        try:
-            networks.add(ipaddress.ip_network(address))
-        except ValueError as err:
-            # Skip invalid ip address
-            print('Could not exclude supplied ip address', err)
-    return list(networks)
+    if session_ip == client_ip:
+        return True
+    address = parse_address(session_ip) if session_ip is not None else None
+    return address is not None and ip_binding(address) == client_binding(request)
+
+
+def session_get(session, key, default=None):
+    """Return a read of a session value, to be yielded by a generator of steps."""
+    return Deferred(session.get, partial(session_aget, session), key, default)
+
+
+def session_set(session, key, value):
+    """Return a write of a session value, to be yielded by a generator of steps."""
+    return Deferred(session.__setitem__, partial(session_aset, session), key, value)
 
 
-def make_excluded_headers(header_exclusions):
-    """Convert headers' string values into case-insensitive regular expression patterns."""
-    return {k: re.compile(v, re.I) for k, v in header_exclusions.items()}
+async def session_aget(session, key, default=None):
+    """Read a session value without blocking the event loop."""
+    if hasattr(session, 'aget'):
+        return await session.aget(key, default)
+    # Sessions only have an async API from Django 5.0.
+    return await sync_to_async(session.get)(key, default)
 
 
-def get_client_ip(request):
-    return request.META.get('HTTP_X_FORWARDED_FOR',
-                            request.META.get('REMOTE_ADDR')).split(',')[0]
+async def session_aset(session, key, value):
+    """Write a session value without blocking the event loop."""
+    if hasattr(session, 'aset'):
+        await session.aset(key, value)
+    else:
+        await sync_to_async(session.__setitem__)(key, value)
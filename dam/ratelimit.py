@@ -0,0 +1,181 @@
+import heapq
+import threading
+import time
+
+from dam.breaker import CacheUnavailable, guarded_cache
+from dam.config import get_config
+from dam.ipindex import network_of
+from dam.steps import arun_steps, run_steps
+
+
+class RateLimiter:
+    """Sliding window rate limiter for clients, aggregated by network.
+
+    Requests are counted per client network in fixed windows, and a client's
+    rate is estimated as its count in the current window plus its count in the
+    previous window, weighted by how much of that window still overlaps the
+    sliding window. Counting happens in process memory, so checking a request
+    never waits on the cache. Every sync_interval seconds, the counts made
+    since the last sync are added to shared counters in the cache, and the
+    totals from all processes are read back.
+
+    A sync reads and writes the counters of up to sync_batch networks (the
+    busiest first; the rest wait for the next sync) in one get_many() and
+    one set_many() call, so a flood from many networks doesn't add a cache
+    call per network to the request that syncs. Counts added by other
+    processes between the two calls are lost, so the shared totals may come
+    up slightly short. The cache is guarded by a deadline and circuit
+    breaker; while it is unavailable, the counts stay unsynced, and each
+    process limits clients by its own counts alone.
+
+    Each process counts at most max_networks networks per window. Beyond
+    that, the networks with the smallest counts are forgotten, a tenth of
+    max_networks more than needed at a time, so a flood from many networks
+    can't grow the counts without bound, nor make every request scan them.
+    """
+
+    def __init__(self, scope, rate, window, ipv4_prefix=32, ipv6_prefix=64, sync_interval=1,
+                 sync_batch=1000, max_networks=100000, cache_alias='default'):
+        self.scope = scope
+        self.rate = rate
+        self.window = window
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.sync_interval = sync_interval
+        self.sync_batch = sync_batch
+        self.max_networks = max_networks
+        self.cache_alias = cache_alias
+        self.window_id = None
+        # Known counts per network for the current and previous windows.
+        self.counts = {}
+        self.previous = {}
+        # Counts per network not yet added to the shared counters.
+        self.unsynced = {}
+        self.synced = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return guarded_cache(self.cache_alias)
+
+    def cache_key(self, network, window_id):
+        return f'dam:ratelimit:{self.scope}:{network}:{window_id}'
+
+    def roll(self, window_id):
+        """Start a new window, if window_id is not the current one."""
+        if window_id != self.window_id:
+            if self.window_id is not None and window_id == self.window_id + 1:
+                self.previous = self.counts
+            else:
+                self.previous = {}
+            self.counts = {}
+            # Counts not synced before the window ended are dropped.
+            self.unsynced = {}
+            self.window_id = window_id
+
+    def count(self, client_ip):
+        """Count a request from client_ip, returning whether it is within the limit."""
+        now = time.time()
+        network = network_of(client_ip, self.ipv4_prefix, self.ipv6_prefix)
+        with self.lock:
+            window_id, elapsed = divmod(int(now), self.window)
+            self.roll(window_id)
+            count = self.counts.get(network, 0) + 1
+            self.counts[network] = count
+            self.unsynced[network] = self.unsynced.get(network, 0) + 1
+            if len(self.counts) > self.max_networks:
+                self.evict()
+            overlap = 1 - elapsed / self.window
+            return count + self.previous.get(network, 0) * overlap <= self.rate
+
+    def evict(self):
+        """Forget the networks with the smallest counts, so max_networks are left at most."""
+        excess = len(self.counts) - self.max_networks + self.max_networks // 10
+        for network in heapq.nsmallest(excess, self.counts, key=self.counts.get):
+            del self.counts[network]
+            self.unsynced.pop(network, None)
+
+    def take_unsynced(self):
+        """Return the unsynced counts and their window if a sync is due, else None."""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.synced < self.sync_interval or not self.unsynced:
+                return None
+            self.synced = now
+            if len(self.unsynced) <= self.sync_batch:
+                unsynced = self.unsynced
+                self.unsynced = {}
+            else:
+                busiest = heapq.nlargest(self.sync_batch, self.unsynced, key=self.unsynced.get)
+                unsynced = {network: self.unsynced.pop(network) for network in busiest}
+            return self.window_id, unsynced
+
+    def restore(self, window_id, unsynced):
+        """Put back counts that couldn't be synced, to try again at the next sync."""
+        with self.lock:
+            if window_id == self.window_id:
+                for network, count in unsynced.items():
+                    self.unsynced[network] = self.unsynced.get(network, 0) + count
+
+    def update(self, window_id, totals):
+        """Record shared totals read back from the cache."""
+        with self.lock:
+            if window_id == self.window_id:
+                for network, total in totals.items():
+                    # Add anything counted locally while the sync was running.
+                    total += self.unsynced.get(network, 0)
+                    self.counts[network] = max(self.counts.get(network, 0), total)
+                if len(self.counts) > self.max_networks:
+                    self.evict()
+
+    def flush(self):
+        """Add unsynced counts to the shared counters, if a sync is due."""
+        run_steps(self.flush_steps())
+
+    async def aflush(self):
+        """Async version of flush()."""
+        await arun_steps(self.flush_steps())
+
+    def flush_steps(self):
+        taken = self.take_unsynced()
+        if taken is not None:
+            window_id, unsynced = taken
+            keys = {network: self.cache_key(network, window_id) for network in unsynced}
+            cache = self.cache
+            try:
+                shared = yield cache.defer('get_many', list(keys.values()))
+                totals = {network: shared.get(key, 0) + unsynced[network]
+                          for network, key in keys.items()}
+                yield cache.defer('set_many',
+                                  {keys[network]: total for network, total in totals.items()},
+                                  timeout=self.window * 2)
+            except CacheUnavailable:
+                self.restore(window_id, unsynced)
+            else:
+                self.update(window_id, totals)
+
+    def allow(self, client_ip):
+        """Count a request from client_ip and return whether it may proceed."""
+        return run_steps(self.allow_steps(client_ip))
+
+    async def aallow(self, client_ip):
+        """Async version of allow()."""
+        return await arun_steps(self.allow_steps(client_ip))
+
+    def allow_steps(self, client_ip):
+        allowed = self.count(client_ip)
+        yield from self.flush_steps()
+        return allowed
+
+
+def get_rate_limiter(scope):
+    """Return this process's rate limiter for a scope ('challenge' or 'submit').
+
+    Returns None if no limit is set for the scope in ALTCHA_RATE_LIMIT_CHALLENGE
+    or ALTCHA_RATE_LIMIT_SUBMIT.
+    """
+    config = get_config()
+    options = config.rate_limits.get(scope)
+    if options is None:
+        return None
+    return config.component(f'rate_limiter:{scope}', lambda: RateLimiter(scope, **options))
@@ -0,0 +1,90 @@
+import re
+from types import SimpleNamespace
+
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.shortcuts import render
+from django.template.loader import get_template
+from django.utils.html import escape, escapejs
+
+from dam.config import get_config
+
+
+CHALLENGE_TEMPLATE = 'dam_challenge.html'
+SLOT_PATTERN = re.compile(r'@@dam_slot_(\w+)@@')
+
+
+def slot(name):
+    return f'@@dam_slot_{name}@@'
+
+
+class ChallengePage:
+    """Challenge page rendered once, with only the per-request values filled in later.
+
+    The template is rendered with placeholders in place of the request's host,
+    CSRF token, challenge and next URL, then split into byte segments around
+    them. Filling in a page is then a join of those segments with the escaped
+    values, rather than a full template render.
+    """
+
+    def __init__(self, template_name=CHALLENGE_TEMPLATE):
+        context = dict(get_config().page_context)
+        context.update({
+            'request': SimpleNamespace(get_host=lambda: slot('host')),
+            'csrf_token': slot('csrf_token'),
+            'challenge': SimpleNamespace(algorithm=slot('algorithm'),
+                                         challenge=slot('challenge'),
+                                         salt=slot('salt'),
+                                         signature=slot('signature'),
+                                         max_number=slot('max_number')),
+            'next_url': slot('next_url'),
+        })
+        parts = SLOT_PATTERN.split(get_template(template_name).render(context))
+        # Parts alternate between static text and slot names.
+        self.segments = [part.encode() for part in parts[::2]]
+        self.slots = parts[1::2]
+
+    def render(self, request, challenge, next_url):
+        """Return the page's content for the request as bytes."""
+        values = {
+            'host': escape(request.get_host()),
+            'csrf_token': escape(get_token(request)),
+            'algorithm': escape(challenge.algorithm),
+            'challenge': escape(challenge.challenge),
+            'salt': escape(challenge.salt),
+            'signature': escape(challenge.signature),
+            'max_number': escape(challenge.max_number),
+            'next_url': escapejs(next_url),
+        }
+        segments = self.segments
+        content = [segments[0]]
+        for i, name in enumerate(self.slots, 1):
+            content.append(values[name].encode())
+            content.append(segments[i])
+        return b''.join(content)
+
+
+def get_challenge_page():
+    """Return the pre-rendered challenge page, rendering it on first use.
+
+    It is rendered again whenever the configuration changes.
+    """
+    return get_config().component('challenge_page', ChallengePage)
+
+
+def render_challenge_page(request, challenge, next_url, status=200):
+    """Return a response with the challenge page, which goes to next_url once solved."""
+    config = get_config()
+    if config.prerender:
+        # Fill in the pre-rendered page rather than rendering the template.
+        response = HttpResponse(get_challenge_page().render(request, challenge, next_url),
+                                status=status)
+    else:
+        context = dict(config.page_context)
+        context['challenge'] = challenge
+        context['next_url'] = next_url
+        response = render(request, CHALLENGE_TEMPLATE, context, status=status)
+    if config.page_context['preload_js']:
+        # Lets the browser (or a CDN sending early hints) start fetching the widget early.
+        response['Link'] = f'<{config.page_context["js_src_url"]}>; rel=modulepreload'
+    return response
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+
+from dam.breaker import CacheUnavailable, guarded_cache
+from dam.challenges import challenge_lifetime
+from dam.config import get_config
+from dam.steps import arun_steps, run_steps
+
+
+class ReplayStore:
+    """Record used challenges so each solution is only accepted once.
+
+    Challenges are recorded with an atomic cache.add(), so of any number of
+    concurrent submissions of the same solution, only one succeeds. In front of
+    the cache sits a bounded, in-process LRU of recently seen challenges, so
+    repeated replays of a challenge are rejected without a cache round trip.
+    Entries in both tiers expire once their challenge can no longer be valid.
+
+    The cache is called with a deadline, behind a circuit breaker. If it is
+    slow or failing, the local tier stands in for it, which still rejects
+    replays to the same process, though not to other processes, until the
+    cache recovers. The breaker's changes of state are logged, rather than each
+    submission checked locally.
+    """
+
+    def __init__(self, cache_alias='default', local_size=10000, timeout=None):
+        self.cache_alias = cache_alias
+        self.local_size = local_size
+        self.timeout = timeout if timeout is not None else challenge_lifetime()
+        # Maps challenges to the (monotonic) time they expire from the local tier.
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return guarded_cache(self.cache_alias)
+
+    def seen_locally(self, challenge):
+        """Check the local tier for an unexpired record of the challenge."""
+        with self.lock:
+            expires = self.seen.get(challenge)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.seen[challenge]
+                return False
+            self.seen.move_to_end(challenge)
+            return True
+
+    def remember(self, challenge):
+        """Record the challenge in the local tier, returning False if it was already there.
+
+        Checking and recording happen under one lock, so of concurrent calls
+        for the same challenge, only one returns True.
+        """
+        with self.lock:
+            now = time.monotonic()
+            expires = self.seen.get(challenge)
+            if expires is not None and expires >= now:
+                self.seen.move_to_end(challenge)
+                return False
+            self.seen[challenge] = now + self.timeout
+            self.seen.move_to_end(challenge)
+            while len(self.seen) > self.local_size:
+                # Drop the least recently seen challenge.
+                self.seen.popitem(last=False)
+            return True
+
+    def add(self, challenge):
+        """Record the challenge, returning False if it was already used."""
+        return run_steps(self.add_steps(challenge))
+
+    async def aadd(self, challenge):
+        """Async version of add()."""
+        return await arun_steps(self.add_steps(challenge))
+
+    def add_steps(self, challenge):
+        if self.seen_locally(challenge):
+            return False
+        try:
+            added = yield self.cache.defer('add', challenge, 't', timeout=self.timeout)
+        except CacheUnavailable:
+            # Only the local tier can tell.
+            return self.remember(challenge)
+        self.remember(challenge)
+        return added
+
+    def clear(self):
+        """Forget the locally seen challenges."""
+        with self.lock:
+            self.seen.clear()
+
+
+def get_replay_store():
+    """Return this process's replay store, as configured by ALTCHA_REPLAY_STORE."""
+    config = get_config()
+    return config.component('replay_store',
+                            lambda: config.replay_store_class(**config.replay))
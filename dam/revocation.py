@@ -0,0 +1,248 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from dam.breaker import CacheUnavailable, guarded_cache
+from dam.config import get_config
+from dam.ipindex import network_of
+from dam.steps import arun_steps, run_steps
+
+
+GLOBAL_KEY = 'dam:generation'
+# Set, to the latest subnet generation, whenever a subnet is revoked.
+SUBNETS_KEY = 'dam:generation:subnets'
+
+
+def subnet_key(subnet):
+    return f'dam:generation:subnet:{subnet}'
+
+
+def next_generation(previous):
+    """Return a generation greater than previous and than any generation handed out before.
+
+    Generations are times in nanoseconds, rather than counters, so even if
+    the cache loses a generation, the next one can't repeat an earlier one.
+    """
+    return max(time.time_ns(), (previous or 0) + 1)
+
+
+class Generations:
+    """Revoke verifications in bulk by bumping generation numbers.
+
+    Each verification is stamped with the current global generation and the
+    generation of its client's subnet, as a 'global.subnet' string. It is only
+    valid while the global generation still matches and its subnet hasn't
+    been revoked since, so bumping the global generation revokes every
+    verification, and bumping a subnet's revokes that subnet's, without
+    touching any sessions or cookies.
+
+    The global generation is kept in a shared cache, along with the time of
+    the latest subnet revocation. Each process checks them against a local
+    copy, which it reloads from the cache (in one call) at most every
+    check_interval seconds, so revocations take up to that long to reach every
+    process. Each revoked subnet's generation has a key of its own, so
+    concurrent revocations don't overwrite each other. It expires after
+    subnet_ttl seconds (the longest a verification lasts), when nothing
+    stamped before the revocation can still be valid. Subnets' generations are
+    only looked up while some subnet revocation is unexpired, and each
+    process remembers them until it sees the latest subnet revocation change,
+    so each subnet is looked up once per revocation rather than on a timer.
+
+    Generations are times, so they only ever increase. If the cache loses the
+    global generation, a new one is started, revoking every verification.
+    Subnet generations that are lost early (e.g. evicted from a full cache)
+    restore their subnets' revoked verifications, so the cache should have
+    room for them.
+
+    Checks call the cache with a deadline, behind a circuit breaker. While it
+    is unavailable, the local copy is kept, and subnet generations count as
+    0. If the generations have never been loaded, verifications are taken to
+    be current, and new ones go unstamped.
+    """
+
+    def __init__(self, ipv4_prefix=24, ipv6_prefix=64, check_interval=5, subnet_ttl=480 * 60,
+                 cache_alias='default', subnet_cache_size=10000):
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.check_interval = check_interval
+        self.subnet_ttl = subnet_ttl
+        self.cache_alias = cache_alias
+        self.subnet_cache_size = subnet_cache_size
+        # (global generation, latest subnet revocation), or None until first loaded.
+        self.current = None
+        self.checked = 0.0
+        self.refreshing = False
+        # Maps subnets to their generations, as of the latest subnet revocation.
+        self.subnets = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return guarded_cache(self.cache_alias)
+
+    def subnet(self, client_ip):
+        return network_of(client_ip, self.ipv4_prefix, self.ipv6_prefix)
+
+    def due(self):
+        return self.current is None or time.monotonic() - self.checked >= self.check_interval
+
+    def claim(self):
+        """Claim a due reload, returning False if it isn't due or another caller is making it.
+
+        Until the generations are first loaded, every caller loads them,
+        rather than carrying on without them. Nothing waits on a lock across
+        a cache call, so this is safe from both threads and coroutines.
+        """
+        with self.lock:
+            if not self.due() or (self.refreshing and self.current is not None):
+                return False
+            self.refreshing = True
+            return True
+
+    def store(self, values):
+        latest_subnet = values.get(SUBNETS_KEY)
+        with self.lock:
+            if self.current is None or self.current[1] != latest_subnet:
+                # A subnet has been revoked since, so look subnets up afresh.
+                self.subnets.clear()
+            self.current = (values[GLOBAL_KEY], latest_subnet)
+            self.checked = time.monotonic()
+
+    def keep(self):
+        """Carry on with the local copy until the next check, as the cache is unavailable."""
+        with self.lock:
+            self.checked = time.monotonic()
+
+    def refresh(self):
+        """Reload the generations from the cache if they are due a check."""
+        run_steps(self.refresh_steps())
+
+    def refresh_steps(self):
+        if self.claim():
+            try:
+                values = yield self.cache.defer('get_many', [GLOBAL_KEY, SUBNETS_KEY])
+                if GLOBAL_KEY not in values:
+                    values[GLOBAL_KEY] = yield from self.start_global_steps()
+                self.store(values)
+            except CacheUnavailable:
+                self.keep()
+            finally:
+                self.refreshing = False
+
+    def start_global_steps(self):
+        """Start a new global generation, as there is none (or the cache lost it)."""
+        generation = time.time_ns()
+        if not (yield self.cache.defer('add', GLOBAL_KEY, generation, timeout=None)):
+            # Another process started one first.
+            generation = yield self.cache.defer('get', GLOBAL_KEY, generation)
+        return generation
+
+    def cached_subnet(self, subnet):
+        """Return the subnet's remembered generation, or None if it needs looking up."""
+        with self.lock:
+            generation = self.subnets.get(subnet)
+            if generation is not None:
+                self.subnets.move_to_end(subnet)
+            return generation
+
+    def remember_subnet(self, subnet, generation):
+        with self.lock:
+            self.subnets[subnet] = generation
+            self.subnets.move_to_end(subnet)
+            while len(self.subnets) > self.subnet_cache_size:
+                self.subnets.popitem(last=False)
+
+    def subnet_generation_steps(self, client_ip):
+        """Return the generation of client_ip's subnet, 0 if it hasn't been revoked."""
+        if self.current[1] is None:
+            # No subnet revocation is unexpired, so there's nothing to look up.
+            return 0
+        subnet = self.subnet(client_ip)
+        generation = self.cached_subnet(subnet)
+        if generation is None:
+            try:
+                generation = yield self.cache.defer('get', subnet_key(subnet), 0)
+            except CacheUnavailable:
+                return 0
+            self.remember_subnet(subnet, generation)
+        return generation
+
+    def check_stamp(self, stamp, subnet_generation):
+        try:
+            stamped_global, stamped_subnet = map(int, (stamp or '0.0').split('.'))
+        except ValueError:
+            return False
+        # Subnet generations expire, so a stamp from after a subnet's revocation can be newer
+        # than its (expired) current generation.
+        return stamped_global == self.current[0] and stamped_subnet >= subnet_generation
+
+    def stamp(self, client_ip):
+        """Return the generation stamp for a new verification of client_ip.
+
+        Returns None if the generations couldn't be loaded.
+        """
+        return run_steps(self.stamp_steps(client_ip))
+
+    async def astamp(self, client_ip):
+        """Async version of stamp()."""
+        return await arun_steps(self.stamp_steps(client_ip))
+
+    def stamp_steps(self, client_ip):
+        yield from self.refresh_steps()
+        if self.current is None:
+            return None
+        subnet_generation = yield from self.subnet_generation_steps(client_ip)
+        return f'{self.current[0]}.{subnet_generation}'
+
+    def is_current(self, stamp, client_ip):
+        """Determine if a verification stamped with stamp hasn't been revoked.
+
+        Verifications from before revocation was enabled have no stamp, and
+        count as generation '0.0', which is never current.
+        """
+        return run_steps(self.is_current_steps(stamp, client_ip))
+
+    async def ais_current(self, stamp, client_ip):
+        """Async version of is_current()."""
+        return await arun_steps(self.is_current_steps(stamp, client_ip))
+
+    def is_current_steps(self, stamp, client_ip):
+        yield from self.refresh_steps()
+        if self.current is None:
+            # The cache is unavailable, so don't hold every client up.
+            return True
+        if not self.check_stamp(stamp, 0):
+            return False
+        subnet_generation = yield from self.subnet_generation_steps(client_ip)
+        return self.check_stamp(stamp, subnet_generation)
+
+    def expire(self):
+        """Make the next check reload the generations."""
+        self.checked = float('-inf')
+
+    def revoke_all(self):
+        """Revoke every verification."""
+        # Revoking calls the cache directly, so that failures are reported.
+        cache = caches[self.cache_alias]
+        cache.set(GLOBAL_KEY, next_generation(cache.get(GLOBAL_KEY)), timeout=None)
+        self.expire()
+
+    def revoke_subnet(self, client_ip):
+        """Revoke the verifications of every client in client_ip's subnet."""
+        subnet = self.subnet(client_ip)
+        cache = caches[self.cache_alias]
+        generation = next_generation(cache.get(subnet_key(subnet)))
+        cache.set(subnet_key(subnet), generation, timeout=self.subnet_ttl)
+        cache.set(SUBNETS_KEY, generation, timeout=self.subnet_ttl)
+        self.expire()
+        return subnet
+
+
+def get_generations():
+    """Return this process's generations, or None if ALTCHA_REVOCATION is off."""
+    config = get_config()
+    if config.revocation is None:
+        return None
+    return config.component('generations', lambda: Generations(**config.revocation))
@@ -0,0 +1,14 @@
+from django.dispatch import Signal
+
+
+# Sent when a challenge is served to a client. Arguments: request, challenge.
+challenge_issued = Signal()
+
+# Sent when a submitted solution is accepted. Arguments: request, payload.
+challenge_solved = Signal()
+
+# Sent when a submitted solution is invalid or expired. Arguments: request, payload, error.
+challenge_failed = Signal()
+
+# Sent when a valid solution is submitted again. Arguments: request, payload.
+challenge_replayed = Signal()
@@ -0,0 +1,50 @@
+class Deferred:
+    """A call that may be made either synchronously or asynchronously.
+
+    call is the sync function and acall the async one, and both take args and
+    kwargs. Operations that need I/O (e.g. a cache or session call) are
+    written once, as generators of steps that yield Deferred calls and are
+    sent back their results, so the same logic serves both the sync and the
+    async version of the operation, run by run_steps() or arun_steps().
+    """
+
+    __slots__ = ('call', 'acall', 'args', 'kwargs')
+
+    def __init__(self, call, acall, *args, **kwargs):
+        self.call = call
+        self.acall = acall
+        self.args = args
+        self.kwargs = kwargs
+
+
+def run_steps(steps):
+    """Run a generator of steps, making the calls it yields synchronously.
+
+    Each call's result is sent back into the generator, and any exception it
+    raises is thrown into it, where it can be handled like that of a direct
+    call. Returns the generator's return value.
+    """
+    result = error = None
+    while True:
+        try:
+            deferred = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = deferred.call(*deferred.args, **deferred.kwargs), None
+        except Exception as err:
+            result, error = None, err
+
+
+async def arun_steps(steps):
+    """Async version of run_steps(), which awaits the calls' async versions."""
+    result = error = None
+    while True:
+        try:
+            deferred = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await deferred.acall(*deferred.args, **deferred.kwargs), None
+        except Exception as err:
+            result, error = None, err
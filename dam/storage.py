@@ -0,0 +1,75 @@
+import gzip
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, StaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Extensions of text files worth compressing.
+COMPRESS_EXTENSIONS = ('.css', '.js', '.json', '.map', '.svg', '.txt', '.html', '.xml')
+
+
+def compressors():
+    """Return (suffix, compress function) pairs for the available encodings."""
+    # mtime=0 keeps the output the same for the same input, across deploys.
+    encodings = [('gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        encodings.append(('br', lambda data: brotli.compress(data, quality=11)))
+    return encodings
+
+
+class CompressedFilesMixin:
+    """Write gzip and brotli variants of collected static files alongside them.
+
+    After collectstatic copies (and, with the manifest storage, hashes) the
+    files, each text file of at least compress_min_size bytes gets a .gz
+    variant, and a .br one if the brotli package is installed, which
+    compression is only kept if it makes the file smaller. Web servers (e.g.
+    nginx's gzip_static and brotli_static) can then send the variants as they
+    are, rather than compressing the files on every request.
+    """
+
+    compress_extensions = COMPRESS_EXTENSIONS
+    compress_min_size = 256
+
+    def post_process(self, paths, dry_run=False, **options):
+        parent = getattr(super(), 'post_process', None)
+        if parent is not None:
+            yield from parent(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        # The manifest storage keeps both the original and hashed copies of each file.
+        names = set(paths) | set(getattr(self, 'hashed_files', {}).values())
+        for name in sorted(names):
+            if name.endswith(self.compress_extensions):
+                for compressed_name in self.compress(name):
+                    yield name, compressed_name, True
+
+    def compress(self, name):
+        """Write the compressed variants of a file, returning their names."""
+        with self.open(name) as original:
+            data = original.read()
+        if len(data) < self.compress_min_size:
+            return []
+        names = []
+        for suffix, compress in compressors():
+            compressed = compress(data)
+            if len(compressed) >= len(data):
+                continue
+            compressed_name = f'{name}.{suffix}'
+            if self.exists(compressed_name):
+                self.delete(compressed_name)
+            names.append(self.save(compressed_name, ContentFile(compressed)))
+        return names
+
+
+class CompressedStaticFilesStorage(CompressedFilesMixin, StaticFilesStorage):
+    """StaticFilesStorage that also writes compressed variants of the files."""
+
+
+class CompressedManifestStaticFilesStorage(CompressedFilesMixin, ManifestStaticFilesStorage):
+    """ManifestStaticFilesStorage that also writes compressed variants of the hashed files."""
@@ -0,0 +1,101 @@
+import ipaddress
+import re
+
+from django.conf import settings
+from django.core import signing
+
+from dam.clientip import get_client_address, get_client_ip
+from dam.config import get_config
+
+
+TOKEN_SALT = 'dam.tokens'
+GENERATION_PREFIX = re.compile(r'(\d+\.\d+):')
+
+
+def get_token_keys():
+    """Return the mapping of key ids to secrets used to sign tokens.
+
+    Defaults to a single key derived from ALTCHA_HMAC_KEY, so rotating that key
+    also invalidates every issued token.
+    """
+    return get_config().token_keys
+
+
+def get_signer(key):
+    return signing.Signer(key=key, salt=TOKEN_SALT)
+
+
+def ip_binding(address):
+    """Return the network, as a string, a verification from address is bound to.
+
+    address is an ipaddress object. The prefix lengths come from
+    ALTCHA_IPV4_BIND_PREFIX and ALTCHA_IPV6_BIND_PREFIX, and default to
+    binding the exact address.
+    """
+    config = get_config()
+    prefix = config.ipv4_bind_prefix if address.version == 4 else config.ipv6_bind_prefix
+    return str(ipaddress.ip_network((address, prefix), strict=False))
+
+
+def client_binding(request):
+    """Return the binding of the request's client, using the address it was resolved to.
+
+    Invalid client IPs are bound to as they are.
+    """
+    address = get_client_address(request)
+    return get_client_ip(request) if address is None else ip_binding(address)
+
+
+def make_token(expires, binding, generation=None):
+    """Create a signed token recording a verification, bound to binding, until expires.
+
+    generation is the verification's revocation generation stamp, if any.
+    """
+    config = get_config()
+    keys = config.token_keys
+    key_id = config.token_key_id
+    if generation:
+        value = f'{key_id}:{int(expires)}:{generation}:{binding}'
+    else:
+        value = f'{key_id}:{int(expires)}:{binding}'
+    return get_signer(keys[key_id]).sign(value)
+
+
+def load_token(token):
+    """Verify a token's signature and return its (expires, binding, generation).
+
+    generation is None if the token has no generation stamp. Returns None if
+    the token is malformed, signed with an unknown key id or has a bad
+    signature.
+    """
+    key_id = token.split(':', 1)[0]
+    key = get_token_keys().get(key_id)
+    if key is None:
+        return None
+    try:
+        value = get_signer(key).unsign(token)
+        _, expires, binding = value.split(':', 2)
+        # A generation stamp ('1.0') can't be mistaken for the start of an
+        # IPv6 binding, which has no dots before its first colon.
+        generation = None
+        match = GENERATION_PREFIX.match(binding)
+        if match:
+            generation = match.group(1)
+            binding = binding[match.end():]
+        return int(expires), binding, generation
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+def set_token_cookie(response, expires, binding, generation=None):
+    """Store a verification token on the response as a cookie."""
+    config = get_config()
+    response.set_cookie(
+        config.cookie_name,
+        make_token(expires, binding, generation),
+        max_age=config.auth_expire_minutes * 60,
+        domain=settings.SESSION_COOKIE_DOMAIN,
+        secure=settings.SESSION_COOKIE_SECURE,
+        httponly=True,
+        samesite='Lax',
+    )
@@ -1,6 +1,6 @@
 from django.urls import path
 
-from dam.views import dam_challenge, submit_challenge
+from dam.views import dam_challenge, dam_check, submit_challenge
 
 
 app_name = 'dam'
@@ -8,4 +8,5 @@ app_name = 'dam'
 urlpatterns = [
     path('dam/', dam_challenge, name='challenge'),
     path('dam/submit/', submit_challenge, name='submit_challenge'),
+    path('dam/check/', dam_check, name='check'),
 ]
@@ -1,79 +1,187 @@
 import json
 import time
-import datetime
 from base64 import b64decode
+from functools import wraps
 
 
-from django.conf import settings
-from django.http import JsonResponse
-from django.shortcuts import render
-from django.core.cache import cache
-from django.views.decorators.http import require_GET, require_POST
-from altcha import create_challenge, verify_solution
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, JsonResponse
+from django.utils.log import log_response
+from django.views.decorators.csrf import csrf_exempt
+from altcha import verify_solution
 
-from dam.middleware import get_client_ip
+from dam.challenges import aissue_challenge
+from dam.clientip import get_client_ip
+from dam.config import get_config
+from dam.difficulty import get_difficulty_controller
+from dam.events import log_event
+from dam.metrics import count_challenge, get_metrics, prometheus_text
+from dam.middleware import (ALLOWED_VERDICTS, GENERATION_SESSION_KEY, VERIFIED, AltchaMiddleware,
+                            session_aget, session_aset)
+from dam.ratelimit import get_rate_limiter
+from dam.rendering import render_challenge_page
+from dam.replay import get_replay_store
+from dam.revocation import get_generations
+from dam.signals import challenge_failed, challenge_replayed, challenge_solved
+from dam.steps import arun_steps, run_steps
+from dam.tokens import client_binding, set_token_cookie
 
 
-@require_GET
-def dam_challenge(request):
+def require_method(method):
+    """Decorator to only allow an async view to be called with the given HTTP method.
+
+    Django's own require_GET and require_POST only support async views from
+    Django 5.0.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def inner(request, *args, **kwargs):
+            if request.method != method:
+                response = HttpResponseNotAllowed([method])
+                log_response(
+                    'Method Not Allowed (%s): %s', request.method, request.path,
+                    response=response,
+                    request=request,
+                )
+                return response
+            return await func(request, *args, **kwargs)
+        return inner
+    return decorator
+
+
+@require_method('GET')
+async def dam_challenge(request):
     """Provide user an Altcha challenge to solve before allowing access."""
-    challenge_expire_mins = getattr(settings, 'ALTCHA_CHALLENGE_EXPIRE_MINUTES', 2)
-    challenge = create_challenge(
-        expires=datetime.datetime.now() + datetime.timedelta(minutes=challenge_expire_mins),
-        max_number=settings.ALTCHA_MAX_NUMBER,
-        hmac_key=settings.ALTCHA_HMAC_KEY,
-        # Use the params to add arbitrary values to the salt, potentially increasing security
-        params=getattr(settings, 'ALTCHA_SALT_PARAMS', {}),
-    )
+    challenge = await aissue_challenge(request)
+    if challenge is None:
+        log_event('rate_limited', request, endpoint='challenge')
+        response = HttpResponse('Too many requests.', status=429, content_type='text/plain')
+        response['Retry-After'] = get_rate_limiter('challenge').window
+        return response
     next_url = request.GET.get('next', '/')
-    return render(
-        request,
-        'dam_challenge.html',
-        {
-            'challenge': challenge,
-            'site_icon_url': getattr(settings, 'ALTCHA_SITE_ICON_URL', ''),
-            'js_src_url': getattr(
-                settings, 'ALTCHA_JS_URL', f'{settings.STATIC_URL}altcha/altcha.min.js'),
-            'css_src_url': getattr(
-                settings, 'ALTCHA_CSS_URL', f'{settings.STATIC_URL}dam/dam.css'),
-            'altcha_message': getattr(settings,
-                                      'ALTCHA_MESSAGE',
-                                      'Gauging your humanity...This may take some seconds.'),
-            'next_url': next_url,
-            'help_text': getattr(settings,
-                                 'ALTCHA_HELP_MESSAGE',
-                                 ''),
-        }
-    )
-
-
-@require_POST
-def submit_challenge(request):
+    log_event('issued', request, challenge=challenge.challenge, max_number=challenge.max_number,
+              next=next_url, prev=request.GET.get('prev'))
+    return render_challenge_page(request, challenge, next_url)
+
+
+@require_method('POST')
+async def submit_challenge(request):
     """Attempt to validate Altcha challenge solution."""
-    altcha_session_key = getattr(settings, 'ALTCHA_SESSION_KEY', 'altcha_verified')
-    if time.time() <= request.session.get(altcha_session_key, 0):
-        # User already passed Altcha verification and their approval hasn't expired yet.
+    limiter = get_rate_limiter('submit')
+    if limiter is not None and not await limiter.aallow(get_client_ip(request)):
+        log_event('rate_limited', request, endpoint='submit')
+        response = JsonResponse({'error': 'Too many requests.'}, status=429)
+        response['Retry-After'] = limiter.window
+        return response
+    config = get_config()
+    generations = get_generations()
+    if config.use_signed_cookie:
+        if await get_checker().acheck_verification(request) == VERIFIED:
+            # User already holds a valid verification token.
+            return JsonResponse({'success': True})
+    elif (time.time() <= await session_aget(request.session, config.session_key, 0)
+          and (generations is None or await generations.ais_current(
+              await session_aget(request.session, GENERATION_SESSION_KEY),
+              get_client_ip(request)))):
+        # User already passed Altcha verification and their approval hasn't expired (or been
+        # revoked) yet.
         return JsonResponse({'success': True})
     try:
-        payload = json.loads(b64decode(request.POST.get('altcha')))
+        # API clients may send the solution in a header instead.
+        solution = request.POST.get('altcha') or request.headers.get('X-Altcha-Solution')
+        payload = json.loads(b64decode(solution))
     except Exception:
         payload = {}
-    ok, err = verify_solution(payload, settings.ALTCHA_HMAC_KEY, check_expires=True)
-    # If the solution validates and hasn't already been seen, create/update their session dam
-    # expiration and store client IP address, as well as saving the challenge in cache.
-    if (isinstance(payload, dict) and ok
-            and not cache.get(payload.get('challenge'))):
-        challenge_expire_mins = getattr(settings, 'ALTCHA_CHALLENGE_EXPIRE_MINUTES', 2)
-        auth_expire_mins = getattr(settings, 'ALTCHA_AUTH_EXPIRE_MINUTES', 480)
-        cache.set(
-            payload['challenge'],
-            't',
-            timeout=challenge_expire_mins*60)
-        altcha_session_key = getattr(settings, 'ALTCHA_SESSION_KEY', 'altcha_verified')
-        request.session[altcha_session_key] = time.time() + auth_expire_mins*60
+    started = time.perf_counter()
+    ok, err = verify_solution(payload, config.hmac_key, check_expires=True)
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.observe('dam_verify_solution_seconds', time.perf_counter() - started)
+    if not (isinstance(payload, dict) and ok):
+        count_challenge('failed')
+        log_event('failed', request, error=err,
+                  challenge=payload.get('challenge') if isinstance(payload, dict) else None)
+        challenge_failed.send(sender=submit_challenge, request=request, payload=payload,
+                              error=err)
+    # If the solution hasn't already been seen, create/update their session dam expiration
+    # and store client IP address. Adding the challenge to the replay store both checks and
+    # records that it has been used.
+    elif await get_replay_store().aadd(payload['challenge']):
+        count_challenge('solved')
+        log_event('solved', request, challenge=payload['challenge'])
+        challenge_solved.send(sender=submit_challenge, request=request, payload=payload)
+        auth_expires = time.time() + config.auth_expire_minutes*60
+        generation = (await generations.astamp(get_client_ip(request))
+                      if generations is not None else None)
+        if config.use_signed_cookie:
+            # Issue a signed token instead of writing to the session.
+            response = JsonResponse({'success': True})
+            set_token_cookie(response, auth_expires, client_binding(request), generation)
+            return response
+        await session_aset(request.session, config.session_key, auth_expires)
+        if generation is not None:
+            await session_aset(request.session, GENERATION_SESSION_KEY, generation)
         # Store client IP address to verify on subsequent requests.
-        request.session['ip'] = get_client_ip(request)
+        await session_aset(request.session, 'ip', get_client_ip(request))
         return JsonResponse({'success': True})
+    else:
+        count_challenge('replayed')
+        log_event('replayed', request, challenge=payload['challenge'])
+        challenge_replayed.send(sender=submit_challenge, request=request, payload=payload)
     # Otherwise, reject them.
-    fail_msg = getattr(settings, 'ALTCHA_FAIL_MESSAGE', 'Challenge failed or no longer valid.')
-    return JsonResponse({'error': fail_msg}, status=400)
+    controller = get_difficulty_controller()
+    if controller is not None:
+        controller.record_failure()
+    return JsonResponse({'error': config.fail_message}, status=400)
+
+
+def get_checker():
+    """Return the middleware instance dam_check uses to classify requests."""
+    # The middleware's own response is never used.
+    return get_config().component('checker', lambda: AltchaMiddleware(lambda request: None))
+
+
+@csrf_exempt
+def dam_check(request):
+    """Respond 204 if the client may proceed without a challenge, or 401 if not.
+
+    Meant for a reverse proxy's subrequests (e.g. nginx's auth_request), so it
+    only runs the middleware's checks, and renders nothing. It answers any
+    HTTP method, as proxies may pass the original request's method on, and
+    is exempt from CSRF checks, as nothing is changed on the client's behalf.
+
+    This is a sync view, as under WSGI an async one would start an event
+    loop on every call. Under ASGI, route adam_check instead.
+    """
+    return run_steps(check_steps(request))
+
+
+async def adam_check(request):
+    """Async version of dam_check(), for ASGI deployments."""
+    return await arun_steps(check_steps(request))
+
+
+def check_steps(request):
+    checker = get_checker()
+    # The path requested is the check's own, so only the client is checked.
+    verdict = checker.check_client_exclusions(request)
+    if verdict is None:
+        verdict = yield from checker.check_verification_steps(request)
+    return HttpResponse(status=204 if verdict in ALLOWED_VERDICTS else 401)
+
+
+# csrf_exempt() only supports async views from Django 5.0.
+adam_check.csrf_exempt = True
+
+
+@require_method('GET')
+async def dam_metrics(request):
+    """Serve this process's metrics in the Prometheus text format.
+
+    Not routed by dam.urls, as metrics shouldn't be public. Returns 404 if
+    ALTCHA_METRICS is off.
+    """
+    metrics = get_metrics()
+    if metrics is None:
+        raise Http404('Metrics are not enabled.')
+    return HttpResponse(prometheus_text(metrics.snapshot()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
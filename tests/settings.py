@@ -10,6 +10,10 @@ ALTCHA_SALT_PARAMS = {}
 
 ALTCHA_SESSION_KEY = 'altcha_verified'
 
+ALTCHA_USE_SIGNED_COOKIE = False
+
+ALTCHA_COOKIE_NAME = 'altcha_verified'
+
 ALTCHA_SITE_ICON_URL = ''
 
 ALTCHA_JS_URL = '/static/altcha/altcha.min.js'
@@ -0,0 +1,211 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+
+from dam.breaker import (CLOSED, HALF_OPEN, OPEN, CacheUnavailable, CircuitBreaker,
+                         GuardedCache, guarded_cache)
+from dam.challenges import ChallengePool
+from dam.difficulty import DifficultyController
+from dam.metrics import get_metrics
+from dam.ratelimit import RateLimiter
+from dam.replay import ReplayStore
+from dam.revocation import Generations
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker('test', failure_threshold=2, reset_seconds=30)
+
+
+class TestCircuitBreaker:
+    def test_opens_after_consecutive_failures(self, breaker):
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker.state == CLOSED
+        breaker.record_failure()
+        assert breaker.state == OPEN
+        assert not breaker.allow()
+
+    def test_half_opens_after_reset(self, breaker):
+        breaker.record_failure()
+        breaker.record_failure()
+        with patch('dam.breaker.time.monotonic', return_value=time.monotonic() + 30):
+            assert breaker.allow()
+            assert breaker.state == HALF_OPEN
+            # Only one trial call at a time.
+            assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CLOSED
+        assert breaker.allow()
+
+    def test_failed_trial_reopens(self, breaker):
+        breaker.record_failure()
+        breaker.record_failure()
+        with patch('dam.breaker.time.monotonic', return_value=time.monotonic() + 30):
+            assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == OPEN
+        assert not breaker.allow()
+
+    def test_transitions_counted(self, breaker, settings):
+        settings.ALTCHA_METRICS = True
+        breaker.record_failure()
+        breaker.record_failure()
+        with patch('dam.breaker.time.monotonic', return_value=time.monotonic() + 30):
+            breaker.allow()
+        breaker.record_success()
+        counters = get_metrics().snapshot()['counters']
+        assert counters['dam_cache_breaker_transitions_total'] == {
+            OPEN: 1, HALF_OPEN: 1, CLOSED: 1}
+
+
+@pytest.fixture
+def mock_caches():
+    with patch('dam.breaker.caches', {}) as mock_caches:
+        yield mock_caches
+
+
+class TestGuardedCache:
+    def test_call(self, breaker):
+        cache.clear()
+        guarded = GuardedCache('default', breaker, deadline=1)
+        assert guarded.call('add', 'key', 'value')
+        assert not guarded.call('add', 'key', 'value')
+        assert async_to_sync(guarded.acall)('get', 'key') == 'value'
+
+    def test_cache_looked_up_in_calling_thread(self, breaker):
+        threads = []
+        mock_caches = MagicMock()
+        mock_caches.__getitem__.side_effect = lambda alias: threads.append(
+            threading.current_thread()) or Mock(aget=AsyncMock())
+        with patch('dam.breaker.caches', mock_caches):
+            GuardedCache('test', breaker).call('get', 'key')
+            async_to_sync(GuardedCache('test', breaker).acall)('get', 'key')
+            # With a deadline, sync calls run in the executor's threads, which have their
+            # own cache connections.
+            GuardedCache('test', breaker, deadline=1).call('get', 'key')
+        assert threads[0] is threading.current_thread()
+        assert threads[2].name.startswith('dam-cache')
+
+    def test_call_without_deadline(self, breaker, mock_caches):
+        mock_caches['test'] = Mock(**{'add.return_value': True})
+        guarded = GuardedCache('test', breaker)
+        assert guarded.executor is None
+        assert guarded.call('add', 'key', 'value')
+
+    def test_missed_deadline(self, breaker, mock_caches):
+        mock_caches['test'] = Mock(**{'add.side_effect': lambda *args: time.sleep(0.2)})
+        guarded = GuardedCache('test', breaker, deadline=0.01)
+        with pytest.raises(CacheUnavailable):
+            guarded.call('add', 'key', 'value')
+        assert breaker.failures == 1
+
+    def test_async_missed_deadline(self, breaker, mock_caches):
+        async def aadd(*args):
+            await asyncio.sleep(0.2)
+
+        mock_caches['test'] = Mock(aadd=aadd)
+        guarded = GuardedCache('test', breaker, deadline=0.01)
+        with pytest.raises(CacheUnavailable):
+            async_to_sync(guarded.acall)('add', 'key', 'value')
+        assert breaker.failures == 1
+
+    def test_error(self, breaker, mock_caches):
+        mock_caches['test'] = Mock(**{'add.side_effect': ConnectionError})
+        guarded = GuardedCache('test', breaker)
+        with pytest.raises(CacheUnavailable):
+            guarded.call('add', 'key', 'value')
+        assert breaker.failures == 1
+
+    def test_value_error_is_an_answer(self, breaker):
+        cache.clear()
+        guarded = GuardedCache('default', breaker, deadline=1)
+        with pytest.raises(ValueError):
+            guarded.call('incr', 'missing')
+        with pytest.raises(ValueError):
+            async_to_sync(guarded.acall)('incr', 'missing')
+        assert breaker.failures == 0
+
+    def test_open_breaker_skips_cache(self, breaker, mock_caches):
+        broken_cache = mock_caches['test'] = Mock(**{'add.side_effect': ConnectionError})
+        guarded = GuardedCache('test', breaker)
+        for _ in range(3):
+            with pytest.raises(CacheUnavailable):
+                guarded.call('add', 'key', 'value')
+        assert broken_cache.add.call_count == 2
+
+    def test_shared_per_alias(self, settings):
+        settings.ALTCHA_CACHE_BREAKER_THRESHOLD = 3
+        guarded = guarded_cache('default')
+        assert guarded_cache('default') is guarded
+        assert guarded.breaker.failure_threshold == 3
+        assert ReplayStore().cache is ChallengePool(10).cache is guarded
+
+
+@pytest.fixture
+def broken_cache(mock_caches, settings):
+    """Make the default cache fail, and its breaker open after one failure."""
+    settings.ALTCHA_CACHE_DEADLINE_SECONDS = None
+    settings.ALTCHA_CACHE_BREAKER_THRESHOLD = 1
+    broken = Mock(**{f'{method}.side_effect': ConnectionError
+                     for method in ('add', 'get', 'get_many', 'set_many', 'incr')})
+    mock_caches['default'] = broken
+    return broken
+
+
+class TestFallbacks:
+    def test_replays_rejected_locally_while_cache_unavailable(self, broken_cache):
+        store = ReplayStore(timeout=60)
+        assert store.add('abc')
+        assert store.cache.breaker.state == OPEN
+        assert not store.add('abc')
+        assert async_to_sync(store.aadd)('def')
+        assert not async_to_sync(store.aadd)('def')
+
+    def test_concurrent_replays_rejected_while_cache_unavailable(self, broken_cache, caplog):
+        store = ReplayStore(timeout=60)
+        store.add('abc')
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(store.add, ['replayed-challenge'] * 4))
+        assert sorted(results) == [False, False, False, True]
+        # Only the breaker opening is logged, not each submission.
+        assert not any('replayed-challenge' in message for message in caplog.messages)
+
+    def test_pool_empty(self, broken_cache):
+        pool = ChallengePool(10)
+        assert pool.take() is None
+        assert pool.refill() == 0
+        assert async_to_sync(pool.atake)() is None
+
+    def test_difficulty_holds(self, broken_cache):
+        controller = DifficultyController(1000, 4000, refresh_interval=0, use_load=False)
+        controller.level = 2000.0
+        assert controller.issue('1.2.3.4') == 2000
+        assert async_to_sync(controller.aissue)('1.2.3.4') == 2000
+
+    def test_rate_limits_kept_locally(self, broken_cache):
+        limiter = RateLimiter('challenge', rate=2, window=60, sync_interval=0)
+        assert [limiter.allow('1.2.3.4') for _ in range(3)] == [True, True, False]
+        assert not async_to_sync(limiter.aallow)('1.2.3.4')
+        # The counts are synced once the cache recovers.
+        assert limiter.unsynced == {'1.2.3.4/32': 4}
+
+    def test_generations_never_loaded(self, broken_cache):
+        generations = Generations()
+        assert generations.stamp('1.2.3.4') is None
+        assert generations.is_current('1.2.3', '1.2.3.4')
+        assert async_to_sync(generations.astamp)('1.2.3.4') is None
+
+    def test_generations_kept(self, broken_cache, settings):
+        generations = Generations(check_interval=0)
+        generations.current = (3, 5)
+        assert generations.stamp('1.2.3.4') == '3.0'
+        assert generations.is_current('3.0', '1.2.3.4')
+        assert not async_to_sync(generations.ais_current)('2.0', '1.2.3.4')
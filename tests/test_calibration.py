@@ -0,0 +1,49 @@
+from io import StringIO
+
+import pytest
+from django.core.management import CommandError, call_command
+from django.test import override_settings
+
+from dam.calibration import ClientProfile, hash_rate, recommend_max_number, solve_seconds
+
+
+def test_hash_rate():
+    assert hash_rate(seconds=0.01, batch=100) > 0
+
+
+def test_solve_seconds():
+    assert solve_seconds(100_000, 50_000) == 1.0
+    assert solve_seconds(100_000, 50_000, percentile=95) == 1.9
+
+
+def test_recommend_max_number():
+    assert recommend_max_number(1.0, 95_000, percentile=95) == 100_000
+    # The recommendation is solved within the target at the percentile.
+    assert solve_seconds(recommend_max_number(2.0, 123_456), 123_456, percentile=95) <= 2.0
+
+
+def test_parse_client_profile():
+    profile = ClientProfile.parse('tablet:200000:3')
+    assert (profile.name, profile.rate, profile.workers) == ('tablet', 200_000, 3)
+    assert profile.total_rate == 600_000
+    assert ClientProfile.parse('tablet:200000').workers == 1
+    for value in ('tablet', 'tablet:fast', ':1000', 'tablet:0', 'tablet:1000:0', 'a:1:2:3'):
+        with pytest.raises(ValueError):
+            ClientProfile.parse(value)
+
+
+@override_settings(ALTCHA_MAX_NUMBER=100_000)
+def test_calibrate_command():
+    out = StringIO()
+    call_command('dam_calibrate', '--profile', 'slow:10000', '--profile', 'fast:100000:4',
+                 '--seconds', '0.01', '--processes', '1', '--target-seconds', '2',
+                 '--percentile', '50', stdout=out)
+    output = out.getvalue()
+    assert 'Solve times at max number 100,000:' in output
+    assert 'slow                     expected 5.0s, p50 5.0s' in output
+    assert 'Recommended: ALTCHA_MAX_NUMBER = 40000, which p50 of slow clients' in output
+
+
+def test_calibrate_command_recommend_for_unknown_profile():
+    with pytest.raises(CommandError):
+        call_command('dam_calibrate', '--recommend-for', 'toaster', '--seconds', '0.01')
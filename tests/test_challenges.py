@@ -0,0 +1,142 @@
+from io import StringIO
+from unittest.mock import patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+
+from dam.breaker import guarded_cache
+from dam.challenges import (ChallengePool, POOL_HEAD_KEY, challenge_lifetime,
+                            get_challenge_pool, new_challenge, slot_key)
+from dam.metrics import get_metrics
+
+
+@pytest.fixture
+def pool():
+    cache.clear()
+    return ChallengePool(3, ttl=30)
+
+
+@pytest.fixture
+def metrics(settings):
+    settings.ALTCHA_METRICS = True
+    return get_metrics()
+
+
+def pool_counts(metrics):
+    return metrics.snapshot()['counters'].get('dam_pool_total', {})
+
+
+class TestNewChallenge:
+    @patch('dam.challenges.create_challenge')
+    def test_new_challenge_extends_expiry(self, mock_create_challenge, settings):
+        new_challenge()
+        expires = mock_create_challenge.call_args.kwargs['expires']
+        new_challenge(extra_seconds=30)
+        extended = mock_create_challenge.call_args.kwargs['expires']
+        assert round((extended - expires).total_seconds()) == 30
+        assert mock_create_challenge.call_args.kwargs['max_number'] == settings.ALTCHA_MAX_NUMBER
+
+    @pytest.mark.parametrize('pool_size, expected', [(0, 120), (10, 150)])
+    def test_challenge_lifetime(self, pool_size, expected, settings):
+        settings.ALTCHA_CHALLENGE_EXPIRE_MINUTES = 2
+        settings.ALTCHA_POOL_SIZE = pool_size
+        settings.ALTCHA_POOL_TTL = 30
+        assert challenge_lifetime() == expected
+
+
+class TestChallengePool:
+    def test_take_from_empty_pool(self, pool, metrics):
+        assert pool.take() is None
+        assert pool_counts(metrics) == {'miss': 1}
+        assert pool.wakeup.is_set()
+
+    def test_refill_and_take(self, pool, metrics):
+        assert pool.refill() == 3
+        taken = [pool.take() for _ in range(4)]
+        assert len({challenge.challenge for challenge in taken[:3]}) == 3
+        assert taken[3] is None
+        assert pool_counts(metrics) == {'refilled': 3, 'hit': 3, 'miss': 1}
+
+    def test_taken_slot_deleted(self, pool):
+        pool.refill()
+        head = cache.get(POOL_HEAD_KEY)
+        pool.take()
+        assert cache.get(slot_key(head + 1)) is None
+        assert cache.get(slot_key(head + 2)) is not None
+
+    def test_refill_only_fills_empty_slots(self, pool):
+        pool.refill()
+        pool.take()
+        # The two unused challenges are kept and one more is added.
+        assert pool.refill() == 1
+        assert pool.refill() == 0
+
+    def test_head_counter_evicted(self, pool):
+        pool.refill()
+        taken = pool.take()
+        cache.delete(POOL_HEAD_KEY)
+        # The new head starts past the old slots, so none are handed out again.
+        assert pool.take() is None
+        assert pool.refill() == 3
+        reissued = {pool.take().challenge for _ in range(3)}
+        assert taken.challenge not in reissued
+
+    def test_atake(self, pool, metrics):
+        assert async_to_sync(pool.atake)() is None
+        pool.refill()
+        head = cache.get(POOL_HEAD_KEY)
+        assert async_to_sync(pool.atake)() is not None
+        assert cache.get(slot_key(head + 1)) is None
+        assert pool_counts(metrics)['hit'] == 1
+
+    def test_cache_guarded(self, pool):
+        assert pool.cache is guarded_cache('default')
+
+    def test_stop(self, pool):
+        pool.start()
+        pool.stop()
+        pool.thread.join(1)
+        assert not pool.thread.is_alive()
+
+    @patch.object(ChallengePool, 'run')
+    def test_start(self, mock_run, pool):
+        pool.start()
+        pool.thread.join()
+        pool.start()
+        assert mock_run.call_count == 2
+
+
+class TestGetChallengePool:
+    def test_disabled(self, settings):
+        settings.ALTCHA_POOL_SIZE = 0
+        assert get_challenge_pool() is None
+
+    def test_enabled(self, settings):
+        settings.ALTCHA_POOL_SIZE = 5
+        settings.ALTCHA_POOL_TTL = 20
+        pool = get_challenge_pool()
+        assert (pool.size, pool.ttl) == (5, 20)
+        assert get_challenge_pool() is pool
+
+    def test_reset_on_setting_change(self, settings):
+        settings.ALTCHA_POOL_SIZE = 5
+        pool = get_challenge_pool()
+        settings.ALTCHA_POOL_SIZE = 6
+        assert get_challenge_pool().size == 6
+        assert pool.stopped.is_set()
+
+
+class TestRefillPoolCommand:
+    def test_refill(self, settings):
+        cache.clear()
+        settings.ALTCHA_POOL_SIZE = 2
+        out = StringIO()
+        call_command('dam_refill_pool', stdout=out)
+        assert out.getvalue() == 'Added 2 challenges to the pool.\n'
+
+    def test_disabled(self, settings):
+        settings.ALTCHA_POOL_SIZE = 0
+        with pytest.raises(CommandError):
+            call_command('dam_refill_pool')
@@ -0,0 +1,93 @@
+from ipaddress import ip_address, ip_network
+from time import time
+from unittest.mock import Mock, patch
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+
+from dam.clientip import (ClientIPResolver, get_client_address, get_client_ip, get_resolver,
+                          resolve_client)
+from dam.middleware import IP_CHANGED, VERIFIED, AltchaMiddleware
+
+
+def meta(forwarded_for=None, remote_addr='10.0.0.1'):
+    meta = {'REMOTE_ADDR': remote_addr}
+    if forwarded_for is not None:
+        meta['HTTP_X_FORWARDED_FOR'] = forwarded_for
+    return meta
+
+
+class TestClientIPResolver:
+    @pytest.mark.parametrize('meta, expected', [
+        (meta(), '10.0.0.1'),
+        (meta('1.1.1.1, 2.2.2.2'), '1.1.1.1'),
+    ])
+    def test_untrusted_first_hop(self, meta, expected):
+        assert ClientIPResolver().resolve(meta) == (expected, ip_address(expected))
+
+    @pytest.mark.parametrize('proxy_count, expected', [
+        (0, '10.0.0.1'),
+        (1, '3.3.3.3'),
+        (2, '2.2.2.2'),
+        (3, '1.1.1.1'),
+        # More proxies than hops falls back to the leftmost hop.
+        (5, '1.1.1.1'),
+    ])
+    def test_proxy_count(self, proxy_count, expected):
+        resolver = ClientIPResolver(proxy_count=proxy_count)
+        assert resolver.resolve(meta('1.1.1.1, 2.2.2.2,3.3.3.3'))[0] == expected
+
+    @pytest.mark.parametrize('forwarded_for, expected', [
+        (None, '10.0.0.1'),
+        ('1.1.1.1', '1.1.1.1'),
+        # The client's own claims are ignored.
+        ('6.6.6.6, 1.1.1.1, 10.0.0.2', '1.1.1.1'),
+        ('1.1.1.1, 2001:db8::1', '1.1.1.1'),
+        # Every hop trusted.
+        ('10.0.0.3, 10.0.0.2', '10.0.0.3'),
+    ])
+    def test_trusted_proxies(self, forwarded_for, expected):
+        resolver = ClientIPResolver([ip_network('10.0.0.0/8'), ip_network('2001:db8::/32')])
+        assert resolver.resolve(meta(forwarded_for)) == (expected, ip_address(expected))
+
+    def test_invalid_hop(self):
+        resolver = ClientIPResolver([ip_network('10.0.0.0/8')])
+        assert resolver.resolve(meta('1.1.1.1, unknown')) == ('unknown', None)
+
+
+def test_get_resolver(settings):
+    settings.ALTCHA_TRUSTED_PROXIES = ['10.0.0.0/8']
+    settings.ALTCHA_PROXY_COUNT = 2
+    resolver = get_resolver()
+    assert ip_address('10.1.2.3') in resolver.trusted_proxies
+    assert resolver.proxy_count == 2
+    assert get_resolver() is resolver
+
+
+def test_get_resolver_invalid_network(settings):
+    settings.ALTCHA_TRUSTED_PROXIES = ['10.0.0.0/33']
+    with pytest.raises(ImproperlyConfigured):
+        get_resolver()
+
+
+def test_resolved_once_per_request(rf):
+    request = rf.get('/', HTTP_X_FORWARDED_FOR='1.1.1.1')
+    with patch.object(ClientIPResolver, 'resolve',
+                      return_value=('1.1.1.1', ip_address('1.1.1.1'))) as mock_resolve:
+        assert get_client_ip(request) == '1.1.1.1'
+        assert get_client_address(request) == ip_address('1.1.1.1')
+        assert resolve_client(request) == ('1.1.1.1', ip_address('1.1.1.1'))
+    mock_resolve.assert_called_once_with(request.META)
+
+
+@pytest.mark.parametrize('session_ip, expected', [
+    ('192.0.2.1', VERIFIED),
+    ('192.0.2.200', VERIFIED),
+    ('198.51.100.1', IP_CHANGED),
+])
+def test_session_bound_to_network(session_ip, expected, rf, settings):
+    settings.ALTCHA_IPV4_BIND_PREFIX = 24
+    AM = AltchaMiddleware(Mock())
+    request = rf.get('/protected/', REMOTE_ADDR='192.0.2.1')
+    request.session = {settings.ALTCHA_SESSION_KEY: time() + 100, 'ip': session_ip}
+    assert AM.classify(request) == expected
@@ -0,0 +1,159 @@
+import re
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+
+from dam.challenges import ChallengePool, get_challenge_pool
+from dam.config import Config, get_config
+
+
+def test_config_is_immutable():
+    config = get_config()
+    with pytest.raises(AttributeError):
+        config.max_number = 1
+    with pytest.raises(AttributeError):
+        config.extra = 1
+    with pytest.raises(AttributeError):
+        del config.hmac_key
+    with pytest.raises(TypeError):
+        config.page_context['help_text'] = 'changed'
+
+
+def test_config_rebuilt_only_when_settings_change(settings):
+    config = get_config()
+    assert get_config() is config
+    settings.ALTCHA_MAX_NUMBER = 1234
+    assert get_config() is not config
+    assert get_config().max_number == 1234
+    settings.DEBUG = not settings.DEBUG
+    assert get_config().max_number == 1234
+
+
+def test_config_compiles_exclusions(settings):
+    settings.ALTCHA_EXCLUDE_IPS = ['10.0.0.0/8', '2001:db8::/32']
+    settings.ALTCHA_EXCLUDE_PATHS = ['/open/', '/static/*']
+    settings.ALTCHA_EXCLUDE_HEADERS = {'User-Agent': 'Friendlybot', 'user-agent': 'Kindbot'}
+    config = Config.from_settings()
+    assert len(config.ip_index) == 2
+    assert config.path_matcher.match('/static/app.css')
+    assert config.header_matcher.match({'HTTP_USER_AGENT': 'kindbot'})
+    assert config.excluded_headers == {'User-Agent': re.compile('(?:Friendlybot)|(?:Kindbot)',
+                                                                re.I)}
+
+
+def test_config_urls():
+    assert get_config().challenge_url == '/dam/'
+    assert get_config().dam_paths == {'/dam/', '/dam/submit/', '/dam/check/'}
+
+
+@pytest.mark.parametrize('setting, value, message', [
+    ('ALTCHA_EXCLUDE_IPS', ['10.0.0.0/8', '10.0.0.1/8'], 'Invalid ALTCHA_EXCLUDE_IPS'),
+    ('ALTCHA_EXCLUDE_IPS', ['not_an_ip_address'], 'Invalid ALTCHA_EXCLUDE_IPS'),
+    ('ALTCHA_EXCLUDE_HEADERS', {'User-Agent': '(unclosed'}, 'Invalid ALTCHA_EXCLUDE_HEADERS'),
+    ('ALTCHA_MAX_NUMBER', 0, 'ALTCHA_MAX_NUMBER must be a positive integer'),
+    ('ALTCHA_INLINE_CHALLENGE_STATUS', '403', 'must be an integer'),
+    ('ALTCHA_TRUSTED_PROXIES', ['not-a-cidr'], 'Invalid ALTCHA_TRUSTED_PROXIES'),
+    ('ALTCHA_PROXY_COUNT', -1, 'ALTCHA_PROXY_COUNT must be an integer of at least 0'),
+    ('ALTCHA_TOKEN_KEYS', {'a:b': 'secret'}, 'ids must be strings without colons'),
+    ('ALTCHA_TOKEN_KEY_ID', 'missing', "'missing' is not in ALTCHA_TOKEN_KEYS"),
+    ('ALTCHA_IPV4_BIND_PREFIX', 40, 'ALTCHA_IPV4_BIND_PREFIX must be an integer from 0 to 32'),
+    ('ALTCHA_IPV6_BIND_PREFIX', '64', 'ALTCHA_IPV6_BIND_PREFIX must be an integer'),
+    ('ALTCHA_RATE_LIMIT_SUBMIT', 5, 'ALTCHA_RATE_LIMIT_SUBMIT must be a'),
+    ('ALTCHA_RATE_LIMIT_CHALLENGE', (10, 0), 'ALTCHA_RATE_LIMIT_CHALLENGE must be a'),
+    ('ALTCHA_POOL_SIZE', -1, 'ALTCHA_POOL_SIZE must be an integer of at least 0'),
+    ('ALTCHA_REPLAY_CACHE', 'missing', "ALTCHA_REPLAY_CACHE 'missing' is not a cache"),
+    ('ALTCHA_REPLAY_STORE', 'dam.replay.Missing', 'Invalid ALTCHA_REPLAY_STORE'),
+    ('ALTCHA_CACHE_DEADLINE_SECONDS', '1', 'must be a number of at least 0'),
+    ('ALTCHA_EXCLUDE_FILES_CHECK_SECONDS', '5', 'ALTCHA_EXCLUDE_FILES_CHECK_SECONDS must be a'),
+    ('ALTCHA_HEADER_CACHE_SIZE', '100', 'ALTCHA_HEADER_CACHE_SIZE must be an integer'),
+])
+def test_invalid_settings(settings, setting, value, message):
+    setattr(settings, setting, value)
+    with pytest.raises(ImproperlyConfigured, match=message):
+        get_config()
+
+
+def test_invalid_crawler_pattern(settings):
+    settings.ALTCHA_TRUSTED_PROXIES = ['10.0.0.0/8']
+    settings.ALTCHA_VERIFIED_CRAWLERS = {'(unclosed': ['.googlebot.com']}
+    with pytest.raises(ImproperlyConfigured, match='Invalid ALTCHA_VERIFIED_CRAWLERS pattern'):
+        get_config()
+
+
+def test_missing_hmac_key(settings):
+    del settings.ALTCHA_HMAC_KEY
+    with pytest.raises(ImproperlyConfigured, match='requires ALTCHA_HMAC_KEY'):
+        get_config()
+
+
+def test_page_context_uses_hashed_static_urls(settings, tmp_path):
+    del settings.ALTCHA_JS_URL
+    del settings.ALTCHA_CSS_URL
+    settings.STATIC_ROOT = tmp_path
+    settings.STORAGES = {
+        'staticfiles': {
+            'BACKEND': 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage',
+        },
+    }
+    # Resolving the URLs needs the manifest, so the config can be built before collectstatic.
+    config = get_config()
+    call_command('collectstatic', interactive=False, verbosity=0)
+    page_context = config.page_context
+    assert re.fullmatch(r'/static/altcha/altcha\.min\.\w{12}\.js', page_context['js_src_url'])
+    assert re.fullmatch(r'/static/dam/dam\.\w{12}\.css', page_context['css_src_url'])
+
+
+@pytest.mark.parametrize('setting, value, message', [
+    ('ALTCHA_DIFFICULTY_SMOOTHING', 2, 'ALTCHA_DIFFICULTY_SMOOTHING must be more than 0'),
+    ('ALTCHA_DIFFICULTY_CEILING', 10, 'ALTCHA_DIFFICULTY_CEILING must be an integer of at least'),
+    ('ALTCHA_DIFFICULTY_FAIL_RATE', 0, 'ALTCHA_DIFFICULTY_FAIL_RATE must be more than 0'),
+    ('ALTCHA_DIFFICULTY_CACHE', 'missing', "'missing' is not a cache"),
+])
+def test_invalid_difficulty_settings(settings, setting, value, message):
+    settings.ALTCHA_ADAPTIVE_DIFFICULTY = True
+    setattr(settings, setting, value)
+    with pytest.raises(ImproperlyConfigured, match=message):
+        get_config()
+
+
+@pytest.mark.parametrize('setting, value, message', [
+    ('ALTCHA_METRICS_EXPORTER', 'tests.missing.export', 'Invalid ALTCHA_METRICS_EXPORTER'),
+    ('ALTCHA_METRICS_BUCKETS', [0.1, -1], 'ALTCHA_METRICS_BUCKETS must be positive'),
+])
+def test_invalid_metrics_settings(settings, setting, value, message):
+    settings.ALTCHA_METRICS = True
+    setattr(settings, setting, value)
+    with pytest.raises(ImproperlyConfigured, match=message):
+        get_config()
+
+
+def test_components_rebuilt_with_config(settings):
+    settings.ALTCHA_POOL_SIZE = 5
+    config = get_config()
+    pool = config.component('challenge_pool', lambda: ChallengePool(**config.pool))
+    assert get_challenge_pool() is pool
+    settings.ALTCHA_POOL_SIZE = 6
+    # The old configuration's components are stopped, and new ones built.
+    assert pool.stopped.is_set()
+    assert get_challenge_pool().size == 6
+
+
+def test_revocation_settings(settings):
+    settings.ALTCHA_REVOCATION = True
+    settings.ALTCHA_AUTH_EXPIRE_MINUTES = 60
+    assert get_config().revocation['subnet_ttl'] == 3601
+    settings.ALTCHA_REVOCATION_IPV4_PREFIX = 33
+    with pytest.raises(ImproperlyConfigured, match='ALTCHA_REVOCATION_IPV4_PREFIX'):
+        get_config()
+
+
+@pytest.mark.parametrize('setting, value, message', [
+    ('ALTCHA_EVENT_SINK', 'dam.events.Missing', 'Invalid ALTCHA_EVENT_SINK'),
+    ('ALTCHA_EVENT_QUEUE_SIZE', 0, 'ALTCHA_EVENT_QUEUE_SIZE must be an integer of at least 1'),
+])
+def test_invalid_event_settings(settings, setting, value, message):
+    settings.ALTCHA_EVENTS = True
+    setattr(settings, setting, value)
+    with pytest.raises(ImproperlyConfigured, match=message):
+        get_config()
@@ -0,0 +1,174 @@
+import socket
+from unittest.mock import Mock, patch
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+
+from dam.config import get_config
+from dam.crawlers import (CrawlerVerifier, SocketResolver, get_crawler_verifier,
+                          verify_crawler)
+from dam.middleware import AltchaMiddleware, VERIFIED_CRAWLER
+
+
+GOOGLEBOT_UA = 'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'
+
+
+class StubResolver:
+    """Resolver answering from fixed tables instead of DNS."""
+
+    hosts = {
+        '66.249.66.1': 'crawl-66-249-66-1.googlebot.com.',
+        '1.2.3.4': 'spoofer.example.com',
+        '5.6.7.8': 'fake.googlebot.com',
+        '2001:4860:4801:10::1': 'crawl-2001-4860-4801-10--1.googlebot.com',
+    }
+    addresses = {
+        'crawl-66-249-66-1.googlebot.com.': {'66.249.66.1'},
+        'fake.googlebot.com': {'9.9.9.9'},
+        # The same address as above, written out in full.
+        'crawl-2001-4860-4801-10--1.googlebot.com': {'2001:4860:4801:0010:0000:0000:0000:0001'},
+    }
+
+    def reverse(self, ip):
+        return self.hosts.get(ip)
+
+    def forward(self, hostname):
+        return self.addresses.get(hostname, set())
+
+
+@pytest.fixture
+def verifier():
+    return CrawlerVerifier({r'Googlebot': ['.googlebot.com', '.google.com']}, StubResolver(),
+                           cache_size=2)
+
+
+def wait(verifier, ip):
+    verifier.pending[(ip, ('.googlebot.com', '.google.com'))].result()
+
+
+class TestVerifyCrawler:
+    @pytest.mark.parametrize('ip, expected', [
+        ('66.249.66.1', True),      # Reverse and forward DNS match
+        ('1.2.3.4', False),         # Hostname outside the crawler's domains
+        ('5.6.7.8', False),         # Hostname doesn't resolve back to the IP
+        ('10.0.0.1', False),        # No hostname
+        ('2001:4860:4801:10::1', True),  # Forward DNS gives the address in another form
+        ('not-an-ip', False),
+    ])
+    def test_verify_crawler(self, ip, expected):
+        assert verify_crawler(ip, ('.googlebot.com',), StubResolver()) == expected
+
+
+class TestCrawlerVerifier:
+    def test_verified_after_lookup(self, verifier):
+        meta = {'HTTP_USER_AGENT': GOOGLEBOT_UA}
+        # The first request is unverified while the lookup runs.
+        assert not verifier.verify(meta, '66.249.66.1')
+        wait(verifier, '66.249.66.1')
+        assert verifier.verify(meta, '66.249.66.1')
+
+    def test_negative_result_cached(self, verifier):
+        meta = {'HTTP_USER_AGENT': GOOGLEBOT_UA}
+        verifier.verify(meta, '1.2.3.4')
+        wait(verifier, '1.2.3.4')
+        with patch.object(verifier, 'lookup') as mock_lookup:
+            assert not verifier.verify(meta, '1.2.3.4')
+            mock_lookup.assert_not_called()
+
+    def test_no_crawler_claimed(self, verifier):
+        assert not verifier.verify({'HTTP_USER_AGENT': 'Firefox'}, '66.249.66.1')
+        assert not verifier.verify({}, '66.249.66.1')
+        assert verifier.executor is None
+
+    def test_results_expire(self, verifier):
+        verifier.ttl = 0
+        verifier.lookup('66.249.66.1', ('.googlebot.com', '.google.com'))
+        meta = {'HTTP_USER_AGENT': GOOGLEBOT_UA}
+        with patch.object(verifier, 'lookup') as mock_lookup:
+            assert not verifier.verify(meta, '66.249.66.1')
+            wait(verifier, '66.249.66.1')
+            mock_lookup.assert_called_once_with('66.249.66.1', ('.googlebot.com', '.google.com'))
+
+    def test_results_bounded(self, verifier):
+        for ip in ('66.249.66.1', '1.2.3.4', '5.6.7.8', '10.0.0.1'):
+            verifier.lookup(ip, ('.googlebot.com',))
+        assert [key[0] for key in verifier.unverified] == ['5.6.7.8', '10.0.0.1']
+        # Unverified results don't displace verified ones.
+        assert [key[0] for key in verifier.verified] == ['66.249.66.1']
+
+    def test_pending_bounded(self, verifier):
+        verifier.max_pending = 1
+        verifier.executor = Mock()
+        meta = {'HTTP_USER_AGENT': GOOGLEBOT_UA}
+        assert not verifier.verify(meta, '66.249.66.1')
+        assert not verifier.verify(meta, '1.2.3.4')
+        # While the queue is full, claims are unverified without a lookup.
+        verifier.executor.submit.assert_called_once()
+        assert list(verifier.pending) == [('66.249.66.1', ('.googlebot.com', '.google.com'))]
+
+    def test_resolver_error_is_unverified(self, verifier):
+        verifier.resolver = Mock(reverse=Mock(side_effect=RuntimeError))
+        assert not verifier.lookup('66.249.66.1', ('.googlebot.com',))
+
+    def test_close(self, verifier):
+        verifier.verify({'HTTP_USER_AGENT': GOOGLEBOT_UA}, '66.249.66.1')
+        executor = verifier.executor
+        verifier.close()
+        assert verifier.executor is None
+        assert executor._shutdown
+
+
+class TestSocketResolver:
+    @patch('dam.crawlers.socket.gethostbyaddr', return_value=('host.example.com', [], []))
+    def test_reverse(self, mock_gethostbyaddr):
+        assert SocketResolver().reverse('1.2.3.4') == 'host.example.com'
+
+    @patch('dam.crawlers.socket.gethostbyaddr', side_effect=socket.herror)
+    def test_reverse_not_found(self, mock_gethostbyaddr):
+        assert SocketResolver().reverse('1.2.3.4') is None
+
+    @patch('dam.crawlers.socket.getaddrinfo', return_value=[
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('1.2.3.4', 0)),
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 0, 0, 0)),
+    ])
+    def test_forward(self, mock_getaddrinfo):
+        assert SocketResolver().forward('host.example.com') == {'1.2.3.4', '::1'}
+
+    @patch('dam.crawlers.socket.getaddrinfo', side_effect=socket.gaierror)
+    def test_forward_not_found(self, mock_getaddrinfo):
+        assert SocketResolver().forward('host.example.com') == set()
+
+
+def test_middleware_exempts_verified_crawler(rf, settings):
+    settings.ALTCHA_VERIFIED_CRAWLERS = {r'Googlebot': ['.googlebot.com', '.google.com']}
+    settings.ALTCHA_CRAWLER_RESOLVER = 'tests.test_crawlers.StubResolver'
+    settings.ALTCHA_PROXY_COUNT = 0
+    AM = AltchaMiddleware(Mock())
+    request = rf.get('/protected/', HTTP_USER_AGENT=GOOGLEBOT_UA, REMOTE_ADDR='66.249.66.1')
+    request.session = {}
+    assert AM.process_request(request).status_code == 302
+    wait(get_crawler_verifier(), '66.249.66.1')
+    assert AM.classify(request) == VERIFIED_CRAWLER
+
+
+def test_requires_trusted_client_ip(settings):
+    settings.ALTCHA_VERIFIED_CRAWLERS = {r'Googlebot': ['.googlebot.com']}
+    with pytest.raises(ImproperlyConfigured, match='ALTCHA_TRUSTED_PROXIES'):
+        get_config()
+    settings.ALTCHA_TRUSTED_PROXIES = ['10.0.0.0/8']
+    assert get_crawler_verifier() is not None
+
+
+def test_get_crawler_verifier(settings):
+    assert get_crawler_verifier() is None
+    settings.ALTCHA_VERIFIED_CRAWLERS = {r'Googlebot': ['.googlebot.com']}
+    settings.ALTCHA_CRAWLER_RESOLVER = 'tests.test_crawlers.StubResolver'
+    settings.ALTCHA_PROXY_COUNT = 0
+    verifier = get_crawler_verifier()
+    assert get_crawler_verifier() is verifier
+    assert isinstance(verifier.resolver, StubResolver)
+    with patch.object(verifier, 'close') as mock_close:
+        # Replacing the configuration closes its verifier.
+        settings.ALTCHA_PROXY_COUNT = 1
+        get_config()
+    mock_close.assert_called_once()
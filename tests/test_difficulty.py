@@ -0,0 +1,96 @@
+from unittest.mock import patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+
+from dam.breaker import guarded_cache
+from dam.difficulty import DifficultyController, get_difficulty_controller
+from dam.steps import run_steps
+
+
+@pytest.fixture
+def controller():
+    cache.clear()
+    return DifficultyController(1000, 10000, smoothing=0.5, issue_rate=10, fail_rate=5,
+                                subnet_rate=4, use_load=False, refresh_interval=0)
+
+
+class TestDifficultyController:
+    def test_cache_guarded(self, controller):
+        assert controller.cache is guarded_cache('default')
+
+    def test_normal_traffic_uses_floor(self, controller):
+        assert [controller.issue('1.2.3.4') for _ in range(3)] == [1000] * 3
+
+    def test_issue_rate_raises_difficulty(self, controller):
+        # Spread requests over subnets so only the global rate is high.
+        levels = [controller.issue(f'10.0.{i}.1') for i in range(40)]
+        assert levels[0] == 1000
+        # Difficulty ramps up smoothly rather than jumping.
+        assert levels == sorted(levels)
+        assert 1000 < levels[20] < levels[-1] <= 4000
+
+    def test_failures_raise_difficulty(self, controller):
+        for _ in range(20):
+            controller.record_failure()
+        controller.refresh()
+        assert controller.level == 2500
+
+    def test_subnet_rate_raises_difficulty_for_subnet(self, controller):
+        levels = [controller.issue('1.2.3.4') for _ in range(8)]
+        assert levels[:4] == [1000] * 4
+        assert levels[7] == 2000
+        # Other subnets still get the global level.
+        assert controller.issue('5.6.7.8') == 1000
+
+    def test_ceiling(self, controller):
+        controller.level = 9000
+        assert controller.max_number(subnet_count=40) == 10000
+
+    @patch('dam.difficulty.os.getloadavg', return_value=(8.0, 0, 0))
+    @patch('dam.difficulty.os.cpu_count', return_value=2)
+    def test_server_load_raises_difficulty(self, mock_cpu_count, mock_getloadavg, controller):
+        controller.use_load = True
+        controller.update({'issued': 0, 'failed': 0})
+        assert controller.level == 2500
+
+    def test_counts_batched_until_refresh(self, controller):
+        controller.refresh_interval = 60
+        controller.issue('1.2.3.4')
+        controller.record_failure()
+        assert controller.pending == {'issued': 1, 'failed': 1}
+        assert cache.get(controller.window_key('issued')) is None
+
+    def test_count(self, controller, settings):
+        # Without a deadline, cache calls are made in this thread, with its (patched) cache.
+        settings.ALTCHA_CACHE_DEADLINE_SECONDS = None
+        assert run_steps(controller.count_steps('counter', 3)) == 3
+        with patch.object(cache, 'add') as mock_add:
+            assert run_steps(controller.count_steps('counter', 2)) == 5
+        # Once the counter exists, counting is a single incr.
+        mock_add.assert_not_called()
+
+    def test_counter_started_by_another_process(self, controller, settings):
+        settings.ALTCHA_CACHE_DEADLINE_SECONDS = None
+        with patch.object(cache, 'incr', side_effect=[ValueError, 5]), \
+                patch.object(cache, 'add', return_value=False):
+            assert run_steps(controller.count_steps('counter', 3)) == 5
+
+    def test_aissue(self, controller):
+        assert async_to_sync(controller.aissue)('1.2.3.4') == 1000
+        assert cache.get(controller.subnet_key('1.2.3.4')) == 1
+        assert cache.get(controller.window_key('issued')) == 1
+
+
+class TestGetDifficultyController:
+    def test_disabled(self, settings):
+        settings.ALTCHA_ADAPTIVE_DIFFICULTY = False
+        assert get_difficulty_controller() is None
+
+    def test_enabled(self, settings):
+        settings.ALTCHA_ADAPTIVE_DIFFICULTY = True
+        controller = get_difficulty_controller()
+        assert controller.floor == settings.ALTCHA_MAX_NUMBER
+        assert controller.ceiling == settings.ALTCHA_MAX_NUMBER * 10
+        assert get_difficulty_controller() is controller
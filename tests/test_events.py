@@ -0,0 +1,129 @@
+import json
+import threading
+from unittest.mock import Mock
+
+import pytest
+from django.test import Client
+
+from dam.events import EventLog, JSONLinesSink, get_event_log
+from dam.metrics import get_metrics
+from dam.middleware import AltchaMiddleware
+
+
+class ListSink:
+    def __init__(self):
+        self.events = []
+
+    def write(self, events):
+        self.events.extend(events)
+
+
+@pytest.fixture
+def events(settings):
+    settings.ALTCHA_EVENTS = True
+    settings.ALTCHA_EVENT_SINK = 'tests.test_events.ListSink'
+    settings.ALTCHA_EVENT_FLUSH_SECONDS = 0.01
+
+    def get_events():
+        event_log = get_event_log()
+        event_log.close()
+        return event_log.sink.events
+
+    return get_events
+
+
+class TestJSONLinesSink:
+    def test_write(self, tmp_path):
+        sink = JSONLinesSink(str(tmp_path / 'events.{pid}.jsonl'))
+        sink.write([{'event': 'solved'}, {'event': 'failed'}])
+        sink.write([{'event': 'replayed'}])
+        sink.close()
+        lines = open(sink.path).read().splitlines()
+        assert [json.loads(line)['event'] for line in lines] == ['solved', 'failed', 'replayed']
+
+    def test_rotate(self, tmp_path):
+        path = str(tmp_path / 'events.jsonl')
+        sink = JSONLinesSink(path, max_bytes=40, backup_count=2)
+        for i in range(4):
+            sink.write([{'event': 'solved', 'i': i}])
+        sink.close()
+        assert json.loads(open(path).read())['i'] == 3
+        assert json.loads(open(f'{path}.1').read())['i'] == 2
+        assert json.loads(open(f'{path}.2').read())['i'] == 1
+        assert not (tmp_path / 'events.jsonl.3').exists()
+
+
+class TestEventLog:
+    def test_batches_written_in_background(self):
+        sink = ListSink()
+        event_log = EventLog(sink, batch_size=2, flush_seconds=0.01)
+        for i in range(5):
+            event_log.emit({'event': 'solved', 'i': i})
+        event_log.close()
+        assert [event['i'] for event in sink.events] == [0, 1, 2, 3, 4]
+        assert not event_log.thread.is_alive()
+
+    def test_full_queue_drops_events(self, settings):
+        settings.ALTCHA_METRICS = True
+        writing = threading.Event()
+        release = threading.Event()
+        sink = Mock(write=Mock(side_effect=lambda batch: writing.set() or release.wait()))
+        event_log = EventLog(sink, queue_size=1, flush_seconds=0.01)
+        event_log.emit({'event': 'solved'})
+        # Wait until the thread is stuck writing the first event.
+        writing.wait(5)
+        event_log.emit({'event': 'failed'})
+        event_log.emit({'event': 'replayed'})
+        event_log.emit({'event': 'replayed'})
+        release.set()
+        event_log.close()
+        assert event_log.dropped == 2
+        assert get_metrics().snapshot()['counters']['dam_events_dropped_total'] == {'replayed': 2}
+        assert sink.write.call_count == 2
+
+    def test_failing_sink_keeps_writing(self):
+        sink = Mock(write=Mock(side_effect=[OSError, None]))
+        event_log = EventLog(sink, batch_size=1, flush_seconds=0.01)
+        event_log.emit({'event': 'solved'})
+        event_log.emit({'event': 'failed'})
+        event_log.close()
+        assert sink.write.call_count == 2
+
+
+def test_disabled_by_default():
+    assert get_event_log() is None
+
+
+def test_closed_on_setting_change(settings, events):
+    event_log = get_event_log()
+    settings.ALTCHA_EVENT_BATCH_SIZE = 10
+    assert event_log.stopped.is_set()
+    assert get_event_log() is not event_log
+
+
+def test_middleware_logs_challenged(rf, events):
+    request = rf.get('/protected/?q=1', HTTP_REFERER='https://example.com/',
+                     HTTP_USER_AGENT='Badbot', REMOTE_ADDR='1.2.3.4')
+    request.session = {}
+    AltchaMiddleware(Mock()).process_request(request)
+    [event] = events()
+    assert event['event'] == 'challenged'
+    assert event['verdict'] == 'challenge'
+    assert event['status'] == 302
+    assert (event['ip'], event['user_agent'], event['path']) == \
+        ('1.2.3.4', 'Badbot', '/protected/')
+    assert (event['next'], event['prev']) == ('/protected/?q=1', 'https://example.com/')
+
+
+@pytest.mark.django_db
+def test_views_log_issued_and_failed(events):
+    client = Client()
+    client.get('/dam/?next=/protected/&prev=https://example.com/')
+    client.post('/dam/submit/', {'altcha': 'garbage'})
+    issued, failed = events()
+    assert issued['event'] == 'issued'
+    assert (issued['next'], issued['prev']) == ('/protected/', 'https://example.com/')
+    assert issued['max_number'] > 0
+    assert failed['event'] == 'failed'
+    assert failed['path'] == '/dam/submit/'
+    assert failed['challenge'] is None
@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+from ipaddress import ip_address
+from unittest.mock import Mock
+
+import pytest
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory
+
+from dam.config import get_config
+from dam.exclusions import WatchedFile, read_lines
+from dam.ipindex import load_index
+from dam.middleware import AltchaMiddleware
+
+
+def write(path, content, mtime):
+    path.write_text(content)
+    # Give each version a distinct mtime, however coarse the filesystem's.
+    os.utime(path, (mtime, mtime))
+
+
+def reloaded(watched):
+    """Start a due check of a watched file, and return its value once the check finishes."""
+    watched.get()
+    if watched.thread is not None:
+        watched.thread.join(5)
+    return watched.value
+
+
+class TestWatchedFile:
+    def test_reloads_changed_file(self, tmp_path):
+        path = tmp_path / 'paths.txt'
+        write(path, '/a\n', 1000)
+        watched = WatchedFile(str(path), read_lines, check_interval=0)
+        assert reloaded(watched) == ['/a']
+        write(path, '/b\n# comment\n\n/c\n', 2000)
+        reloaded(watched)
+        assert watched.get() == ['/b', '/c']
+
+    def test_reload_does_not_block(self, tmp_path):
+        path = tmp_path / 'paths.txt'
+        write(path, '/a\n', 1000)
+        release = threading.Event()
+
+        def slow_load(path):
+            release.wait(5)
+            return read_lines(path)
+
+        watched = WatchedFile(str(path), read_lines, check_interval=0)
+        watched.load = slow_load
+        write(path, '/b\n', 2000)
+        assert watched.get() == ['/a']
+        # Checks aren't started while one is running.
+        assert watched.get() == ['/a']
+        release.set()
+        watched.thread.join(5)
+        assert watched.get() == ['/b']
+
+    def test_checks_at_most_every_interval(self, tmp_path):
+        path = tmp_path / 'paths.txt'
+        write(path, '/a\n', 1000)
+        load = Mock(side_effect=read_lines)
+        watched = WatchedFile(str(path), load, check_interval=60)
+        write(path, '/b\n', 2000)
+        assert watched.get() == ['/a']
+        load.assert_called_once()
+
+    def test_failed_reload_keeps_previous_value(self, tmp_path):
+        path = tmp_path / 'ips.txt'
+        write(path, '10.0.0.0/8\n', 1000)
+        watched = WatchedFile(str(path), load_index, check_interval=0)
+        write(path, 'not an ip\n', 2000)
+        assert ip_address('10.1.1.1') in reloaded(watched)
+        path.unlink()
+        assert ip_address('10.1.1.1') in reloaded(watched)
+        assert ip_address('10.1.1.1') in watched.get()
+
+    def test_missing_file_fails_at_startup(self, tmp_path):
+        with pytest.raises(OSError):
+            WatchedFile(str(tmp_path / 'missing.txt'), read_lines)
+
+
+class TestMiddlewareExclusionFiles:
+    @pytest.fixture
+    def files(self, tmp_path, settings):
+        ips = tmp_path / 'ips.txt'
+        paths = tmp_path / 'paths.txt'
+        headers = tmp_path / 'headers.json'
+        write(ips, '192.0.2.0/24\n', 1000)
+        write(paths, '/feeds/*\n', 1000)
+        write(headers, json.dumps({'User-Agent': r'Friendlybot'}), 1000)
+        settings.ALTCHA_EXCLUDE_IPS_FILE = str(ips)
+        settings.ALTCHA_EXCLUDE_PATHS_FILE = str(paths)
+        settings.ALTCHA_EXCLUDE_HEADERS_FILE = str(headers)
+        settings.ALTCHA_EXCLUDE_FILES_CHECK_SECONDS = 0
+        return ips, paths, headers
+
+    def test_excluded(self, files):
+        AM = AltchaMiddleware(Mock())
+        rf = RequestFactory()
+        assert AM.exclude_ip(rf.get('/', REMOTE_ADDR='192.0.2.1'))
+        assert not AM.exclude_ip(rf.get('/', REMOTE_ADDR='198.51.100.1'))
+        assert AM.exclude_path('/feeds/rss')
+        assert AM.exclude_headers(rf.get('/', HTTP_USER_AGENT='Friendlybot 1.0'))
+
+    def test_reloaded(self, files):
+        ips, paths, headers = files
+        AM = AltchaMiddleware(Mock())
+        rf = RequestFactory()
+        write(ips, '198.51.100.0/24\n', 2000)
+        write(paths, '/news/*\n', 2000)
+        write(headers, json.dumps({'User-Agent': r'Otherbot'}), 2000)
+        config = get_config()
+        for watched in (config.ip_file, config.path_file, config.header_file):
+            reloaded(watched)
+        assert not AM.exclude_ip(rf.get('/', REMOTE_ADDR='192.0.2.1'))
+        assert AM.exclude_ip(rf.get('/', REMOTE_ADDR='198.51.100.1'))
+        assert not AM.exclude_path('/feeds/rss')
+        assert AM.exclude_path('/news/today')
+        assert not AM.exclude_headers(rf.get('/', HTTP_USER_AGENT='Friendlybot 1.0'))
+        assert AM.exclude_headers(rf.get('/', HTTP_USER_AGENT='Otherbot 1.0'))
+
+
+class TestCompileIPsCommand:
+    def test_compile(self, tmp_path, capsys):
+        sources = [tmp_path / 'a.txt', tmp_path / 'b.txt']
+        sources[0].write_text('10.0.0.0/24\n10.0.1.0/24\n')
+        sources[1].write_text('# crawlers\n2001:db8::/32\n')
+        output = tmp_path / 'ips.bin'
+        call_command('dam_compile_ips', *map(str, sources), output=str(output))
+        assert 'Compiled 3 networks into 2 ranges' in capsys.readouterr().out
+        index = load_index(str(output))
+        assert ip_address('10.0.1.1') in index
+        assert ip_address('2001:db8::1') in index
+        assert ip_address('10.0.2.1') not in index
+
+    def test_invalid_source(self, tmp_path):
+        source = tmp_path / 'a.txt'
+        source.write_text('10.0.0.0/24\n10.0.0.1/24\n')
+        with pytest.raises(CommandError, match='Line 2'):
+            call_command('dam_compile_ips', str(source), output=str(tmp_path / 'ips.bin'))
+        assert not (tmp_path / 'ips.bin').exists()
@@ -0,0 +1,98 @@
+from ipaddress import ip_address, ip_network
+
+import pytest
+
+from dam.ipindex import IPIndex, dump_index, load_index, merge_ranges, parse_range, parse_ranges
+
+
+class TestIPIndex:
+    @pytest.mark.parametrize('address, expected', [
+        ('127.0.0.1', True),
+        ('1.2.3.4', True),
+        ('1.1.255.255', False),
+        ('1.3.0.0', False),
+        ('2001:db8::1', True),
+        ('2001:db9::1', False),
+        ('0.0.0.0', False),
+        ('::', False),
+    ])
+    def test_contains(self, address, expected):
+        index = IPIndex([ip_network('1.2.0.0/16'),
+                         ip_network('2001:db8::/32'),
+                         ip_network('127.0.0.1/32')])
+        assert (ip_address(address) in index) == expected
+
+    def test_mixed_families_merged_separately(self):
+        index = IPIndex([ip_network('10.0.0.0/25'),
+                         ip_network('10.0.0.128/25'),
+                         ip_network('10.0.0.0/8'),
+                         ip_network('::/127'),
+                         ip_network('::2/127')])
+        assert len(index) == 2
+        assert list(index.families[4][0]) == [167772160]
+        assert list(index.families[4][1]) == [184549375]
+        assert index.families[6] == ([0], [3])
+
+    def test_empty(self):
+        index = IPIndex()
+        assert not index
+        assert len(index) == 0
+        assert ip_address('1.1.1.1') not in index
+
+
+class TestMergeRanges:
+    def test_merge_ranges(self):
+        ranges = [(10, 20), (0, 5), (6, 8), (15, 30), (40, 50)]
+        assert merge_ranges(ranges) == ([0, 10, 40], [8, 30, 50])
+
+    def test_merge_ranges_contained(self):
+        assert merge_ranges([(0, 100), (10, 20)]) == ([0], [100])
+
+
+class TestParseRange:
+    @pytest.mark.parametrize('cidr', [
+        '10.0.0.0/8', '192.0.2.1', '0.0.0.0/0', '2001:db8::/32', '::1', '::ffff:1.2.3.4/128',
+    ])
+    def test_matches_ip_network(self, cidr):
+        network = ip_network(cidr)
+        assert parse_range(cidr) == (network.version, int(network.network_address),
+                                     int(network.broadcast_address))
+
+    @pytest.mark.parametrize('cidr', [
+        '10.0.0.1/8', '10.0.0.0/33', '10.0.0.0/', '10.0.0.0/x', '10.0.0', 'bogus',
+        '2001:db8::1/32',
+    ])
+    def test_invalid(self, cidr):
+        with pytest.raises(ValueError):
+            parse_range(cidr)
+
+    def test_parse_ranges(self):
+        ranges = parse_ranges(['# crawlers', '', '10.0.0.0/8  # private', '::1'])
+        assert ranges == {4: [(0x0a000000, 0x0affffff)], 6: [(1, 1)]}
+        with pytest.raises(ValueError, match='Line 2'):
+            parse_ranges(['10.0.0.0/8', 'bogus'])
+
+
+@pytest.mark.parametrize('compiled', [False, True], ids=['text', 'compiled'])
+def test_load_index(compiled, tmp_path):
+    networks = ['1.2.0.0/16', '1.3.0.0/16', '2001:db8::/32', '127.0.0.1']
+    path = tmp_path / 'ips'
+    if compiled:
+        with open(path, 'wb') as file:
+            dump_index(IPIndex(map(ip_network, networks)), file)
+    else:
+        path.write_text('\n'.join(networks))
+    index = load_index(str(path))
+    assert len(index) == 3
+    for address, expected in [('1.3.255.255', True), ('1.4.0.0', False), ('127.0.0.1', True),
+                              ('2001:db8::1', True), ('2001:db9::', False), ('::', False)]:
+        assert (ip_address(address) in index) == expected
+
+
+def test_load_empty_compiled_index(tmp_path):
+    path = tmp_path / 'ips'
+    with open(path, 'wb') as file:
+        dump_index(IPIndex(), file)
+    index = load_index(str(path))
+    assert not index
+    assert ip_address('1.2.3.4') not in index
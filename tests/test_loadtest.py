@@ -0,0 +1,65 @@
+from io import StringIO
+
+import pytest
+from django.core.management import CommandError, call_command
+from django.test import Client, override_settings
+
+from dam.loadtest import parse_challenge, percentile, solve
+
+
+@pytest.mark.django_db
+@override_settings(ALTCHA_MAX_NUMBER=1000)
+def test_parse_and_solve_challenge_page():
+    response = Client().get('/dam/')
+    challenge = parse_challenge(response.content.decode())
+    assert challenge['maxnumber'] == 1000
+    response = Client().post('/dam/submit/', {'altcha': solve(challenge)})
+    assert response.status_code == 200
+
+
+def test_parse_challenge_without_challenge():
+    assert parse_challenge('<html></html>') is None
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([], 50) == 0.0
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(ALTCHA_MAX_NUMBER=1000)
+def test_loadtest_command():
+    out = StringIO()
+    call_command('dam_loadtest', challenges=10, processes=2, concurrency=1, replay_ratio=0.5,
+                 expired_ratio=0.2, host='testserver', stdout=out)
+    output = out.getvalue()
+    assert 'Issue: 10 requests' in output
+    assert 'Statuses: 200: 10, 400: 7' in output
+    assert 'Accepted: 10' in output
+    assert 'Expired rejected: 2' in output
+    assert 'Replayed rejected: 5' in output
+    assert 'unexpectedly' not in output
+
+
+@override_settings(ALTCHA_MAX_NUMBER=1000,
+                   SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+def test_loadtest_command_concurrent():
+    # Concurrent requests can lock SQLite's session table, so keep sessions in cookies.
+    out = StringIO()
+    call_command('dam_loadtest', challenges=20, processes=2, concurrency=4, replay_ratio=0.5,
+                 expired_ratio=0.2, host='testserver', stdout=out)
+    output = out.getvalue()
+    assert 'Issue: 20 requests' in output
+    assert 'Statuses: 200: 20, 400: 14' in output
+    assert 'Accepted: 20' in output
+    assert 'Expired rejected: 4' in output
+    assert 'Replayed rejected: 10' in output
+    assert 'unexpectedly' not in output
+
+
+def test_loadtest_command_rejects_bad_counts():
+    with pytest.raises(CommandError):
+        call_command('dam_loadtest', challenges=0)
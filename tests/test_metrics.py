@@ -0,0 +1,175 @@
+import base64
+import json
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+from django.core.cache import cache
+from django.test import Client, RequestFactory
+
+from dam.metrics import Metrics, get_metrics, prometheus_text
+from dam.middleware import AltchaMiddleware
+from dam.signals import (challenge_failed, challenge_issued, challenge_replayed,
+                         challenge_solved)
+
+
+@pytest.fixture
+def metrics(settings):
+    settings.ALTCHA_METRICS = True
+    return get_metrics()
+
+
+class TestMetrics:
+    def test_count(self):
+        metrics = Metrics()
+        metrics.count('dam_requests_total', 'verified')
+        metrics.count('dam_requests_total', 'verified')
+        metrics.count('dam_requests_total', 'challenge', 3)
+        assert metrics.snapshot()['counters'] == {
+            'dam_requests_total': {'verified': 2, 'challenge': 3},
+        }
+
+    def test_observe(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 2.0):
+            metrics.observe('dam_verify_solution_seconds', seconds)
+        histogram = metrics.snapshot()['histograms']['dam_verify_solution_seconds']
+        assert histogram['buckets'] == [(0.1, 2), (1.0, 3), (float('inf'), 4)]
+        assert histogram['count'] == 4
+        assert histogram['sum'] == pytest.approx(2.65)
+
+    def test_threads_recorded_separately(self):
+        metrics = Metrics()
+
+        def record():
+            for _ in range(1000):
+                metrics.count('dam_requests_total', 'verified')
+                metrics.observe('dam_process_request_seconds', 0.001)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot = metrics.snapshot()
+        assert len(metrics.shards) == 4
+        assert snapshot['counters']['dam_requests_total']['verified'] == 4000
+        assert snapshot['histograms']['dam_process_request_seconds']['count'] == 4000
+
+    def test_exporter(self):
+        metrics = Metrics()
+        exported = threading.Event()
+        exporter = Mock(side_effect=lambda snapshot: exported.set())
+        metrics.count('dam_challenges_total', 'issued')
+        metrics.start(exporter, 0.01)
+        assert exported.wait(5)
+        metrics.stop()
+        assert exporter.call_args[0][0]['counters'] == {'dam_challenges_total': {'issued': 1}}
+
+    def test_exporter_error_logged(self, caplog):
+        metrics = Metrics()
+        exported = threading.Event()
+
+        def exporter(snapshot):
+            exported.set()
+            raise ConnectionError
+
+        with caplog.at_level('ERROR', logger='dam.metrics'):
+            metrics.start(exporter, 0.01)
+            assert exported.wait(5)
+            metrics.stop()
+            metrics.thread.join(1)
+        assert 'Could not export metrics.' in caplog.messages
+
+
+def test_prometheus_text():
+    metrics = Metrics(buckets=(0.001,))
+    metrics.count('dam_requests_total', 'verified')
+    metrics.observe('dam_process_request_seconds', 0.0005)
+    text = prometheus_text(metrics.snapshot())
+    assert 'dam_requests_total{verdict="verified"} 1\n' in text
+    assert '# TYPE dam_challenges_total counter\n' in text
+    assert 'dam_process_request_seconds_bucket{le="0.001"} 1\n' in text
+    assert 'dam_process_request_seconds_bucket{le="+Inf"} 1\n' in text
+    assert 'dam_process_request_seconds_count 1\n' in text
+    assert 'dam_create_challenge_seconds' not in text
+
+
+def test_get_metrics_disabled():
+    assert get_metrics() is None
+
+
+def test_middleware_records_verdicts(settings):
+    settings.ALTCHA_EXCLUDE_PATHS = {'/open/'}
+    settings.ALTCHA_METRICS = True
+    metrics = get_metrics()
+    AM = AltchaMiddleware(Mock())
+    request = RequestFactory().get('/open/')
+    request.session = {}
+    AM.process_request(request)
+    request = RequestFactory().get('/protected/')
+    request.session = {}
+    AM.process_request(request)
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['dam_requests_total'] == {'excluded_path': 1, 'challenge': 1}
+    assert snapshot['histograms']['dam_process_request_seconds']['count'] == 2
+
+
+class TestChallengeSignals:
+    def test_issued(self, client, metrics):
+        receiver = Mock()
+        challenge_issued.connect(receiver)
+        try:
+            response = client.get('/dam/')
+        finally:
+            challenge_issued.disconnect(receiver)
+        assert receiver.call_args.kwargs['challenge'] == response.context['challenge']
+        snapshot = metrics.snapshot()
+        assert snapshot['counters']['dam_challenges_total'] == {'issued': 1}
+        assert snapshot['histograms']['dam_create_challenge_seconds']['count'] == 1
+
+    @pytest.mark.django_db
+    @patch('dam.views.verify_solution', return_value=[True, None])
+    def test_solved_and_replayed(self, mock_verify_solution, client, metrics):
+        cache.clear()
+        solved = Mock()
+        replayed = Mock()
+        challenge_solved.connect(solved)
+        challenge_replayed.connect(replayed)
+        payload = {'challenge': 'signals-solved'}
+        data = {'altcha': base64.b64encode(json.dumps(payload).encode()).decode()}
+        try:
+            assert client.post('/dam/submit/', data).status_code == 200
+            # Replayed by another client, which isn't verified yet.
+            assert Client().post('/dam/submit/', data).status_code == 400
+        finally:
+            challenge_solved.disconnect(solved)
+            challenge_replayed.disconnect(replayed)
+        assert solved.call_args.kwargs['payload'] == payload
+        assert replayed.call_args.kwargs['payload'] == payload
+        snapshot = metrics.snapshot()
+        assert snapshot['counters']['dam_challenges_total'] == {'solved': 1, 'replayed': 1}
+        assert snapshot['histograms']['dam_verify_solution_seconds']['count'] == 2
+
+    @patch('dam.views.verify_solution', return_value=[False, 'Invalid signature'])
+    def test_failed(self, mock_verify_solution, client, metrics):
+        receiver = Mock()
+        challenge_failed.connect(receiver)
+        try:
+            assert client.post('/dam/submit/', {'altcha': 'bad'}).status_code == 400
+        finally:
+            challenge_failed.disconnect(receiver)
+        assert receiver.call_args.kwargs['error'] == 'Invalid signature'
+        assert metrics.snapshot()['counters']['dam_challenges_total'] == {'failed': 1}
+
+
+class TestMetricsView:
+    def test_disabled(self, client):
+        assert client.get('/metrics/').status_code == 404
+
+    def test_enabled(self, client, metrics):
+        metrics.count('dam_requests_total', 'verified')
+        response = client.get('/metrics/')
+        assert response.status_code == 200
+        assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+        assert b'dam_requests_total{verdict="verified"} 1' in response.content
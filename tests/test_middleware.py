@@ -1,29 +1,39 @@
+import json
 import re
 from unittest.mock import patch, Mock
 from ipaddress import ip_network
 from time import time
 
+from asgiref.sync import async_to_sync, iscoroutinefunction
 from django.conf import settings
+from django.core.cache import cache
+from django.contrib.sessions.backends.db import SessionStore
+from django.http import HttpResponse
 from django.urls import reverse
 import pytest
 
-from dam.middleware import AltchaMiddleware, make_excluded_headers, make_ip_list
+from dam.tokens import make_token
+from dam.config import get_config
+from dam.matchers import PathMatcher, make_excluded_headers, make_ip_list, meta_key
+from dam.middleware import (AltchaMiddleware, wants_json,
+                            CHALLENGE, EXCLUDED_PATH, IP_CHANGED, VERIFIED)
 
 
 class TestAltchaMiddleware:
-    @patch('dam.middleware.make_ip_list', return_value=[ip_network('1.2.0.0/16'),
-                                                        ip_network('127.0.0.1/32')])
-    @patch('dam.middleware.make_excluded_headers', return_value={})
-    def test_init(self, mock_make_excluded_headers, mock_make_ip_list):
+    def test_init(self, rf, settings):
+        settings.ALTCHA_EXCLUDE_IPS = ['1.2.0.0/16', '127.0.0.1/32']
+        settings.ALTCHA_EXCLUDE_HEADERS = {'User-Agent': 'Friendlybot'}
         mock_get_response = Mock()
         AM = AltchaMiddleware(mock_get_response)
         assert AM.get_response == mock_get_response
-        assert AM.altcha_session_key == settings.ALTCHA_SESSION_KEY
-        assert AM.excluded_paths == settings.ALTCHA_EXCLUDE_PATHS
-        mock_make_ip_list.assert_called_once_with(settings.ALTCHA_EXCLUDE_IPS)
-        assert AM.excluded_ips == mock_make_ip_list.return_value
-        mock_make_excluded_headers.assert_called_once_with(settings.ALTCHA_EXCLUDE_HEADERS)
-        assert AM.excluded_headers == mock_make_excluded_headers.return_value
+        assert AM.exclude_ip(rf.get('/', REMOTE_ADDR='1.2.3.4'))
+        assert AM.exclude_headers(rf.get('/', HTTP_USER_AGENT='friendlybot'))
+
+    def test_settings_read_per_request(self, rf, settings):
+        AM = AltchaMiddleware(Mock())
+        assert not AM.exclude_path('/open/')
+        settings.ALTCHA_EXCLUDE_PATHS = ['/open/']
+        assert AM.exclude_path('/open/')
 
     @pytest.mark.parametrize('current_ip, expected', [
         ('127.0.0.1', True),    # Exact IP excluded
@@ -31,16 +41,27 @@ class TestAltchaMiddleware:
         ('1.1.1.1', False),     # IP before excluded range
         ('2.2.2.2', False),     # IP after excluded range
     ])
-    @patch('dam.middleware.make_ip_list', Mock(return_value=[ip_network('1.2.0.0/16'),
-                                                             ip_network('127.0.0.1/32')]))
-    def test_exclude_ip(self, current_ip, expected, rf):
+    def test_exclude_ip(self, current_ip, expected, rf, settings):
+        settings.ALTCHA_EXCLUDE_IPS = ['1.2.0.0/16', '127.0.0.1/32']
         mock_get_response = Mock()
         AM = AltchaMiddleware(mock_get_response)
         request = rf.get('/dam/')
         request.META['HTTP_X_FORWARDED_FOR'] = current_ip
         assert AM.exclude_ip(request) == expected
 
-    @patch('dam.middleware.make_ip_list', Mock(return_value=[]))
+    @pytest.mark.parametrize('current_ip, expected', [
+        ('10.1.2.3', True),
+        ('2001:db8::1', True),
+        ('11.0.0.0', False),
+        ('2001:db9::1', False),
+    ])
+    def test_exclude_ip_mixed_ip_versions(self, current_ip, expected, rf, settings):
+        settings.ALTCHA_EXCLUDE_IPS = ['2001:db8::/32', '10.0.0.0/8', '10.1.0.0/16']
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/dam/')
+        request.META['HTTP_X_FORWARDED_FOR'] = current_ip
+        assert AM.exclude_ip(request) == expected
+
     def test_exclude_ip_no_excluded_networks(self, rf):
         mock_get_response = Mock()
         AM = AltchaMiddleware(mock_get_response)
@@ -62,11 +83,10 @@ class TestAltchaMiddleware:
         ('1.1.1.1, 2.2.2.2', '3.3.3.3', '1.1.1.1'),
         (None, '3.3.3.3', '3.3.3.3'),
     ])
-    @patch('dam.middleware.ipaddress.ip_address', side_effect=ValueError)
-    @patch('dam.middleware.make_ip_list', Mock(return_value=[ip_network('1.2.0.0/16'),
-                                                             ip_network('127.0.0.1/32')]))
+    @patch('dam.clientip.ipaddress.ip_address', side_effect=ValueError)
     def test_exclude_ip_uses_expected_ip(self, mock_ip_address, forwarded_for, remote_addr,
-                                         expected_ip, rf):
+                                         expected_ip, rf, settings):
+        settings.ALTCHA_EXCLUDE_IPS = ['1.2.0.0/16', '127.0.0.1/32']
         mock_get_response = Mock()
         AM = AltchaMiddleware(mock_get_response)
         request = rf.get('/dam/')
@@ -77,22 +97,30 @@ class TestAltchaMiddleware:
         AM.exclude_ip(request)
         mock_ip_address.assert_called_once_with(expected_ip)
 
-    def test_exclude_headers_gives_match(self, rf):
+    def test_exclude_headers_gives_match(self, rf, settings):
         mock_get_response = Mock()
+        settings.ALTCHA_EXCLUDE_HEADERS = {'User-Agent': r'Friendlybot'}
         AM = AltchaMiddleware(mock_get_response)
-        AM.excluded_headers = {'User-Agent': re.compile(r'Friendlybot')}
-        request = rf.get('/protected/')
-        request.headers = {'User-Agent': 'Mozilla Friendlybot 5.0'}
+        request = rf.get('/protected/', HTTP_USER_AGENT='Mozilla Friendlybot 5.0')
         assert AM.exclude_headers(request)
 
-    def test_exclude_headers_no_match(self, rf):
+    def test_exclude_headers_no_match(self, rf, settings):
         mock_get_response = Mock()
+        settings.ALTCHA_EXCLUDE_HEADERS = {'User-Agent': r'Friendlybot'}
         AM = AltchaMiddleware(mock_get_response)
-        AM.excluded_headers = {'User-Agent': re.compile(r'Friendlybot')}
-        request = rf.get('/protected/')
-        request.headers = {'User-Agent': 'Badbot 5.0'}
+        request = rf.get('/protected/', HTTP_USER_AGENT='Badbot 5.0')
         assert not AM.exclude_headers(request)
 
+    def test_exclude_headers_memoized(self, rf, settings):
+        settings.ALTCHA_EXCLUDE_HEADERS = {'User-Agent': r'Friendlybot',
+                                           'Content-Type': r'^text/plain$'}
+        AM = AltchaMiddleware(Mock())
+        for user_agent in ('Friendlybot', 'Badbot', 'Friendlybot', 'Badbot', ' '):
+            AM.exclude_headers(rf.get('/protected/', HTTP_USER_AGENT=user_agent))
+        assert AM.exclude_headers(rf.post('/protected/', content_type='text/plain'))
+        assert get_config().header_matcher.stats() == {'hits': 2, 'misses': 4,
+                                                       'hit_rate': 2 / 6, 'size': 4}
+
     @pytest.mark.django_db
     @patch('dam.middleware.get_client_ip', return_value='127.0.0.1')
     def test_process_request_user_exempt(self, mock_get_ip, rf):
@@ -124,16 +152,58 @@ class TestAltchaMiddleware:
         reverse('dam:submit_challenge'),    # We never add another challenge to the submission page
         '/open/'                            # Set as an excluded path in the test
     ])
-    def test_process_request_path_exempt(self, path, rf):
+    def test_process_request_path_exempt(self, path, rf, settings):
         mock_get_response = Mock()
+        settings.ALTCHA_EXCLUDE_PATHS = ['/open/']
         AM = AltchaMiddleware(mock_get_response)
-        AM.excluded_paths = ['/open/']
         request = rf.get(path)
         request.session = {}
         assert AM.process_request(request) is None
 
+    def test_process_request_glob_path_exempt(self, rf, settings):
+        settings.ALTCHA_EXCLUDE_PATHS = ['/static/*']
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/static/dam/dam.css')
+        request.session = Mock()
+        assert AM.process_request(request) is None
+        # The session isn't consulted for excluded paths.
+        request.session.get.assert_not_called()
+
+    @pytest.mark.parametrize('session, expected', [
+        ({}, CHALLENGE),
+        ({settings.ALTCHA_SESSION_KEY: time()-100, 'ip': '127.0.0.1'}, CHALLENGE),
+        ({settings.ALTCHA_SESSION_KEY: time()+100, 'ip': '127.0.0.1'}, VERIFIED),
+        ({settings.ALTCHA_SESSION_KEY: time()+100, 'ip': '1.1.1.1'}, IP_CHANGED),
+    ])
+    def test_classify(self, session, expected, rf):
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/protected/', REMOTE_ADDR='127.0.0.1')
+        request.session = session
+        assert AM.classify(request) == expected
+
+    @pytest.mark.parametrize('expires, token_ip, expected', [
+        (time()+100, '127.0.0.1/32', VERIFIED),
+        (time()-100, '127.0.0.1/32', CHALLENGE),
+        (time()+100, '1.1.1.1/32', IP_CHANGED),
+        (None, None, CHALLENGE),
+    ])
+    def test_classify_signed_cookie(self, expires, token_ip, expected, rf, settings):
+        settings.ALTCHA_USE_SIGNED_COOKIE = True
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/protected/', REMOTE_ADDR='127.0.0.1')
+        if expires:
+            request.COOKIES[settings.ALTCHA_COOKIE_NAME] = make_token(expires, token_ip)
+        request.session = Mock()
+        assert AM.classify(request) == expected
+        # The session is never used in signed cookie mode.
+        assert request.session.method_calls == []
+
+    def test_classify_excluded_path(self, rf):
+        AM = AltchaMiddleware(Mock())
+        request = rf.get(reverse('dam:challenge'))
+        assert AM.classify(request) == EXCLUDED_PATH
+
     @pytest.mark.django_db
-    @patch('dam.middleware.make_ip_list', Mock(return_value=[ip_network('127.0.0.1/32')]))
     def test_process_request_ip_exempt(self, rf):
         mock_get_response = Mock()
         AM = AltchaMiddleware(mock_get_response)
@@ -179,12 +249,188 @@ class TestAltchaMiddleware:
                                 f'&prev=https%3A%2F%2Fexample.com%2Fsearch%3Fq%3Dunt')
 
 
+class TestAltchaMiddlewareAsync:
+    @pytest.fixture
+    def mock_get_response(self):
+        async def get_response(request):
+            return HttpResponse('protected')
+        return get_response
+
+    def test_async_mode(self, mock_get_response):
+        AM = AltchaMiddleware(mock_get_response)
+        assert AM.async_mode
+        assert iscoroutinefunction(AM)
+
+    @pytest.mark.parametrize('session, expected', [
+        ({}, CHALLENGE),
+        ({settings.ALTCHA_SESSION_KEY: time()+100, 'ip': '127.0.0.1'}, VERIFIED),
+        ({settings.ALTCHA_SESSION_KEY: time()+100, 'ip': '1.1.1.1'}, IP_CHANGED),
+    ])
+    def test_aclassify(self, session, expected, mock_get_response, async_rf):
+        AM = AltchaMiddleware(mock_get_response)
+        request = async_rf.get('/protected/', REMOTE_ADDR='127.0.0.1')
+        request.session = session
+        assert async_to_sync(AM.aclassify)(request) == expected
+        if expected == IP_CHANGED:
+            assert session == {settings.ALTCHA_SESSION_KEY: 0, 'ip': '127.0.0.1'}
+
+    def test_aclassify_signed_cookie(self, mock_get_response, async_rf, settings):
+        settings.ALTCHA_USE_SIGNED_COOKIE = True
+        AM = AltchaMiddleware(mock_get_response)
+        request = async_rf.get('/protected/', REMOTE_ADDR='127.0.0.1')
+        request.COOKIES[settings.ALTCHA_COOKIE_NAME] = make_token(time()+100, '127.0.0.1/32')
+        assert async_to_sync(AM.aclassify)(request) == VERIFIED
+
+    @pytest.mark.django_db(transaction=True)
+    def test_acall_verified(self, mock_get_response, async_rf):
+        AM = AltchaMiddleware(mock_get_response)
+        request = async_rf.get('/protected/', REMOTE_ADDR='127.0.0.1')
+        request.session = SessionStore()
+        request.session[settings.ALTCHA_SESSION_KEY] = time()+100
+        request.session['ip'] = '127.0.0.1'
+        response = async_to_sync(AM)(request)
+        assert response.content == b'protected'
+
+    def test_acall_challenge(self, mock_get_response, async_rf):
+        AM = AltchaMiddleware(mock_get_response)
+        request = async_rf.get('/protected/')
+        request.session = {}
+        response = async_to_sync(AM)(request)
+        assert response.status_code == 302
+        assert response.url == reverse('dam:challenge')+'?next=%2Fprotected%2F'
+
+    def test_acall_json_challenge(self, mock_get_response, async_rf, settings):
+        settings.ALTCHA_JSON_CHALLENGES = True
+        AM = AltchaMiddleware(mock_get_response)
+        request = async_rf.get('/protected/', headers={'Accept': 'application/json'})
+        request.session = {}
+        response = async_to_sync(AM)(request)
+        assert response.status_code == 401
+        assert set(json.loads(response.content)) == {'algorithm', 'challenge', 'maxnumber',
+                                                     'salt', 'signature'}
+
+
+class TestJSONChallenges:
+    @pytest.mark.parametrize('headers, expected', [
+        ({'HTTP_ACCEPT': 'application/json'}, True),
+        ({'HTTP_ACCEPT': 'application/json, text/plain, */*'}, True),
+        ({'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}, True),
+        ({'HTTP_ACCEPT': 'text/html,application/xhtml+xml,*/*;q=0.8'}, False),
+        ({}, False),
+    ])
+    def test_wants_json(self, headers, expected, rf):
+        assert wants_json(rf.get('/protected/', **headers)) == expected
+
+    def test_challenge(self, rf, settings):
+        settings.ALTCHA_JSON_CHALLENGES = True
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/protected/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.session = {}
+        response = AM.process_request(request)
+        assert response.status_code == 401
+        assert response['WWW-Authenticate'] == 'Altcha'
+        data = json.loads(response.content)
+        assert data['maxnumber'] == settings.ALTCHA_MAX_NUMBER
+        assert data['algorithm'] == 'SHA-256'
+        assert 'CSRF_COOKIE' in request.META
+
+    def test_rate_limited(self, rf, settings):
+        cache.clear()
+        settings.ALTCHA_JSON_CHALLENGES = True
+        settings.ALTCHA_RATE_LIMIT_CHALLENGE = (1, 60)
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/protected/', HTTP_ACCEPT='application/json')
+        request.session = {}
+        assert AM.process_request(request).status_code == 401
+        response = AM.process_request(request)
+        assert response.status_code == 429
+        assert response['Retry-After'] == '60'
+
+    def test_disabled(self, rf):
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/protected/', HTTP_ACCEPT='application/json')
+        request.session = {}
+        assert AM.process_request(request).status_code == 302
+
+
+class TestInlineChallenges:
+    @pytest.mark.parametrize('prerender', [False, True])
+    def test_challenge(self, prerender, rf, settings):
+        settings.ALTCHA_INLINE_CHALLENGES = True
+        settings.ALTCHA_PRERENDER = prerender
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/protected/?search=stuff')
+        request.session = {}
+        response = AM.process_request(request)
+        assert response.status_code == 403
+        assert 'no-store' in response['Cache-Control']
+        content = response.content.decode()
+        assert 'window.location.replace("/protected/?search\\u003Dstuff")' in content
+        assert 'altcha-widget' in content
+
+    def test_status(self, rf, settings):
+        settings.ALTCHA_INLINE_CHALLENGES = True
+        settings.ALTCHA_INLINE_CHALLENGE_STATUS = 200
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/protected/')
+        request.session = {}
+        assert AM.process_request(request).status_code == 200
+
+    def test_rate_limited(self, rf, settings):
+        cache.clear()
+        settings.ALTCHA_INLINE_CHALLENGES = True
+        settings.ALTCHA_RATE_LIMIT_CHALLENGE = (1, 60)
+        AM = AltchaMiddleware(Mock())
+        request = rf.get('/protected/')
+        request.session = {}
+        assert AM.process_request(request).status_code == 403
+        response = AM.process_request(request)
+        assert response.status_code == 429
+        assert 'no-store' in response['Cache-Control']
+
+    def test_async(self, async_rf, settings):
+        settings.ALTCHA_INLINE_CHALLENGES = True
+
+        async def get_response(request):
+            return HttpResponse('protected')
+
+        AM = AltchaMiddleware(get_response)
+        request = async_rf.get('/protected/')
+        request.session = {}
+        response = async_to_sync(AM)(request)
+        assert response.status_code == 403
+        assert b'altcha-widget' in response.content
+
+
+class TestPathMatcher:
+    @pytest.mark.parametrize('path, expected', [
+        ('/open/', True),
+        ('/open/more/', False),
+        ('/static/dam/dam.css', True),
+        ('/static', False),
+        ('/api/v1/items/', True),
+        ('/api/v12/items/', False),
+        ('/protected/', False),
+    ])
+    def test_match(self, path, expected):
+        matcher = PathMatcher({'/open/', '/static/*', '/api/v?/items/'})
+        assert matcher.match(path) == expected
+
+    def test_match_no_patterns(self):
+        matcher = PathMatcher([])
+        assert matcher.pattern is None
+        assert not matcher.match('/open/')
+
+
 class TestMakeIPList:
-    def test_make_ip_list(self, capsys):
-        ip_addresses = ['1.2.0.0/16', '127.0.0.1', 'not_an_ip_address']
+    def test_make_ip_list(self):
+        ip_addresses = ['1.2.0.0/16', '127.0.0.1', '127.0.0.1/32']
         expected = [ip_network('1.2.0.0/16'), ip_network('127.0.0.1')]
-        assert make_ip_list(ip_addresses) == expected
-        assert capsys.readouterr().out.startswith('Could not exclude supplied ip address')
+        assert sorted(make_ip_list(ip_addresses)) == expected
+
+    def test_make_ip_list_invalid(self):
+        with pytest.raises(ValueError):
+            make_ip_list(['1.2.0.0/16', 'not_an_ip_address'])
 
 
 class TestMakeExcludedHeaders:
@@ -193,3 +439,19 @@ class TestMakeExcludedHeaders:
         expected = {'Content-Length': re.compile('^\\d{,4}$', re.IGNORECASE),
                     'User-Agent': re.compile('Somebot 2.0', re.IGNORECASE)}
         assert make_excluded_headers(exclusions) == expected
+
+    def test_make_excluded_headers_combines_header_patterns(self):
+        exclusions = {'User-Agent': r'Somebot', 'user-agent': r'Otherbot'}
+        expected = {'User-Agent': re.compile('(?:Somebot)|(?:Otherbot)', re.IGNORECASE)}
+        assert make_excluded_headers(exclusions) == expected
+
+
+class TestMetaKey:
+    @pytest.mark.parametrize('header, expected', [
+        ('User-Agent', 'HTTP_USER_AGENT'),
+        ('x-forwarded-proto', 'HTTP_X_FORWARDED_PROTO'),
+        ('Content-Type', 'CONTENT_TYPE'),
+        ('content-length', 'CONTENT_LENGTH'),
+    ])
+    def test_meta_key(self, header, expected):
+        assert meta_key(header) == expected
@@ -0,0 +1,121 @@
+from unittest.mock import patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+from dam.breaker import guarded_cache
+from dam.ratelimit import RateLimiter, get_rate_limiter
+
+
+@pytest.fixture
+def limiter():
+    cache.clear()
+    return RateLimiter('test', 3, 60, ipv4_prefix=24, sync_interval=0)
+
+
+class TestRateLimiter:
+    def test_cache_guarded(self, limiter):
+        assert limiter.cache is guarded_cache('default')
+
+    @patch('dam.ratelimit.time.time', return_value=6000.0)
+    def test_allow(self, mock_time, limiter):
+        assert [limiter.allow('1.2.3.4') for _ in range(4)] == [True, True, True, False]
+        # Clients in the same network share a limit.
+        assert not limiter.allow('1.2.3.5')
+        assert limiter.allow('1.2.4.4')
+
+    def test_previous_window_weighted(self, limiter):
+        with patch('dam.ratelimit.time.time', return_value=6000.0):
+            for _ in range(3):
+                limiter.allow('1.2.3.4')
+        # Halfway through the next window, half of the previous count still applies.
+        with patch('dam.ratelimit.time.time', return_value=6090.0):
+            assert [limiter.allow('1.2.3.4') for _ in range(2)] == [True, False]
+        # Windows that don't follow on directly don't carry over.
+        with patch('dam.ratelimit.time.time', return_value=6300.0):
+            assert limiter.allow('1.2.3.4')
+            assert limiter.previous == {}
+
+    @patch('dam.ratelimit.time.time', return_value=6000.0)
+    def test_counts_shared_between_processes(self, mock_time, limiter):
+        other = RateLimiter('test', 3, 60, ipv4_prefix=24, sync_interval=0)
+        limiter.allow('1.2.3.4')
+        limiter.allow('1.2.3.4')
+        assert other.allow('1.2.3.4')
+        assert cache.get(limiter.cache_key('1.2.3.0/24', 100)) == 3
+        # Syncing read back the counts made by the other process.
+        assert not other.allow('1.2.3.4')
+
+    @patch('dam.ratelimit.time.time', return_value=6000.0)
+    def test_counts_batched_between_syncs(self, mock_time, limiter):
+        limiter.sync_interval = 60
+        for _ in range(5):
+            limiter.allow('1.2.3.4')
+        assert limiter.unsynced == {'1.2.3.0/24': 5}
+        assert cache.get(limiter.cache_key('1.2.3.0/24', 100)) is None
+        limiter.sync_interval = 0
+        limiter.flush()
+        assert cache.get(limiter.cache_key('1.2.3.0/24', 100)) == 5
+
+    @patch('dam.ratelimit.time.time', return_value=6000.0)
+    def test_sync_batched(self, mock_time, limiter, settings):
+        # Without a deadline, cache calls are made in this thread, with its (patched) cache.
+        settings.ALTCHA_CACHE_DEADLINE_SECONDS = None
+        limiter.sync_interval = 60
+        for i in range(10):
+            limiter.allow(f'10.0.{i}.1')
+        for _ in range(2):
+            limiter.allow('1.2.3.4')
+        limiter.sync_batch = 4
+        limiter.sync_interval = 0
+        with patch.object(cache, 'get_many', wraps=cache.get_many) as mock_get_many, \
+                patch.object(cache, 'set_many', wraps=cache.set_many) as mock_set_many:
+            limiter.flush()
+        mock_get_many.assert_called_once()
+        mock_set_many.assert_called_once()
+        # The busiest network is synced first, and the rest wait for later syncs.
+        assert cache.get(limiter.cache_key('1.2.3.0/24', 100)) == 2
+        assert len(limiter.unsynced) == 7
+        limiter.flush()
+        limiter.flush()
+        assert limiter.unsynced == {}
+
+    @patch('dam.ratelimit.time.time', return_value=6000.0)
+    def test_networks_capped(self, mock_time, limiter):
+        limiter.sync_interval = 60
+        limiter.max_networks = 10
+        for _ in range(4):
+            limiter.allow('1.2.3.4')
+        for i in range(30):
+            limiter.allow(f'10.0.{i}.1')
+        assert len(limiter.counts) <= 10
+        assert len(limiter.unsynced) <= 10
+        # The busiest network is kept, so it is still limited.
+        assert limiter.counts['1.2.3.0/24'] == 4
+        assert not limiter.allow('1.2.3.4')
+
+    @patch('dam.ratelimit.time.time', return_value=6000.0)
+    def test_aallow(self, mock_time, limiter):
+        assert [async_to_sync(limiter.aallow)('1.2.3.4') for _ in range(4)] == \
+            [True, True, True, False]
+        assert cache.get(limiter.cache_key('1.2.3.0/24', 100)) == 4
+
+
+class TestGetRateLimiter:
+    def test_disabled(self, settings):
+        settings.ALTCHA_RATE_LIMIT_CHALLENGE = None
+        assert get_rate_limiter('challenge') is None
+
+    def test_enabled(self, settings):
+        settings.ALTCHA_RATE_LIMIT_SUBMIT = (10, 30)
+        limiter = get_rate_limiter('submit')
+        assert (limiter.scope, limiter.rate, limiter.window) == ('submit', 10, 30)
+        assert get_rate_limiter('submit') is limiter
+
+    def test_max_networks_validated(self, settings):
+        settings.ALTCHA_RATE_LIMIT_SUBMIT = (10, 30)
+        settings.ALTCHA_RATE_LIMIT_MAX_NETWORKS = 0
+        with pytest.raises(ImproperlyConfigured, match='ALTCHA_RATE_LIMIT_MAX_NETWORKS'):
+            get_rate_limiter('submit')
@@ -0,0 +1,53 @@
+import re
+
+from altcha import Challenge
+from django.shortcuts import render
+
+from dam.config import page_context
+from dam.rendering import (CHALLENGE_TEMPLATE, ChallengePage, get_challenge_page,
+                           render_challenge_page)
+
+
+CSRF_INPUT = re.compile(r'name="csrfmiddlewaretoken" value="\w+"')
+
+
+class TestChallengePage:
+    def test_render_matches_template_render(self, rf):
+        challenge = Challenge('SHA-256', 'abc123', 50000, 'salt?expires=1&some=<thing>', 'sig')
+        next_url = '/protected/?q="quoted"&x=</script>'
+        request = rf.get('/dam/')
+        context = page_context()
+        context.update({'challenge': challenge, 'next_url': next_url})
+        expected = render(request, CHALLENGE_TEMPLATE, context).content
+        content = ChallengePage().render(request, challenge, next_url)
+        assert b'<h1><img src=""> testserver</h1>' in content
+        assert CSRF_INPUT.sub('', content.decode()) == CSRF_INPUT.sub('', expected.decode())
+
+    def test_render_sets_csrf_token(self, rf):
+        challenge = Challenge('SHA-256', 'abc123', 50000, 'salt', 'sig')
+        request = rf.get('/dam/')
+        ChallengePage().render(request, challenge, '/')
+        assert request.META['CSRF_COOKIE_NEEDS_UPDATE']
+
+    def test_get_challenge_page_reset_on_setting_change(self, settings):
+        page = get_challenge_page()
+        assert get_challenge_page() is page
+        settings.ALTCHA_MESSAGE = 'Changed message'
+        page = get_challenge_page()
+        assert b'Changed message' in b''.join(page.segments)
+
+
+def test_inline_css(settings, rf):
+    settings.ALTCHA_INLINE_CSS = True
+    challenge = Challenge('SHA-256', 'abc123', 50000, 'salt', 'sig')
+    content = get_challenge_page().render(rf.get('/dam/'), challenge, '/')
+    assert b'<style>:root {' in content
+    assert b'rel="stylesheet"' not in content
+
+
+def test_preload_js(settings, rf):
+    settings.ALTCHA_PRELOAD_JS = True
+    challenge = Challenge('SHA-256', 'abc123', 50000, 'salt', 'sig')
+    response = render_challenge_page(rf.get('/dam/'), challenge, '/')
+    assert b'<link rel="modulepreload" href="/static/altcha/altcha.min.js">' in response.content
+    assert response['Link'] == '</static/altcha/altcha.min.js>; rel=modulepreload'
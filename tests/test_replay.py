@@ -0,0 +1,100 @@
+import asyncio
+import base64
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+
+from dam.replay import ReplayStore, get_replay_store
+from dam.views import submit_challenge
+
+
+@pytest.fixture
+def store():
+    cache.clear()
+    return ReplayStore(local_size=2, timeout=60)
+
+
+class TestReplayStore:
+    def test_add(self, store):
+        assert store.add('abc')
+        assert not store.add('abc')
+        assert cache.get('abc') == 't'
+
+    def test_aadd(self, store):
+        assert async_to_sync(store.aadd)('abc')
+        assert not async_to_sync(store.aadd)('abc')
+        assert not store.add('abc')
+
+    def test_replay_rejected_locally(self, store):
+        store.add('abc')
+        with patch.object(store.cache.cache, 'add') as mock_add:
+            assert not store.add('abc')
+            mock_add.assert_not_called()
+
+    def test_replay_from_other_process_remembered(self, store):
+        cache.set('abc', 't')
+        assert not store.add('abc')
+        assert 'abc' in store.seen
+
+    def test_local_tier_bounded(self, store):
+        for challenge in ('a', 'b', 'c'):
+            store.add(challenge)
+        assert list(store.seen) == ['b', 'c']
+        # Evicted entries are still rejected by the cache.
+        assert not store.add('a')
+
+    def test_local_entries_expire(self, store):
+        store.add('abc')
+        with patch('dam.replay.time.monotonic', return_value=store.seen['abc'] + 1):
+            assert not store.seen_locally('abc')
+        assert 'abc' not in store.seen
+
+    def test_clear(self, store):
+        store.add('abc')
+        store.clear()
+        assert not store.seen
+
+    def test_concurrent_adds_accept_once(self, store):
+        barrier = threading.Barrier(16)
+
+        def add(challenge):
+            barrier.wait()
+            return store.add(challenge)
+
+        for challenge in ('x', 'y', 'z'):
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                results = list(executor.map(add, [challenge] * 16))
+            assert results.count(True) == 1
+
+
+class TestGetReplayStore:
+    def test_configured_store(self, settings):
+        settings.ALTCHA_REPLAY_LOCAL_SIZE = 5
+        store = get_replay_store()
+        assert isinstance(store, ReplayStore)
+        assert store.local_size == 5
+        assert get_replay_store() is store
+
+
+@patch('dam.views.verify_solution', return_value=[True, None])
+def test_parallel_submissions_accepted_once(mock_verify_solution, async_rf):
+    """Of many parallel submissions of the same solution, exactly one succeeds."""
+    cache.clear()
+    get_replay_store().clear()
+    payload = base64.b64encode(json.dumps({'challenge': 'parallel'}).encode()).decode()
+
+    async def submit():
+        request = async_rf.post('/dam/submit/', {'altcha': payload})
+        request.session = {}
+        response = await submit_challenge(request)
+        return response.status_code
+
+    async def submit_all():
+        return await asyncio.gather(*[submit() for _ in range(20)])
+
+    assert sorted(async_to_sync(submit_all)()) == [200] + [400] * 19
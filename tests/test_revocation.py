@@ -0,0 +1,209 @@
+import asyncio
+import time
+from io import StringIO
+from unittest.mock import Mock, call, patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+
+from dam.middleware import GENERATION_SESSION_KEY, REVOKED, VERIFIED, AltchaMiddleware
+from dam.revocation import GLOBAL_KEY, SUBNETS_KEY, Generations, get_generations, subnet_key
+from dam.tokens import load_token, make_token
+
+
+@pytest.fixture
+def generations():
+    cache.clear()
+    return Generations(check_interval=0)
+
+
+@pytest.fixture
+def revocation(settings):
+    cache.clear()
+    settings.ALTCHA_REVOCATION = True
+    settings.ALTCHA_REVOCATION_CHECK_SECONDS = 0
+    return get_generations()
+
+
+class TestGenerations:
+    def test_unstamped_verifications_not_current(self, generations):
+        assert not generations.is_current(None, '1.2.3.4')
+        assert generations.is_current(generations.stamp('1.2.3.4'), '1.2.3.4')
+
+    def test_revoke_all(self, generations):
+        stamp = generations.stamp('1.2.3.4')
+        generations.revoke_all()
+        assert not generations.is_current(stamp, '1.2.3.4')
+        new_stamp = generations.stamp('1.2.3.4')
+        assert new_stamp != stamp
+        assert generations.is_current(new_stamp, '1.2.3.4')
+
+    def test_revoke_subnet(self, generations):
+        stamp = generations.stamp('1.2.3.4')
+        other_stamp = generations.stamp('5.6.7.8')
+        assert generations.revoke_subnet('1.2.3.99') == '1.2.3.0/24'
+        assert not generations.is_current(stamp, '1.2.3.4')
+        assert generations.is_current(other_stamp, '5.6.7.8')
+        new_stamp = generations.stamp('1.2.3.4')
+        assert new_stamp.split('.')[0] == stamp.split('.')[0]
+        assert generations.is_current(new_stamp, '1.2.3.4')
+
+    def test_subnet_revocations_kept_separately(self, generations):
+        stamps = {ip: generations.stamp(ip) for ip in ('1.2.3.4', '5.6.7.8')}
+        generations.revoke_subnet('1.2.3.4')
+        generations.revoke_subnet('5.6.7.8')
+        assert cache.get(subnet_key('1.2.3.0/24')) and cache.get(subnet_key('5.6.7.0/24'))
+        assert not any(generations.is_current(stamp, ip) for ip, stamp in stamps.items())
+
+    def test_expired_subnet_revocation(self, generations):
+        generations.revoke_subnet('1.2.3.4')
+        new_stamp = generations.stamp('1.2.3.4')
+        cache.delete_many([SUBNETS_KEY, subnet_key('1.2.3.0/24')])
+        # Verifications made since the revocation stay valid once it expires.
+        assert generations.is_current(new_stamp, '1.2.3.4')
+
+    def test_async(self, generations):
+        stamp = async_to_sync(generations.astamp)('2001:db8::1')
+        assert async_to_sync(generations.ais_current)(stamp, '2001:db8::1')
+        generations.revoke_subnet('2001:db8::2')
+        assert not async_to_sync(generations.ais_current)(stamp, '2001:db8::1')
+
+    def test_concurrent_async_first_load(self, generations):
+        async def check_concurrently():
+            return await asyncio.gather(*(generations.ais_current('0.0', '1.2.3.4')
+                                          for _ in range(5)))
+        # Nothing blocks the event loop while the first load is under way.
+        assert async_to_sync(check_concurrently)() == [False] * 5
+        assert generations.current is not None
+
+    def test_lost_generations_revoke_stamped_verifications(self, generations):
+        generations.revoke_all()
+        generations.revoke_all()
+        stamp = generations.stamp('1.2.3.4')
+        cache.clear()
+        assert not generations.is_current(stamp, '1.2.3.4')
+        # Revoking after the loss doesn't bring back any earlier generation.
+        generations.revoke_all()
+        assert not generations.is_current(stamp, '1.2.3.4')
+        assert not generations.is_current(None, '1.2.3.4')
+
+    @pytest.mark.parametrize('stamp', ['x', '1', '1.x', '0.0.0'])
+    def test_malformed_stamp(self, generations, stamp):
+        assert not generations.is_current(stamp, '1.2.3.4')
+
+    def test_local_copy_reloaded_at_most_every_interval(self, settings):
+        # Without a deadline, cache calls are made in this thread, with its (patched) cache.
+        settings.ALTCHA_CACHE_DEADLINE_SECONDS = None
+        generations = Generations(check_interval=60)
+        stamp = generations.stamp('1.2.3.4')
+        with patch.object(cache, 'get_many', wraps=cache.get_many) as mock_get_many:
+            for _ in range(5):
+                generations.is_current(stamp, '1.2.3.4')
+            mock_get_many.assert_not_called()
+            with patch('dam.revocation.time.monotonic', return_value=time.monotonic() + 60):
+                generations.is_current(stamp, '1.2.3.4')
+            mock_get_many.assert_called_once()
+
+    def test_subnets_only_looked_up_after_subnet_revocation(self, generations, settings):
+        settings.ALTCHA_CACHE_DEADLINE_SECONDS = None
+        stamp = generations.stamp('1.2.3.4')
+        lookup = call(subnet_key('1.2.3.0/24'), 0)
+        with patch.object(cache, 'get', wraps=cache.get) as mock_get:
+            generations.is_current(stamp, '1.2.3.4')
+            assert lookup not in mock_get.call_args_list
+            generations.revoke_subnet('5.6.7.8')
+            generations.is_current(stamp, '1.2.3.4')
+            assert lookup in mock_get.call_args_list
+
+    def test_subnet_looked_up_once_per_revocation(self, generations, settings):
+        settings.ALTCHA_CACHE_DEADLINE_SECONDS = None
+        generations.revoke_subnet('5.6.7.8')
+        stamp = generations.stamp('1.2.3.4')
+        lookup = call(subnet_key('1.2.3.0/24'), 0)
+        with patch.object(cache, 'get', wraps=cache.get) as mock_get:
+            # The generations are reloaded on every check, but the subnet isn't looked up again.
+            for _ in range(3):
+                assert generations.is_current(stamp, '1.2.3.4')
+            assert lookup not in mock_get.call_args_list
+            generations.revoke_subnet('1.2.3.4')
+            assert not generations.is_current(stamp, '1.2.3.4')
+            assert mock_get.call_args_list.count(lookup) == 1
+
+
+def test_token_generation():
+    token = make_token(1234, '2001:db8::1/128', '3.1')
+    assert load_token(token) == (1234, '2001:db8::1/128', '3.1')
+    token = make_token(1234, '1.2.3.4/32', '3.1')
+    assert load_token(token) == (1234, '1.2.3.4/32', '3.1')
+
+
+def test_disabled_by_default():
+    assert get_generations() is None
+
+
+class TestMiddleware:
+    def test_session_verification_revoked(self, rf, revocation):
+        request = rf.get('/protected/', REMOTE_ADDR='1.2.3.4')
+        request.session = {'altcha_verified': time.time() + 60, 'ip': '1.2.3.4',
+                           GENERATION_SESSION_KEY: revocation.stamp('1.2.3.4')}
+        AM = AltchaMiddleware(Mock())
+        assert AM.classify(request) == VERIFIED
+        revocation.revoke_subnet('1.2.3.4')
+        assert AM.classify(request) == REVOKED
+        assert request.session['altcha_verified'] == 0
+        assert AM.process_request(request).status_code == 302
+
+    def test_async_session_verification_revoked(self, rf, revocation):
+        request = rf.get('/protected/', REMOTE_ADDR='1.2.3.4')
+        request.session = {'altcha_verified': time.time() + 60, 'ip': '1.2.3.4',
+                           GENERATION_SESSION_KEY: revocation.stamp('1.2.3.4')}
+        AM = AltchaMiddleware(Mock())
+        assert async_to_sync(AM.aclassify)(request) == VERIFIED
+        revocation.revoke_all()
+        assert async_to_sync(AM.aclassify)(request) == REVOKED
+
+    def test_signed_cookie_verification_revoked(self, rf, revocation, settings):
+        settings.ALTCHA_USE_SIGNED_COOKIE = True
+        request = rf.get('/protected/', REMOTE_ADDR='1.2.3.4')
+        request.COOKIES['altcha_verified'] = make_token(time.time() + 60, '1.2.3.4/32',
+                                                        revocation.stamp('1.2.3.4'))
+        AM = AltchaMiddleware(Mock())
+        assert AM.classify(request) == VERIFIED
+        revocation.revoke_all()
+        assert AM.classify(request) == REVOKED
+        assert async_to_sync(AM.aclassify)(request) == REVOKED
+
+
+@pytest.mark.django_db
+@patch('dam.views.verify_solution', return_value=[True, None])
+def test_submit_stamps_verification(mock_verify_solution, client, revocation):
+    response = client.post('/dam/submit/', {'altcha': 'eyJjaGFsbGVuZ2UiOiAic3RhbXAifQ=='})
+    assert response.status_code == 200
+    stamp = client.session[GENERATION_SESSION_KEY]
+    assert revocation.is_current(stamp, '127.0.0.1')
+    revocation.revoke_all()
+    # A revoked client must solve again, rather than being told it's verified.
+    client.post('/dam/submit/', {'altcha': 'eyJjaGFsbGVuZ2UiOiAic3RhbXAyIn0='})
+    assert mock_verify_solution.call_count == 2
+    assert client.session[GENERATION_SESSION_KEY] != stamp
+
+
+class TestRevokeCommand:
+    def test_revoke(self, revocation):
+        out = StringIO()
+        call_command('dam_revoke', '--all', '1.2.3.4', stdout=out)
+        assert out.getvalue() == ('Revoked every verification.\n'
+                                  'Revoked verifications in 1.2.3.0/24.\n')
+        global_generation, subnet_generation = revocation.stamp('1.2.3.4').split('.')
+        assert global_generation == str(cache.get(GLOBAL_KEY))
+        assert subnet_generation == str(cache.get(subnet_key('1.2.3.0/24')))
+
+    def test_revoke_requires_target(self, revocation):
+        with pytest.raises(CommandError):
+            call_command('dam_revoke')
+
+    def test_revoke_requires_revocation(self):
+        with pytest.raises(CommandError):
+            call_command('dam_revoke', '--all')
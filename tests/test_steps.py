@@ -0,0 +1,61 @@
+import pytest
+from asgiref.sync import async_to_sync
+
+from dam.steps import Deferred, arun_steps, run_steps
+
+
+def fail(value):
+    raise ValueError(value)
+
+
+async def afail(value):
+    raise ValueError(value)
+
+
+async def adouble(value):
+    return value * 2
+
+
+def double_then_recover(value):
+    doubled = yield Deferred(lambda value: value * 2, adouble, value)
+    try:
+        yield Deferred(fail, afail, doubled)
+    except ValueError as err:
+        # The call's exception is raised at the yield, so it can be handled.
+        return f'recovered {err}'
+
+
+def unhandled():
+    yield Deferred(fail, afail, 'unhandled')
+
+
+def no_calls():
+    return 'done'
+    yield
+
+
+@pytest.mark.parametrize('run', [run_steps, async_to_sync(arun_steps)], ids=['sync', 'async'])
+class TestRunSteps:
+    def test_results_sent_back(self, run):
+        assert run(double_then_recover(2)) == 'recovered 4'
+
+    def test_unhandled_exception_raised(self, run):
+        with pytest.raises(ValueError, match='unhandled'):
+            run(unhandled())
+
+    def test_no_calls(self, run):
+        assert run(no_calls()) == 'done'
+
+
+def test_sync_and_async_calls_made():
+    calls = []
+
+    async def acall(value):
+        calls.append(('async', value))
+
+    def steps():
+        yield Deferred(lambda value: calls.append(('sync', value)), acall, 1)
+
+    run_steps(steps())
+    async_to_sync(arun_steps)(steps())
+    assert calls == [('sync', 1), ('async', 1)]
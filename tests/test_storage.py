@@ -0,0 +1,62 @@
+import gzip
+from unittest.mock import patch
+
+import pytest
+from django.core.management import call_command
+
+from dam import storage
+
+
+@pytest.fixture
+def collect(settings, tmp_path):
+    def collect(backend):
+        settings.STATIC_ROOT = tmp_path
+        settings.STORAGES = {'staticfiles': {'BACKEND': f'dam.storage.{backend}'}}
+        call_command('collectstatic', interactive=False, verbosity=0)
+        return tmp_path
+    return collect
+
+
+def test_compressed_manifest_storage(collect):
+    static_root = collect('CompressedManifestStaticFilesStorage')
+    hashed_js = [path for path in (static_root / 'altcha').glob('altcha.min.*.js')
+                 if path.name != 'altcha.min.js']
+    assert len(hashed_js) == 1
+    for path in (static_root / 'altcha' / 'altcha.min.js', hashed_js[0]):
+        compressed = path.with_name(f'{path.name}.gz')
+        assert gzip.decompress(compressed.read_bytes()) == path.read_bytes()
+    assert list((static_root / 'dam').glob('dam.*.css.gz'))
+    # Only text files are compressed.
+    assert not list(static_root.glob('**/*.ABOUT.gz'))
+
+
+def test_compressed_storage(collect):
+    static_root = collect('CompressedStaticFilesStorage')
+    assert (static_root / 'altcha' / 'altcha.min.js.gz').exists()
+    assert (static_root / 'dam' / 'dam.css.gz').exists()
+
+
+def test_compression_is_deterministic(collect):
+    static_root = collect('CompressedStaticFilesStorage')
+    first = (static_root / 'dam' / 'dam.css.gz').read_bytes()
+    static_root = collect('CompressedStaticFilesStorage')
+    assert (static_root / 'dam' / 'dam.css.gz').read_bytes() == first
+
+
+def test_brotli_variants(collect):
+    brotli = pytest.importorskip('brotli')
+    static_root = collect('CompressedStaticFilesStorage')
+    path = static_root / 'dam' / 'dam.css'
+    assert brotli.decompress(path.with_name('dam.css.br').read_bytes()) == path.read_bytes()
+
+
+def test_no_brotli_variants_without_brotli(collect):
+    with patch.object(storage, 'brotli', None):
+        static_root = collect('CompressedStaticFilesStorage')
+    assert not list(static_root.glob('**/*.br'))
+
+
+def test_small_files_not_compressed(collect):
+    with patch.object(storage.CompressedFilesMixin, 'compress_min_size', 10 ** 6):
+        static_root = collect('CompressedStaticFilesStorage')
+    assert not list(static_root.glob('**/*.gz'))
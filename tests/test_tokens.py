@@ -0,0 +1,67 @@
+import ipaddress
+
+import pytest
+from django.http import HttpResponse
+
+from dam.tokens import client_binding, ip_binding, load_token, make_token, set_token_cookie
+
+
+class TestIPBinding:
+    @pytest.mark.parametrize('client_ip, ipv4_prefix, ipv6_prefix, expected', [
+        ('1.2.3.4', 32, 128, '1.2.3.4/32'),
+        ('1.2.3.4', 24, 128, '1.2.3.0/24'),
+        ('2001:db8::1', 32, 64, '2001:db8::/64'),
+    ])
+    def test_ip_binding(self, client_ip, ipv4_prefix, ipv6_prefix, expected, settings):
+        settings.ALTCHA_IPV4_BIND_PREFIX = ipv4_prefix
+        settings.ALTCHA_IPV6_BIND_PREFIX = ipv6_prefix
+        assert ip_binding(ipaddress.ip_address(client_ip)) == expected
+
+    @pytest.mark.parametrize('client_ip, expected', [
+        ('1.2.3.4', '1.2.3.0/24'),
+        ('not an ip', 'not an ip'),
+    ])
+    def test_client_binding(self, client_ip, expected, rf, settings):
+        settings.ALTCHA_IPV4_BIND_PREFIX = 24
+        assert client_binding(rf.get('/', REMOTE_ADDR=client_ip)) == expected
+
+
+class TestTokens:
+    def test_make_and_load_token(self):
+        token = make_token(1234.5, '2001:db8::1/128')
+        assert token.startswith('0:1234:2001:db8::1/128:')
+        assert load_token(token) == (1234, '2001:db8::1/128', None)
+
+    @pytest.mark.parametrize('token', [
+        '0:1234:1.2.3.4/32:badsignature',
+        'unknownkey:1234:1.2.3.4/32:badsignature',
+        'garbage',
+    ])
+    def test_load_token_rejects_invalid_tokens(self, token):
+        assert load_token(token) is None
+
+    def test_load_token_rejects_tampered_token(self):
+        token = make_token(1234, '1.2.3.4/32')
+        assert load_token(token.replace(':1234:', ':9999:')) is None
+
+    def test_key_rotation(self, settings):
+        settings.ALTCHA_TOKEN_KEYS = {'old': 'oldsecret', 'new': 'newsecret'}
+        settings.ALTCHA_TOKEN_KEY_ID = 'old'
+        old_token = make_token(1234, '1.2.3.4/32')
+        settings.ALTCHA_TOKEN_KEY_ID = 'new'
+        new_token = make_token(1234, '1.2.3.4/32')
+        assert new_token.startswith('new:')
+        # Tokens signed with either known key still verify.
+        assert load_token(old_token) == load_token(new_token) == (1234, '1.2.3.4/32', None)
+        # Retiring a key invalidates its tokens.
+        settings.ALTCHA_TOKEN_KEYS = {'new': 'newsecret'}
+        assert load_token(old_token) is None
+
+    def test_set_token_cookie(self, settings):
+        settings.ALTCHA_COOKIE_NAME = 'dam_token'
+        response = HttpResponse()
+        set_token_cookie(response, 100, '1.2.3.4/32')
+        cookie = response.cookies['dam_token']
+        assert load_token(cookie.value) == (100, '1.2.3.4/32', None)
+        assert cookie['max-age'] == settings.ALTCHA_AUTH_EXPIRE_MINUTES * 60
+        assert cookie['httponly']
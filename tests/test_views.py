@@ -1,16 +1,24 @@
 from unittest.mock import patch
+import asyncio
 import base64
 import json
+import time
 
 import pytest
+from asgiref.sync import async_to_sync
 from django.conf import settings
 from django.core.cache import cache
+from django.test import Client, override_settings
+
+from dam.challenges import ChallengePool
+from dam.tokens import load_token, make_token
+from dam.views import adam_check, dam_check
 
 
 class TestDamChallengeView:
     """Unit tests for dam_challenge view."""
 
-    def test_get_request_serves_challenge_page(self, client):
+    def test_get_request_serves_challenge_page(self, client, settings):
         """A GET request should serve the challenge page."""
         settings.ALTCHA_SALT_PARAMS = {'some': 'thing'}
         response = client.get('/dam/?next=%2Fprotected%2F')
@@ -25,12 +33,76 @@ class TestDamChallengeView:
         assert response.context['site_icon_url'] == settings.ALTCHA_SITE_ICON_URL
         assert response.context['next_url'] == '/protected/'
 
+    def test_get_request_uses_challenge_pool(self, client, settings):
+        """Challenges come from the pool when it is enabled."""
+        settings.ALTCHA_POOL_REFILL_THREAD = False
+        cache.clear()
+        pool = ChallengePool(1)
+        pool.refill()
+        with patch('dam.challenges.get_challenge_pool', return_value=pool), \
+                patch('dam.challenges.new_challenge') as mock_new_challenge:
+            response = client.get('/dam/')
+            assert response.context['challenge'] is not None
+            mock_new_challenge.assert_not_called()
+            # An empty pool falls back to creating a challenge.
+            response = client.get('/dam/')
+            assert response.context['challenge'] == mock_new_challenge.return_value
+
+    @patch('dam.challenges.get_challenge_pool')
+    def test_get_request_adaptive_difficulty(self, mock_get_challenge_pool, client, settings):
+        """An adaptive difficulty above the default skips the pool."""
+        settings.ALTCHA_ADAPTIVE_DIFFICULTY = True
+        with patch('dam.difficulty.DifficultyController.max_number', return_value=123456):
+            response = client.get('/dam/')
+        assert response.context['challenge'].max_number == 123456
+        mock_get_challenge_pool.return_value.take_steps.assert_not_called()
+
+    def test_get_request_rate_limited(self, client, settings):
+        """Clients over the challenge rate limit get a 429."""
+        cache.clear()
+        settings.ALTCHA_RATE_LIMIT_CHALLENGE = (2, 60)
+        assert [client.get('/dam/').status_code for _ in range(3)] == [200, 200, 429]
+        response = client.get('/dam/')
+        assert response['Retry-After'] == '60'
+
+    def test_get_request_prerendered(self, client, settings):
+        """The pre-rendered page is filled in instead of rendering the template."""
+        settings.ALTCHA_PRERENDER = True
+        client.get('/dam/')
+        response = client.get('/dam/?next=%2Fprotected%2F')
+        assert response.status_code == 200
+        # The template was only rendered for the first request.
+        assert response.templates == []
+        assert response['Content-Type'] == 'text/html; charset=utf-8'
+        content = response.content.decode()
+        assert 'testserver' in content
+        assert 'window.location.replace("/protected/")' in content
+        assert settings.CSRF_COOKIE_NAME in response.cookies
+
+    def test_post_request_not_allowed(self, client):
+        """Only GET requests are allowed."""
+        response = client.post('/dam/')
+        assert response.status_code == 405
+        assert response['Allow'] == 'GET'
+
+    def test_async_get_request_serves_challenge_page(self, async_client):
+        """The view is served natively by the async client."""
+        response = async_to_sync(async_client.get)('/dam/?next=%2Fprotected%2F')
+        assert response.status_code == 200
+        assert response.context['next_url'] == '/protected/'
+
 
 @pytest.mark.django_db
 class TestSubmitChallengeView:
     """Unit tests for submit_challenge view."""
 
-    @patch('dam.views.settings.ALTCHA_FAIL_MESSAGE', 'Sorry, please try again.')
+    def test_get_request_not_allowed(self, client):
+        """Only POST requests are allowed."""
+        response = client.get('/dam/submit/')
+        assert response.status_code == 405
+        assert response['Allow'] == 'POST'
+
+    @override_settings(ALTCHA_FAIL_MESSAGE='Sorry, please try again.')
     @patch('dam.views.verify_solution', return_value=[False, None])
     def test_post_request_fails_with_no_payload(self, mock_verify_solution, client):
         """A POST request with no payload should return a 400."""
@@ -58,6 +130,26 @@ class TestSubmitChallengeView:
         assert client.session[settings.ALTCHA_SESSION_KEY] == expected_auth_expiration
         assert cache.get(payload['challenge'])
 
+    @patch('dam.views.verify_solution', return_value=[False, None])
+    def test_post_request_rate_limited(self, mock_verify_solution, client, settings):
+        """Clients over the submission rate limit get a 429 without verifying the solution."""
+        cache.clear()
+        settings.ALTCHA_RATE_LIMIT_SUBMIT = (1, 60)
+        assert client.post('/dam/submit/', {'altcha': 'bad'}).status_code == 400
+        response = client.post('/dam/submit/', {'altcha': 'bad'})
+        assert response.status_code == 429
+        assert response.json() == {'error': 'Too many requests.'}
+        mock_verify_solution.assert_called_once()
+
+    @patch('dam.views.verify_solution', return_value=[False, None])
+    def test_post_request_failure_recorded(self, mock_verify_solution, client, settings):
+        """Failed submissions count toward adaptive difficulty."""
+        settings.ALTCHA_ADAPTIVE_DIFFICULTY = True
+        with patch('dam.difficulty.DifficultyController.record_failure') as mock_record_failure:
+            response = client.post('/dam/submit/', {'altcha': 'bad'})
+        assert response.status_code == 400
+        mock_record_failure.assert_called_once_with()
+
     @patch('dam.views.verify_solution', return_value=[False, None])
     def test_post_request_invalid_challenge_response(self, mock_verify_solution, client):
         """POST request with invalid challenge solution should return a 400 and failure message."""
@@ -87,6 +179,33 @@ class TestSubmitChallengeView:
         assert response.content.decode() == '{"error": "Challenge failed or no longer valid."}'
         assert client.session.get(settings.ALTCHA_SESSION_KEY) is None
 
+    @patch('dam.views.verify_solution', return_value=[True, None])
+    def test_post_request_solution_header(self, mock_verify_solution, client, settings):
+        """The solution may be sent in the X-Altcha-Solution header."""
+        settings.ALTCHA_USE_SIGNED_COOKIE = True
+        payload = {'challenge': 'solutionheader'}
+        payload_b64_encoded = base64.b64encode(json.dumps(payload).encode()).decode()
+        response = client.post('/dam/submit/', HTTP_X_ALTCHA_SOLUTION=payload_b64_encoded)
+        assert response.status_code == 200
+        mock_verify_solution.assert_called_once_with(payload, settings.ALTCHA_HMAC_KEY,
+                                                     check_expires=True)
+
+    @patch('dam.views.verify_solution', return_value=[True, None])
+    def test_post_request_signed_cookie(self, mock_verify_solution, client, settings):
+        """Valid POST request in signed cookie mode sets a token instead of using the session."""
+        settings.ALTCHA_USE_SIGNED_COOKIE = True
+        payload = {'challenge': 'signedcookie'}
+        payload_b64_encoded = base64.b64encode(json.dumps(payload).encode()).decode()
+        response = client.post('/dam/submit/', {'altcha': payload_b64_encoded})
+        assert response.status_code == 200
+        token = response.cookies[settings.ALTCHA_COOKIE_NAME].value
+        assert load_token(token)[1] == '127.0.0.1/32'
+        assert client.session.get(settings.ALTCHA_SESSION_KEY) is None
+        # The token marks the client as already verified on later submissions.
+        response = client.post('/dam/submit/', {'altcha': 'not even trying'})
+        assert response.status_code == 200
+        mock_verify_solution.assert_called_once()
+
     @patch('dam.views.time.time', return_value=1.0)
     @patch('dam.views.verify_solution')
     def test_post_request_pass_already_validated_user(self, mock_verify_solution, mock_time,
@@ -104,3 +223,52 @@ class TestSubmitChallengeView:
         assert response.content.decode() == '{"success": true}'
         # We don't even want to check the solution if the user's already validated
         mock_verify_solution.assert_not_called()
+
+
+class TestDamCheckView:
+    """Unit tests for dam_check view."""
+
+    def test_unverified(self, client):
+        response = client.get('/dam/check/')
+        assert response.status_code == 401
+        assert response.content == b''
+
+    @pytest.mark.django_db
+    def test_verified_session(self, client):
+        session = client.session
+        session[settings.ALTCHA_SESSION_KEY] = time.time() + 100
+        session['ip'] = '127.0.0.1'
+        session.save()
+        assert client.get('/dam/check/').status_code == 204
+
+    def test_verified_token(self, client, settings):
+        settings.ALTCHA_USE_SIGNED_COOKIE = True
+        client.cookies[settings.ALTCHA_COOKIE_NAME] = make_token(time.time() + 100, '127.0.0.1/32')
+        assert client.get('/dam/check/').status_code == 204
+        client.cookies[settings.ALTCHA_COOKIE_NAME] = make_token(time.time() + 100, '10.0.0.1/32')
+        assert client.get('/dam/check/').status_code == 401
+
+    def test_excluded_ip(self, client, settings):
+        settings.ALTCHA_EXCLUDE_IPS = ['127.0.0.0/8']
+        assert client.get('/dam/check/').status_code == 204
+
+    def test_any_method_without_csrf_token(self, settings):
+        settings.ALTCHA_EXCLUDE_IPS = ['127.0.0.0/8']
+        client = Client(enforce_csrf_checks=True)
+        assert client.post('/dam/check/').status_code == 204
+
+    def test_not_redirected_by_middleware(self, client, settings):
+        settings.MIDDLEWARE = settings.MIDDLEWARE + ['dam.middleware.AltchaMiddleware']
+        assert client.get('/dam/check/').status_code == 401
+
+    def test_sync(self):
+        # Under WSGI, an async view would start an event loop on every check.
+        assert not asyncio.iscoroutinefunction(dam_check)
+
+    def test_async_version(self, async_rf, settings):
+        settings.ALTCHA_USE_SIGNED_COOKIE = True
+        request = async_rf.get('/dam/check/', REMOTE_ADDR='127.0.0.1')
+        assert async_to_sync(adam_check)(request).status_code == 401
+        request.COOKIES[settings.ALTCHA_COOKIE_NAME] = make_token(time.time() + 100,
+                                                                  '127.0.0.1/32')
+        assert async_to_sync(adam_check)(request).status_code == 204
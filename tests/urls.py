@@ -1,5 +1,6 @@
 from django.urls import include, path
 
+from dam.views import dam_metrics
 from tests.views import protected_view, open_view
 
 
@@ -7,4 +8,5 @@ urlpatterns = [
     path('', include('dam.urls')),
     path('protected/', protected_view),
     path('open/', open_view),
+    path('metrics/', dam_metrics),
 ]